@@ -5,6 +5,7 @@ import ast
 from itertools import chain
 import matplotlib.pyplot as plt
 import seaborn as sns
+from scripts.sgsgeneloss.pav_store import load_pav
 
 # GLOBALS
 DATA_DIR = Path("../../data/functional_annotation/")
@@ -84,9 +85,10 @@ def plt_top_n_go_terms_by_namespace(df: pd.DataFrame) -> plt.Figure:
 if __name__=="__main__":
 
     # 1) Get a list of core genes and a list of non-core genes from the pav dataframe.
-    pav_df = pd.read_csv(PAV_DF_PATH, index_col=0)
-    core_ids = pav_df.index[pav_df.sum(axis=1) == pav_df.shape[1]]
-    ncore_ids = pav_df.index[pav_df.sum(axis=1) < pav_df.shape[1]]
+    pav = load_pav(PAV_DF_PATH)
+    core_mask = pav.core_mask()
+    core_ids = pav.genes[core_mask]
+    ncore_ids = pav.genes[~core_mask]
 
     # 2) Filter the go_diamond dataframe using those ID's to create a dataframe of core and
     # non-core genes.
@@ -0,0 +1,156 @@
+# Vectorised GO enrichment for many study sets against one shared, precomputed background.
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Sequence
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import hypergeom
+
+from scripts.go_enrichment.go_index import GoAnnotation, load_go_annotation
+from scripts.sgsgeneloss.pav_store import load_pav_df
+
+
+def benjamini_hochberg(pvals: np.ndarray, axis: int = -1) -> np.ndarray:
+    """Benjamini-Hochberg adjusted p-values along `axis`, NaNs are left untouched and not counted."""
+    p = np.moveaxis(np.atleast_1d(np.asarray(pvals, dtype=float)), axis, -1)
+    flat = p.reshape(-1, p.shape[-1])
+    n_valid = (~np.isnan(flat)).sum(axis=1, keepdims=True)
+    ranks = np.arange(1, flat.shape[1] + 1)[None, :]
+
+    # Sort each row (NaNs last), scale by m / rank and take the running minimum from the largest p-value down.
+    order = np.argsort(flat, axis=1, kind="mergesort")
+    ranked = np.take_along_axis(flat, order, axis=1) * n_valid / ranks
+    ranked[ranks > n_valid] = np.inf
+    ranked = np.minimum.accumulate(ranked[:, ::-1], axis=1)[:, ::-1]
+    ranked = np.where(ranks > n_valid, np.nan, np.minimum(ranked, 1.0))
+
+    out = np.empty_like(flat)
+    np.put_along_axis(out, order, ranked, axis=1)
+    return np.moveaxis(out.reshape(p.shape), -1, axis)
+
+
+def pav_absent_study_sets(pav_df: pd.DataFrame) -> pd.DataFrame:
+    """Gene x sample boolean matrix of absent genes, one study set per sample."""
+    return pav_df == 0
+
+
+def group_absent_study_sets(pav_df: pd.DataFrame, groups: Mapping[str, str], how: str = "any") -> pd.DataFrame:
+    """Gene x group boolean matrix of genes absent in `any` (or `all`) samples of each group, e.g. sample -> Island."""
+    absent = pav_absent_study_sets(pav_df)
+    labels = pd.Series(groups).reindex(absent.columns)
+    absent = absent.loc[:, labels.notna()]
+    grouped = absent.T.groupby(labels.dropna())
+    return (grouped.any() if how == "any" else grouped.all()).T
+
+
+def run_batch_enrichment(study_sets: pd.DataFrame, annotation: GoAnnotation, alternative: str = "two-sided",
+                         min_bg_count: int = 1, namespaces: Optional[Sequence[str]] = None) -> Dict[str, pd.DataFrame]:
+    """Runs a hypergeometric enrichment test for every study set and every GO term in one pass.
+
+    `study_sets` is a gene x set boolean matrix (e.g. `pav_absent_study_sets(pav_df)`). The background is every
+    gene in `annotation` with at least one tested (propagated) term and study genes without one are ignored, as
+    goatools does. `alternative` is "greater" (over-representation), "less" (under-representation) or "two-sided"
+    (twice the smaller tail, capped at 1). Returns sets x terms dataframes keyed "study_count", "p_uncorrected", "p_fdr_bh" and
+    "fold_enrichment" (study ratio / population ratio), plus a "summary" of per-set study and population sizes.
+    """
+    if alternative not in {"two-sided", "greater", "less"}:
+        raise ValueError(f"Unknown alternative: {alternative}")
+
+    # Terms to test: present in the background, optionally restricted by namespace.
+    pop_counts = np.asarray(annotation.propagated.sum(axis=0)).ravel()
+    term_mask = pop_counts >= min_bg_count
+    if namespaces is not None:
+        if annotation.dag is None:
+            raise ValueError("Namespace filtering needs an annotation built with a GO DAG.")
+        term_mask &= np.isin(annotation.dag.namespaces, list(namespaces))
+    term_cols = np.flatnonzero(term_mask)
+    incidence = annotation.propagated[:, term_cols].astype(np.float32)
+
+    # Background and study sets only count genes carrying at least one of the tested terms.
+    annotated = incidence.getnnz(axis=1) > 0
+    incidence = incidence[annotated]
+    aligned = study_sets.reindex(annotation.gene_ids[annotated], fill_value=False).astype(bool)
+    study = sparse.csr_matrix(aligned.to_numpy(dtype=np.float32))
+
+    # sets x terms hit counts via one sparse product.
+    k = np.asarray((study.T @ incidence).todense(), dtype=np.int64)
+    pop_n = int(annotated.sum())
+    pop_k = pop_counts[term_cols][None, :]
+    study_n = np.asarray(study.sum(axis=0)).ravel().astype(np.int64)[:, None]
+
+    p_over = hypergeom.sf(k - 1, pop_n, pop_k, study_n)
+    p_under = hypergeom.cdf(k, pop_n, pop_k, study_n)
+    if alternative == "greater":
+        pvals = p_over
+    elif alternative == "less":
+        pvals = p_under
+    else:
+        pvals = np.minimum(1.0, 2 * np.minimum(p_over, p_under))
+    pvals = np.where(study_n > 0, pvals, np.nan)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fold = (k / study_n) / (pop_k / pop_n)
+
+    term_ids = annotation.term_ids[term_cols]
+    frame = lambda values: pd.DataFrame(values, index=aligned.columns, columns=term_ids)
+    summary = pd.DataFrame({"study_n": study_n.ravel(), "population_n": pop_n}, index=aligned.columns)
+
+    return {
+        "study_count": frame(k),
+        "p_uncorrected": frame(pvals),
+        "p_fdr_bh": frame(benjamini_hochberg(pvals, axis=1)),
+        "fold_enrichment": frame(fold),
+        "summary": summary,
+    }
+
+
+def batch_results_to_long(results: Dict[str, pd.DataFrame], annotation: GoAnnotation,
+                          alpha: float = 0.05) -> pd.DataFrame:
+    """Flattens `run_batch_enrichment` output into a goatools-like long table of significant (set, term) rows."""
+    fdr = results["p_fdr_bh"]
+    set_idx, term_idx = np.nonzero(fdr.to_numpy() < alpha)
+    term_ids = fdr.columns[term_idx]
+    fold = results["fold_enrichment"].to_numpy()[set_idx, term_idx]
+
+    long_df = pd.DataFrame({
+        "study_set": fdr.index[set_idx],
+        "GO": term_ids,
+        "study_count": results["study_count"].to_numpy()[set_idx, term_idx],
+        "study_n": results["summary"]["study_n"].to_numpy()[set_idx],
+        "fold_enrichment": fold,
+        "enrichment": np.where(fold > 1, "e", "p"),
+        "p_uncorrected": results["p_uncorrected"].to_numpy()[set_idx, term_idx],
+        "p_fdr_bh": fdr.to_numpy()[set_idx, term_idx],
+    })
+    if annotation.dag is not None:
+        positions = [annotation.dag.index[t] for t in term_ids]
+        long_df["name"] = annotation.dag.names[positions]
+        long_df["NS"] = annotation.dag.namespaces[positions]
+
+    return long_df.sort_values(["study_set", "p_fdr_bh"]).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    # Globals.
+    DATA_FOLDER = Path("../../data/functional_annotation")
+    BG_DATASET = DATA_FOLDER / "go_merged_diamond_results_uniprot.tsv"
+    OBODAG = DATA_FOLDER / "go-basic.obo"
+    PAV_MATRIX = Path("../../data/sgsgeneloss/pav_matrix.csv")
+    META_FILE = Path("../../metadata/raw_sample_metadata.xlsx")
+
+    # Background is built once and shared by every study set.
+    annotation = load_go_annotation(BG_DATASET, obo_file=OBODAG)
+    pav_df = load_pav_df(PAV_MATRIX)
+    pav_df.columns = pav_df.columns.str.replace("_merged_all$", "", regex=True)
+    meta_df = pd.read_excel(META_FILE, index_col=0)
+
+    # Per sample and per island absent-gene sets.
+    sample_results = run_batch_enrichment(pav_absent_study_sets(pav_df), annotation, alternative="greater")
+    island_results = run_batch_enrichment(group_absent_study_sets(pav_df, meta_df["Island"]), annotation,
+                                          alternative="greater")
+
+    sample_long_df = batch_results_to_long(sample_results, annotation, alpha=0.01)
+    island_long_df = batch_results_to_long(island_results, annotation, alpha=0.01)
+    sample_long_df.to_csv(DATA_FOLDER / "batch_enrichment_per_sample.csv", index=False)
+    island_long_df.to_csv(DATA_FOLDER / "batch_enrichment_per_island.csv", index=False)
+    print(island_long_df.groupby("study_set").size())
@@ -1,6 +1,7 @@
 import pandas as pd
 from tabulate import tabulate
 from great_tables import GT
+from scripts.go_enrichment.go_index import filter_by_go_terms
 
 
 # Function to extract the uniprot accession from "subject_id".
@@ -18,7 +19,8 @@ df = pd.read_csv("../../data/functional_annotation/noncore_go_merged_diamond_res
 
 # GO TERMS TO FILTER.
 go_terms = ["GO:0016114"]
-filtered_df = df[df["go_terms"].str.contains("GO:0016114", na=False)]
+# Hits are counted per row below, so each row has to carry the term itself.
+filtered_df = filter_by_go_terms(df, go_terms, by_row=True)
 
 # Generate summary table.
 summary = filtered_df.groupby("subject_id").agg(
@@ -4,6 +4,8 @@ import numpy as np
 from pathlib import Path
 from tabulate import tabulate
 from go_enrichment_.goatools_enrichment_study import *
+from scripts.go_enrichment.go_index import build_go_annotation, load_go_dag
+from scripts.go_enrichment.go_similarity import reduce_redundant_terms
 
 if __name__ == "__main__":
     # Globals.
@@ -22,6 +24,10 @@ if __name__ == "__main__":
     # Get enriched significant results.
     over_df = results_df.query("p_fdr_bh < 0.01 and enrichment == 'e'")
 
+    # Collapse redundant parent/child terms to one representative per semantic cluster.
+    annotation = build_go_annotation(bg_df, dag=load_go_dag(OBODAG))
+    over_df = reduce_redundant_terms(over_df, annotation, threshold=0.7)
+
     # Build wordcloud.
     wc_fig = plt_wordcloud(over_df, max_words=45, subset="e")
     wc_fig.show()
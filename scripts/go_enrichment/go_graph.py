@@ -0,0 +1,174 @@
+# Builds a pruned GO network (enriched terms + lowest common ancestors) with cached layouts for plotting.
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from scipy import sparse
+from scipy.sparse.linalg import eigsh
+
+from scripts.go_enrichment.go_index import GoDag
+from scripts.go_enrichment.go_similarity import max_common_ancestor
+
+# GLOBALS
+LAYOUT_CACHE_DIR = Path("../../data/functional_annotation/go_layout_cache")
+_LAYOUT_MEMORY_CACHE: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+
+@dataclass(frozen=True)
+class GoNetwork:
+    """Induced GO sub-DAG. `edges` holds (child, parent) node positions after transitive reduction."""
+    term_ids: np.ndarray
+    names: np.ndarray
+    term_cols: np.ndarray
+    edges: np.ndarray
+    is_enriched: np.ndarray
+    level: np.ndarray
+    dag_hash: str
+
+    def __len__(self) -> int:
+        return len(self.term_ids)
+
+
+def build_go_network(go_df: pd.DataFrame, dag: GoDag, go_col: str = "GO") -> GoNetwork:
+    """Induces the network of the enriched terms in `go_df` plus the lowest common ancestor of every pair."""
+    enriched = np.unique([dag.index[t] for t in go_df[go_col].unique() if t in dag.index]).astype(np.int64)
+
+    # Deepest shared ancestor per pair, depth + 1 so the namespace roots still count.
+    _, lca = max_common_ancestor(dag, enriched, dag.depth.astype(float) + 1)
+    lca_cols = np.unique(lca[np.triu_indices(len(enriched), k=1)])
+    nodes = np.union1d(enriched, lca_cols[lca_cols >= 0])
+
+    # Reachability between kept nodes, then drop edges implied by a path through another kept node.
+    reach = dag.ancestors[nodes][:, nodes].tocsr().astype(np.int32)
+    reach.setdiag(0)
+    reach.eliminate_zeros()
+    implied = (reach @ reach).astype(bool)
+    direct = reach.astype(bool).tocsr() - reach.astype(bool).multiply(implied)
+    child, parent = direct.nonzero()
+
+    # Longest path from the top of the induced graph, visiting parents first (DAG depth increases downwards).
+    level = np.zeros(len(nodes), dtype=np.int32)
+    parents_of = sparse.csr_matrix((np.ones(len(child), dtype=bool), (child, parent)), shape=(len(nodes),) * 2)
+    for u in np.argsort(dag.depth[nodes], kind="mergesort"):
+        p = parents_of.indices[parents_of.indptr[u]:parents_of.indptr[u + 1]]
+        if len(p):
+            level[u] = level[p].max() + 1
+
+    return GoNetwork(
+        term_ids=dag.term_ids[nodes],
+        names=dag.names[nodes],
+        term_cols=nodes,
+        edges=np.column_stack([child, parent]).astype(np.int64),
+        is_enriched=np.isin(nodes, enriched),
+        level=level,
+        dag_hash=dag.source_hash,
+    )
+
+
+def _spectral_layout(network: GoNetwork) -> np.ndarray:
+    """2D spectral embedding from the two smallest non-trivial Laplacian eigenvectors."""
+    n = len(network)
+    if n < 3:
+        return np.column_stack([np.arange(n, dtype=float), np.zeros(n)])
+
+    i, j = network.edges.T
+    adj = sparse.csr_matrix((np.ones(len(i)), (i, j)), shape=(n, n))
+    adj = adj + adj.T
+    deg = np.asarray(adj.sum(axis=1)).ravel()
+    laplacian = sparse.diags(deg) - adj + sparse.identity(n) * 1e-9
+
+    if n <= 500:
+        _, vecs = np.linalg.eigh(laplacian.toarray())
+    else:
+        _, vecs = eigsh(laplacian.tocsc(), k=3, sigma=-1e-3, which="LM")
+    return vecs[:, 1:3]
+
+
+def _layered_layout(network: GoNetwork) -> np.ndarray:
+    """Top-down layered layout: y is the network level, x is the barycentre of the parents spread evenly per layer."""
+    n = len(network)
+    x = np.zeros(n)
+    child, parent = network.edges.T
+    parents_of = sparse.csr_matrix((np.ones(len(child)), (child, parent)), shape=(n, n))
+    n_parents = np.asarray(parents_of.sum(axis=1)).ravel()
+
+    # Seed the order with the spectral embedding so unrelated branches start apart.
+    seed = _spectral_layout(network)[:, 0] if n >= 3 else np.arange(n, dtype=float)
+    for lvl in range(network.level.max() + 1 if n else 0):
+        layer = np.flatnonzero(network.level == lvl)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            bary = np.where(n_parents[layer] > 0, (parents_of[layer] @ x) / n_parents[layer], seed[layer])
+        order = layer[np.lexsort((seed[layer], bary))]
+        x[order] = np.linspace(-1, 1, len(order)) * (len(order) - 1) / 2 if len(order) > 1 else 0.0
+
+    return np.column_stack([x, -network.level.astype(float)])
+
+
+def _layout_key(network: GoNetwork, method: str) -> str:
+    digest = hashlib.sha1(f"{network.dag_hash}|{method}|".encode())
+    digest.update("\n".join(sorted(network.term_ids)).encode())
+    return digest.hexdigest()
+
+
+def compute_layout(network: GoNetwork, method: str = "layered", cache_dir: Optional[Path] = LAYOUT_CACHE_DIR) -> \
+        pd.DataFrame:
+    """Node positions for a network, cached in memory and on disk keyed by (DAG, method, term set)."""
+    key = _layout_key(network, method)
+    cache_file = Path(cache_dir) / f"{key}.npz" if cache_dir is not None else None
+
+    if key in _LAYOUT_MEMORY_CACHE:
+        cached_ids, positions = _LAYOUT_MEMORY_CACHE[key]
+    elif cache_file is not None and cache_file.exists():
+        cached = np.load(cache_file, allow_pickle=False)
+        cached_ids, positions = cached["term_ids"], cached["positions"]
+    else:
+        if method == "layered":
+            positions = _layered_layout(network)
+        elif method == "spectral":
+            positions = _spectral_layout(network)
+        else:
+            raise ValueError(f"Unknown layout method: {method}")
+        cached_ids = network.term_ids
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(cache_file, term_ids=cached_ids, positions=positions)
+
+    _LAYOUT_MEMORY_CACHE[key] = (cached_ids, positions)
+    return pd.DataFrame(positions, index=pd.Index(cached_ids, name="GO"), columns=["x", "y"]).loc[network.term_ids]
+
+
+def plot_go_network(network: GoNetwork, go_df: pd.DataFrame, layout: Optional[pd.DataFrame] = None,
+                    plot_labels: bool = True, pvalue: float = 0.05, go_col: str = "GO", p_col: str = "p_fdr_bh",
+                    max_label_length: int = 30, ax: Optional[plt.Axes] = None):
+    """Draws the network with enriched terms passing `pvalue` coloured by -log10(p). Cut-off and labels only change
+    the styling, the (cached) layout is reused."""
+    layout = compute_layout(network) if layout is None else layout
+    xy = layout.loc[network.term_ids, ["x", "y"]].to_numpy()
+    pvals = go_df.groupby(go_col)[p_col].min().reindex(network.term_ids).to_numpy()
+    significant = network.is_enriched & (pvals < pvalue)
+
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(14, 10))
+
+    # One collection for all edges keeps large networks fast to draw.
+    ax.add_collection(LineCollection(xy[network.edges], colors="lightgray", linewidths=0.6, zorder=1))
+    ax.scatter(*xy[~significant].T, s=15, color="lightgray", edgecolor="gray", linewidth=0.3, zorder=2)
+    points = ax.scatter(*xy[significant].T, s=60, c=-np.log10(pvals[significant]), cmap="viridis",
+                        edgecolor="black", linewidth=0.4, zorder=3)
+    if significant.any():
+        plt.colorbar(points, ax=ax, label=f"-log10({p_col})", shrink=0.6)
+
+    if plot_labels:
+        for (x, y), name in zip(xy[significant], network.names[significant]):
+            label = name if len(name) <= max_label_length else name[:max_label_length] + "..."
+            ax.annotate(label, (x, y), fontsize=7, xytext=(3, 3), textcoords="offset points")
+
+    ax.autoscale()
+    ax.set_axis_off()
+    ax.set_title(f"GO network of enriched terms ({significant.sum()} with {p_col} < {pvalue}).")
+    plt.tight_layout()
+    return plt
@@ -0,0 +1,396 @@
+# Compiled GO DAG and gene x GO-term incidence matrix shared by the enrichment, filtering and network scripts.
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# GLOBALS
+GO_ID_PATTERN = r"\bGO:\d{7}\b"
+MRNA_SUFFIX = r"-mRNA-1$"
+DAG_CACHE_VERSION = 1
+
+
+@dataclass(frozen=True)
+class GoDag:
+    """GO ontology compiled into integer-indexed arrays.
+
+    `ancestors` is a reflexive term x term boolean CSR matrix: row i flags term i and every term reachable from it
+    through the followed relationships. Obsolete terms are dropped and alt_ids resolve to their primary term.
+    """
+    term_ids: np.ndarray
+    names: np.ndarray
+    namespaces: np.ndarray
+    depth: np.ndarray
+    parents: sparse.csr_matrix
+    ancestors: sparse.csr_matrix
+    alt_ids: Dict[str, str]
+    source_hash: str
+
+    @property
+    def index(self) -> Dict[str, int]:
+        """GO ID -> row/column position, including alt_ids."""
+        lookup = getattr(self, "_index", None)
+        if lookup is None:
+            lookup = {go_id: i for i, go_id in enumerate(self.term_ids)}
+            for alt_id, primary in self.alt_ids.items():
+                if primary in lookup:
+                    lookup[alt_id] = lookup[primary]
+            object.__setattr__(self, "_index", lookup)
+        return lookup
+
+    @property
+    def descendants(self) -> sparse.csr_matrix:
+        """Reflexive term x term matrix, row i flags term i and all of its descendants."""
+        desc = getattr(self, "_descendants", None)
+        if desc is None:
+            desc = self.ancestors.T.tocsr()
+            object.__setattr__(self, "_descendants", desc)
+        return desc
+
+    def __len__(self) -> int:
+        return len(self.term_ids)
+
+
+@dataclass(frozen=True)
+class GoAnnotation:
+    """Gene x GO-term incidence matrices built from the GO merged diamond results.
+
+    `direct` holds only the terms listed against each gene, `propagated` also flags every ancestor term (the true
+    path rule), which is what enrichment and descendant-aware filters need. Columns follow `term_ids`.
+    """
+    gene_ids: pd.Index
+    term_ids: np.ndarray
+    direct: sparse.csr_matrix
+    propagated: sparse.csr_matrix
+    dag: Optional[GoDag] = None
+
+    @property
+    def term_index(self) -> Dict[str, int]:
+        """GO ID -> column position (alt_ids resolve when a DAG is attached)."""
+        lookup = getattr(self, "_term_index", None)
+        if lookup is None:
+            lookup = dict(self.dag.index) if self.dag is not None else {t: i for i, t in enumerate(self.term_ids)}
+            object.__setattr__(self, "_term_index", lookup)
+        return lookup
+
+    @property
+    def propagated_csc(self) -> sparse.csc_matrix:
+        """Column-major copy of the propagated matrix for fast per-term gene lookups."""
+        csc = getattr(self, "_propagated_csc", None)
+        if csc is None:
+            csc = self.propagated.tocsc()
+            object.__setattr__(self, "_propagated_csc", csc)
+        return csc
+
+    @property
+    def direct_csc(self) -> sparse.csc_matrix:
+        """Column-major copy of the direct matrix for fast per-term gene lookups."""
+        csc = getattr(self, "_direct_csc", None)
+        if csc is None:
+            csc = self.direct.tocsc()
+            object.__setattr__(self, "_direct_csc", csc)
+        return csc
+
+
+# OBO parsing.
+def parse_obo(obo_file: Path) -> pd.DataFrame:
+    """Parses the [Term] stanzas of an OBO file into a dataframe with one row per term.
+
+    Relationship lists (is_a, part_of, ...) are stored as lists of parent GO IDs in a `relationships` dict column.
+    """
+    records = []
+    term = None
+    with Path(obo_file).open() as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                if term is not None:
+                    records.append(term)
+                term = {"id": None, "name": "", "namespace": "", "alt_ids": [], "relationships": {},
+                        "is_obsolete": False} if line == "[Term]" else None
+                continue
+            if term is None or ": " not in line:
+                continue
+
+            key, value = line.split(": ", 1)
+            value = value.split(" ! ", 1)[0].strip()
+            if key == "id":
+                term["id"] = value
+            elif key == "name":
+                term["name"] = value
+            elif key == "namespace":
+                term["namespace"] = value
+            elif key == "alt_id":
+                term["alt_ids"].append(value)
+            elif key == "is_obsolete":
+                term["is_obsolete"] = value == "true"
+            elif key == "is_a":
+                term["relationships"].setdefault("is_a", []).append(value)
+            elif key == "relationship":
+                rel_type, parent = value.split()[:2]
+                term["relationships"].setdefault(rel_type, []).append(parent)
+
+    if term is not None:
+        records.append(term)
+    return pd.DataFrame(records)
+
+
+def compile_go_dag(obo_file: Path, relationships: Sequence[str] = ("is_a",)) -> GoDag:
+    """Compiles an OBO file into a GoDag, following the given relationship types when propagating.
+
+    Defaults to is_a only, matching goatools' default propagation.
+    """
+    obo_file = Path(obo_file)
+    terms_df = parse_obo(obo_file)
+    terms_df = terms_df[terms_df["id"].str.startswith("GO:", na=False) & ~terms_df["is_obsolete"]]
+    terms_df = terms_df.reset_index(drop=True)
+
+    term_ids = terms_df["id"].to_numpy(dtype=str)
+    index = {go_id: i for i, go_id in enumerate(term_ids)}
+    alt_ids = {alt: primary for primary, alts in zip(terms_df["id"], terms_df["alt_ids"]) for alt in alts}
+
+    # Child -> parent edges restricted to the followed relationship types.
+    child_idx, parent_idx = [], []
+    for i, rels in enumerate(terms_df["relationships"]):
+        for rel_type in relationships:
+            for parent in rels.get(rel_type, []):
+                j = index.get(parent)
+                if j is not None:
+                    child_idx.append(i)
+                    parent_idx.append(j)
+    n = len(term_ids)
+    parents = sparse.csr_matrix((np.ones(len(child_idx), dtype=bool), (child_idx, parent_idx)), shape=(n, n))
+
+    ancestors, depth = _ancestor_closure(parents)
+
+    return GoDag(
+        term_ids=term_ids,
+        names=terms_df["name"].to_numpy(dtype=str),
+        namespaces=terms_df["namespace"].to_numpy(dtype=str),
+        depth=depth,
+        parents=parents,
+        ancestors=ancestors,
+        alt_ids=alt_ids,
+        source_hash=_file_hash(obo_file),
+    )
+
+
+def _ancestor_closure(parents: sparse.csr_matrix) -> Tuple[sparse.csr_matrix, np.ndarray]:
+    """Reflexive-transitive closure and longest-path depth of a child -> parent adjacency matrix."""
+    n = parents.shape[0]
+    n_parents = np.diff(parents.indptr)
+    children = parents.T.tocsr()
+
+    # Kahn's algorithm from the roots down, so every parent is closed before its children.
+    remaining = n_parents.copy()
+    queue = list(np.flatnonzero(remaining == 0))
+    anc_sets: List[Optional[np.ndarray]] = [None] * n
+    depth = np.zeros(n, dtype=np.int32)
+    while queue:
+        i = queue.pop()
+        p = parents.indices[parents.indptr[i]:parents.indptr[i + 1]]
+        if len(p):
+            anc_sets[i] = np.union1d(np.concatenate([anc_sets[j] for j in p]), [i])
+            depth[i] = depth[p].max() + 1
+        else:
+            anc_sets[i] = np.array([i])
+        for c in children.indices[children.indptr[i]:children.indptr[i + 1]]:
+            remaining[c] -= 1
+            if remaining[c] == 0:
+                queue.append(c)
+
+    if any(a is None for a in anc_sets):
+        raise ValueError("GO relationships contain a cycle, cannot compile the DAG.")
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(a) for a in anc_sets])
+    indices = np.concatenate(anc_sets).astype(np.int32)
+    ancestors = sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(n, n))
+    return ancestors, depth
+
+
+def _file_hash(path: Path) -> str:
+    """sha1 of a file's contents."""
+    digest = hashlib.sha1()
+    with Path(path).open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_go_dag(obo_file: Path, relationships: Sequence[str] = ("is_a",), use_cache: bool = True) -> GoDag:
+    """Loads a compiled GoDag, reusing a `.dag.npz` cache next to the OBO file when its hash still matches."""
+    obo_file = Path(obo_file)
+    cache_file = obo_file.with_name(f"{obo_file.stem}.{'_'.join(relationships)}.dag.npz")
+
+    if use_cache and cache_file.exists():
+        cached = np.load(cache_file, allow_pickle=False)
+        if int(cached["version"]) == DAG_CACHE_VERSION and str(cached["source_hash"]) == _file_hash(obo_file):
+            n = len(cached["term_ids"])
+            return GoDag(
+                term_ids=cached["term_ids"],
+                names=cached["names"],
+                namespaces=cached["namespaces"],
+                depth=cached["depth"],
+                parents=sparse.csr_matrix((np.ones(len(cached["parents_indices"]), dtype=bool),
+                                           cached["parents_indices"], cached["parents_indptr"]), shape=(n, n)),
+                ancestors=sparse.csr_matrix((np.ones(len(cached["anc_indices"]), dtype=bool),
+                                             cached["anc_indices"], cached["anc_indptr"]), shape=(n, n)),
+                alt_ids=dict(zip(cached["alt_keys"], cached["alt_values"])),
+                source_hash=str(cached["source_hash"]),
+            )
+
+    dag = compile_go_dag(obo_file, relationships=relationships)
+    if use_cache:
+        np.savez(
+            cache_file,
+            version=DAG_CACHE_VERSION,
+            source_hash=dag.source_hash,
+            term_ids=dag.term_ids,
+            names=dag.names,
+            namespaces=dag.namespaces,
+            depth=dag.depth,
+            parents_indptr=dag.parents.indptr,
+            parents_indices=dag.parents.indices,
+            anc_indptr=dag.ancestors.indptr,
+            anc_indices=dag.ancestors.indices,
+            alt_keys=np.array(list(dag.alt_ids.keys()), dtype=str),
+            alt_values=np.array(list(dag.alt_ids.values()), dtype=str),
+        )
+    return dag
+
+
+# Gene annotation.
+def explode_go_terms(go_terms: pd.Series) -> pd.Series:
+    """Turns a column of GO term lists (or their string repr) into one exact GO ID per row, keeping the index."""
+    if go_terms.map(lambda x: isinstance(x, list)).all():
+        return go_terms.explode().dropna()
+    return go_terms.astype("string").str.findall(GO_ID_PATTERN).explode().dropna()
+
+
+def build_go_annotation(dmnd_df: pd.DataFrame, dag: Optional[GoDag] = None,
+                        gene_col: Optional[str] = "query_id") -> GoAnnotation:
+    """Builds the gene x GO-term incidence matrices from a GO merged diamond dataframe.
+
+    Genes come from `gene_col` (or the index when None) with the `-mRNA-1` suffix removed so they match the PAV
+    matrix. Without a DAG the columns are the observed GO IDs and no propagation is done.
+    """
+    genes = dmnd_df[gene_col] if gene_col is not None else dmnd_df.index.to_series()
+    genes = pd.Series(genes.to_numpy(), index=np.arange(len(dmnd_df))).astype(str)
+    genes = genes.str.replace(MRNA_SUFFIX, "", regex=True)
+    gene_ids = pd.Index(pd.unique(genes), name="ID")
+
+    go_long = explode_go_terms(pd.Series(dmnd_df["go_terms"].to_numpy(), index=genes.index))
+    gene_codes = gene_ids.get_indexer(genes.loc[go_long.index])
+
+    if dag is not None:
+        term_ids = dag.term_ids
+        term_codes = go_long.map(dag.index).to_numpy()
+        keep = ~pd.isna(term_codes)
+        gene_codes, term_codes = gene_codes[keep], term_codes[keep].astype(np.int64)
+    else:
+        term_codes, term_ids = pd.factorize(go_long, sort=True)
+        term_ids = np.asarray(term_ids, dtype=str)
+
+    shape = (len(gene_ids), len(term_ids))
+    direct = sparse.csr_matrix((np.ones(len(gene_codes), dtype=bool), (gene_codes, term_codes)), shape=shape)
+    direct.sum_duplicates()
+    direct.data[:] = True
+
+    if dag is not None:
+        propagated = (direct.astype(np.int32) @ dag.ancestors.astype(np.int32)).astype(bool).tocsr()
+    else:
+        propagated = direct
+
+    return GoAnnotation(gene_ids=gene_ids, term_ids=term_ids, direct=direct, propagated=propagated, dag=dag)
+
+
+def load_go_annotation(dmnd_file: Path, obo_file: Optional[Path] = None, sep: Optional[str] = None,
+                       gene_col: Optional[str] = "query_id") -> GoAnnotation:
+    """Reads a GO merged diamond file (tsv or csv) and builds its annotation, propagated if an OBO file is given."""
+    dmnd_file = Path(dmnd_file)
+    sep = sep or ("\t" if dmnd_file.suffix == ".tsv" else ",")
+    columns = ["go_terms"] if gene_col is None else [gene_col, "go_terms"]
+    dmnd_df = pd.read_csv(dmnd_file, sep=sep, usecols=columns if gene_col is not None else None,
+                          index_col=0 if gene_col is None else None)
+    dag = load_go_dag(obo_file) if obo_file is not None else None
+    return build_go_annotation(dmnd_df, dag=dag, gene_col=gene_col)
+
+
+def term_names(annotation: GoAnnotation, term_ids: Iterable[str]) -> List[str]:
+    """Human-readable names for GO IDs (empty strings without a DAG)."""
+    if annotation.dag is None:
+        return ["" for _ in term_ids]
+    return [annotation.dag.names[annotation.dag.index[t]] if t in annotation.dag.index else "" for t in term_ids]
+
+
+# Term filtering.
+def resolve_go_ids(annotation: GoAnnotation, go_ids: Iterable[str], strict: bool = False) -> np.ndarray:
+    """Column positions of the given GO IDs (alt_ids resolve through the DAG), unknown IDs are skipped or raise."""
+    go_ids = list(go_ids)
+    positions = [annotation.term_index.get(go_id) for go_id in go_ids]
+    missing = [go_id for go_id, pos in zip(go_ids, positions) if pos is None]
+    if missing and strict:
+        raise KeyError(f"GO IDs not found in the annotation: {', '.join(missing)}")
+    return np.unique(np.array([pos for pos in positions if pos is not None], dtype=np.int64))
+
+
+def genes_with_go_terms(annotation: GoAnnotation, go_ids: Iterable[str], include_descendants: bool = False,
+                        strict: bool = False) -> pd.Index:
+    """Gene IDs annotated with any of `go_ids`, by exact term match.
+
+    With `include_descendants` a gene also matches when it carries a descendant of a requested term, which is read
+    straight off the propagated matrix. Cost is linear in the non-zeros of the selected columns.
+    """
+    if include_descendants and annotation.dag is None:
+        raise ValueError("Descendant matching needs an annotation built with a GO DAG.")
+
+    cols = resolve_go_ids(annotation, go_ids, strict=strict)
+    matrix = annotation.propagated_csc if include_descendants else annotation.direct_csc
+    rows = np.concatenate([matrix.indices[matrix.indptr[c]:matrix.indptr[c + 1]] for c in cols]) if len(cols) else []
+    return annotation.gene_ids[np.unique(np.asarray(rows, dtype=np.int64))]
+
+
+def rows_with_go_terms(dmnd_df: pd.DataFrame, annotation: GoAnnotation, go_ids: Iterable[str],
+                       include_descendants: bool = False, strict: bool = False) -> np.ndarray:
+    """Boolean mask of the rows whose own `go_terms` hold any of `go_ids` (or, with `include_descendants`, a
+    descendant of one), with terms resolved to `annotation` columns."""
+    if include_descendants and annotation.dag is None:
+        raise ValueError("Descendant matching needs an annotation built with a GO DAG.")
+
+    cols = resolve_go_ids(annotation, go_ids, strict=strict)
+    # Which annotation columns count as a hit: the requested terms, or every term with one of them as ancestor.
+    term_hit = np.zeros(len(annotation.term_ids), dtype=bool)
+    if include_descendants and len(cols):
+        term_hit = np.asarray(annotation.dag.ancestors[:, cols].sum(axis=1)).ravel() > 0
+    else:
+        term_hit[cols] = True
+
+    go_long = explode_go_terms(pd.Series(dmnd_df["go_terms"].to_numpy(), index=np.arange(len(dmnd_df))))
+    codes = go_long.map(annotation.term_index)
+    known = codes.notna().to_numpy()
+    hit_rows = go_long.index[known][term_hit[codes[known].to_numpy(dtype=np.int64)]]
+    mask = np.zeros(len(dmnd_df), dtype=bool)
+    mask[hit_rows] = True
+    return mask
+
+
+def filter_by_go_terms(dmnd_df: pd.DataFrame, go_ids: Iterable[str], dag: Optional[GoDag] = None,
+                       include_descendants: bool = False, gene_col: Optional[str] = "query_id",
+                       by_row: bool = False) -> pd.DataFrame:
+    """Rows of a GO merged diamond dataframe whose gene is annotated with any of `go_ids` (see genes_with_go_terms).
+
+    With `by_row` a row is only kept when its own `go_terms` match, so other hits of the same gene without the term
+    are dropped; use it when a gene has several rows (e.g. one per diamond hit).
+    """
+    annotation = build_go_annotation(dmnd_df, dag=dag, gene_col=gene_col)
+    if by_row:
+        return dmnd_df[rows_with_go_terms(dmnd_df, annotation, go_ids, include_descendants=include_descendants)]
+    genes = genes_with_go_terms(annotation, go_ids, include_descendants=include_descendants)
+
+    row_genes = dmnd_df[gene_col] if gene_col is not None else dmnd_df.index.to_series()
+    row_genes = row_genes.astype(str).str.replace(MRNA_SUFFIX, "", regex=True)
+    return dmnd_df[row_genes.isin(genes).to_numpy()]
\ No newline at end of file
@@ -1,15 +1,17 @@
-# Builds a GO network using networkx to visualise enriched GO terms.
+# Builds a GO network of the enriched GO terms (plus their lowest common ancestors) and visualises it.
 from pathlib import Path
-from go_enrichment_.go_network import build_go_network, plot_go_network
+from scripts.go_enrichment.go_graph import build_go_network, compute_layout, plot_go_network
+from scripts.go_enrichment.go_index import load_go_dag
 import pandas as pd
 
 if __name__ == "__main__":
     DATA_FOLDER = Path("../../data/functional_annotation")
     go_df = pd.read_csv(DATA_FOLDER/"goatools_go_enrichment_results_overrep.csv", header=0)
+    dag = load_go_dag(DATA_FOLDER / "go-basic.obo")
 
-    # Build plot.
-    network_x_graph = build_go_network(go_df=go_df)
-    plt = plot_go_network(graph=network_x_graph, go_df=go_df, plot_labels=True, pvalue=0.01)
-    plt.show()
-
+    # Build network once, the layout is cached against the term set so replots are cheap.
+    network = build_go_network(go_df=go_df, dag=dag)
+    layout = compute_layout(network)
 
+    plt = plot_go_network(network, go_df=go_df, layout=layout, plot_labels=True, pvalue=0.01)
+    plt.show()
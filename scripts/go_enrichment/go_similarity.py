@@ -0,0 +1,131 @@
+# Information content based semantic similarity (Resnik / Lin) for collapsing redundant enriched GO terms.
+from typing import Iterable, Optional, Tuple
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+
+from scripts.go_enrichment.go_index import GoAnnotation, GoDag, resolve_go_ids
+
+
+def information_content(annotation: GoAnnotation) -> np.ndarray:
+    """-log p(t) for every annotation column, p(t) being the propagated gene frequency of t relative to its
+    namespace root. Terms without annotated genes get NaN."""
+    counts = np.asarray(annotation.propagated.sum(axis=0), dtype=float).ravel()
+    if annotation.dag is None:
+        totals = np.full_like(counts, len(annotation.gene_ids))
+    else:
+        # Root of each namespace carries every gene annotated in that namespace.
+        namespaces = pd.Series(annotation.dag.namespaces)
+        totals = pd.Series(counts).groupby(namespaces).transform("max").to_numpy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ic = -np.log(counts / totals)
+    ic[counts == 0] = np.nan
+    return ic
+
+
+def max_common_ancestor(dag: GoDag, term_cols: np.ndarray, scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """For every pair of terms, the highest score over their shared ancestors and the position of that ancestor.
+
+    Ancestors are visited in ascending score order and each one overwrites the pair block of the terms it covers,
+    so the final value is the maximum. Ancestors with a non-positive or NaN score are skipped (pairs without a
+    scoring common ancestor keep 0 and position -1).
+    """
+    m = len(term_cols)
+    best = np.zeros((m, m))
+    best_pos = np.full((m, m), -1, dtype=np.int64)
+
+    anc = dag.ancestors[term_cols].tocsc()
+    anc.sort_indices()
+    cols = np.flatnonzero(np.diff(anc.indptr) > 0)
+    col_scores = scores[cols]
+    keep = ~np.isnan(col_scores) & (col_scores > 0)
+    cols, col_scores = cols[keep], col_scores[keep]
+
+    for c, score in zip(cols[np.argsort(col_scores, kind="mergesort")], np.sort(col_scores, kind="mergesort")):
+        members = anc.indices[anc.indptr[c]:anc.indptr[c + 1]]
+        block = np.ix_(members, members)
+        best[block] = score
+        best_pos[block] = c
+
+    return best, best_pos
+
+
+def resnik_similarity(annotation: GoAnnotation, go_ids: Iterable[str],
+                      ic: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Pairwise Resnik similarity (IC of the most informative common ancestor)."""
+    if annotation.dag is None:
+        raise ValueError("Semantic similarity needs an annotation built with a GO DAG.")
+    ic = information_content(annotation) if ic is None else ic
+    term_cols = resolve_go_ids(annotation, go_ids)
+    sim, _ = max_common_ancestor(annotation.dag, term_cols, ic)
+    labels = annotation.term_ids[term_cols]
+    return pd.DataFrame(sim, index=labels, columns=labels)
+
+
+def lin_similarity(annotation: GoAnnotation, go_ids: Iterable[str],
+                   ic: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Pairwise Lin similarity, 2 * IC(MICA) / (IC(a) + IC(b)), in [0, 1]."""
+    ic = information_content(annotation) if ic is None else ic
+    resnik = resnik_similarity(annotation, go_ids, ic=ic)
+    term_ic = np.nan_to_num(ic[resolve_go_ids(annotation, resnik.index)])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lin = 2 * resnik.to_numpy() / (term_ic[:, None] + term_ic[None, :])
+    lin = np.nan_to_num(lin)
+    np.fill_diagonal(lin, 1.0)
+    return pd.DataFrame(lin, index=resnik.index, columns=resnik.columns)
+
+
+def cluster_terms(annotation: GoAnnotation, go_ids: Iterable[str], pvals: Optional[pd.Series] = None,
+                  threshold: float = 0.7, method: str = "lin") -> pd.DataFrame:
+    """Groups GO terms whose average-linkage similarity is at least `threshold` and picks one representative each.
+
+    The representative is the term with the lowest p-value in `pvals` (GO ID -> p), falling back to the most
+    informative term. Unknown GO IDs are dropped. Returns one row per term with its cluster and representative.
+    """
+    ic = information_content(annotation)
+    sim_df = (lin_similarity if method == "lin" else resnik_similarity)(annotation, go_ids, ic=ic)
+    terms = sim_df.index
+    if method != "lin":
+        sim_df = sim_df / max(np.nanmax(sim_df.to_numpy()), 1e-12)
+
+    if len(terms) > 1:
+        dist = np.clip(1 - sim_df.to_numpy(), 0, None)
+        np.fill_diagonal(dist, 0)
+        tree = linkage(squareform(dist, checks=False), method="average")
+        clusters = fcluster(tree, t=1 - threshold, criterion="distance")
+    else:
+        clusters = np.ones(len(terms), dtype=int)
+
+    cluster_df = pd.DataFrame({
+        "GO": terms,
+        "cluster": clusters,
+        "ic": ic[resolve_go_ids(annotation, terms)] if len(terms) else [],
+        "p": pd.Series(pvals).reindex(terms).to_numpy() if pvals is not None else np.nan,
+    })
+
+    # Lowest p first, most specific term breaks ties.
+    ranked = cluster_df.sort_values(["cluster", "p", "ic"], ascending=[True, True, False], na_position="last")
+    representatives = ranked.groupby("cluster")["GO"].first()
+    cluster_df["representative"] = cluster_df["cluster"].map(representatives)
+    cluster_df["is_representative"] = cluster_df["GO"] == cluster_df["representative"]
+    cluster_df["cluster_size"] = cluster_df.groupby("cluster")["GO"].transform("size")
+    sim = sim_df.to_numpy()
+    rep_pos = sim_df.index.get_indexer(cluster_df["representative"])
+    cluster_df["similarity_to_representative"] = sim[np.arange(len(terms)), rep_pos] if len(terms) else []
+    return cluster_df
+
+
+def reduce_redundant_terms(enriched_df: pd.DataFrame, annotation: GoAnnotation, go_col: str = "GO",
+                           p_col: str = "p_fdr_bh", threshold: float = 0.7) -> pd.DataFrame:
+    """Keeps only the cluster representatives of an enrichment results table (e.g. `over_df`), adding the
+    `cluster_size` so plots can show how many redundant terms each one stands for."""
+    pvals = enriched_df.groupby(go_col)[p_col].min() if p_col in enriched_df.columns else None
+    cluster_df = cluster_terms(annotation, enriched_df[go_col].unique(), pvals=pvals, threshold=threshold)
+    reps = cluster_df.loc[cluster_df["is_representative"], ["GO", "cluster", "cluster_size"]]
+    reduced_df = enriched_df.merge(reps, left_on=go_col, right_on="GO", how="inner", suffixes=("", "_rep"))
+    if go_col != "GO":
+        reduced_df = reduced_df.drop(columns="GO")
+    return reduced_df
@@ -1,12 +1,16 @@
+import argparse
 import pandas as pd
 from pathlib import Path
-from geopy.distance import geodesic
 import seaborn as sns
 import matplotlib.pyplot as plt
 import statsmodels.api as sm
-import ast
+
+from scripts.go_enrichment.go_index import build_go_annotation, filter_by_go_terms, load_go_dag
+from scripts.go_enrichment.presence_distance_sweep import run_presence_distance_sweep
 
 from scripts.sgsgeneloss.popcolors import pop_colors, island_colors
+from scripts.sgsgeneloss.geo_distance import geodesic_km, origin_distance_table
+from scripts.sgsgeneloss.pav_store import load_pav_df
 
 # Configuration & Globals
 GO_TERMS = [
@@ -70,24 +74,22 @@ GO_TERMS = [
 PAV_FILE = Path("../../data/sgsgeneloss/pav_matrix.csv")
 DMND_FILE = Path("../../data/functional_annotation/noncore_go_merged_diamond_results_uniprot.csv")
 META_FILE = Path("../../metadata/raw_sample_metadata.xlsx")
+OBO_FILE = Path("../../data/functional_annotation/go-basic.obo")
+SWEEP_FILE = Path("../../data/go_enrichment/presence_v_distance_go_sweep.csv")
 ORIGIN = (-0.252, -90.718)  # Santiago
 
 def load_data():
     """Load PAV matrix, diamond results, and metadata."""
-    pav_df = pd.read_csv(PAV_FILE, index_col=0)
+    pav_df = load_pav_df(PAV_FILE)
     dmnd_df = pd.read_csv(DMND_FILE, index_col=0)
     dmnd_df.index = dmnd_df.index.str.replace(r'-mRNA-1$', '', regex=True)
     meta_df = pd.read_excel(META_FILE, index_col=0)
     return pav_df, dmnd_df, meta_df
 
-def filter_dmnd_by_go_terms(dmnd_df, go_terms):
-    """Filter diamond dataframe to only contain genes with specified GO terms."""
-    dmnd_df = dmnd_df.copy()
-    dmnd_df["go_terms"] = dmnd_df["go_terms"].apply(ast.literal_eval)
-
-    # Uncomment below to filter by GO terms if needed:
-    dmnd_df = dmnd_df[dmnd_df["go_terms"].apply(lambda x: any(term in go_terms for term in x))]
-    return dmnd_df
+def filter_dmnd_by_go_terms(dmnd_df, go_terms, dag=None, include_descendants=False):
+    """Filter diamond dataframe to only contain genes with specified GO terms (exact ID match, optionally
+    including descendant terms when a compiled GO DAG is given)."""
+    return filter_by_go_terms(dmnd_df, go_terms, dag=dag, include_descendants=include_descendants, gene_col=None)
 
 def filter_pav_by_dmnd(pav_df, dmnd_df):
     """Filter PAV dataframe to only contain rows present in filtered diamond dataframe."""
@@ -109,16 +111,18 @@ def merge_with_metadata(pav_df_filtered, meta_df):
     )
     return merged_df
 
-def compute_distance(row, origin):
-    """Compute geodesic distance from origin to sample point."""
-    sample_point = (row['Latitude'], row['Longitude'])
-    return geodesic(origin, sample_point).kilometers
-
 def add_distance_column(merged_df, origin):
+    """Add the geodesic distance (km) from origin to each sample point, computed for all rows at once."""
     merged_df = merged_df.copy()
-    merged_df["distance_km"] = merged_df.apply(lambda row: compute_distance(row, origin), axis=1)
+    merged_df["distance_km"] = geodesic_km(merged_df["Latitude"].to_numpy(), merged_df["Longitude"].to_numpy(),
+                                           origin[0], origin[1])
     return merged_df
 
+def add_origin_distance_columns(merged_df, origins):
+    """Add one `distance_km_<name>` column per candidate origin, e.g. every island centroid."""
+    distances = origin_distance_table(merged_df, origins).add_prefix("distance_km_")
+    return pd.concat([merged_df, distances], axis=1)
+
 def plot_gene_count_vs_distance(merged_df):
     plt.figure(figsize=(10, 5))
 
@@ -157,8 +161,21 @@ def run_regression_analysis(merged_df):
     print("\n--- Poisson Regression Results ---")
     print(poisson_model.summary())
 
-def main():
+def run_go_term_sweep(pav_df, dmnd_df, meta_df, origin, term_groups=None, min_genes=5):
+    """Fit the OLS and Poisson models for every GO term (or term group) instead of one hand-edited GO_TERMS list."""
+    annotation = build_go_annotation(dmnd_df, dag=load_go_dag(OBO_FILE), gene_col=None)
+    sweep_df = run_presence_distance_sweep(pav_df, annotation, meta_df, origin, term_groups=term_groups,
+                                           min_genes=min_genes)
+    SWEEP_FILE.parent.mkdir(parents=True, exist_ok=True)
+    sweep_df.to_csv(SWEEP_FILE, index=False)
+    print(sweep_df.head(20).to_string())
+    return sweep_df
+
+def main(sweep=False, min_genes=5):
     pav_df, dmnd_df, meta_df = load_data()
+    if sweep:
+        run_go_term_sweep(pav_df, dmnd_df, meta_df, ORIGIN, min_genes=min_genes)
+        return
     dmnd_df_filtered = filter_dmnd_by_go_terms(dmnd_df, GO_TERMS)
     pav_df_filtered = filter_pav_by_dmnd(pav_df, dmnd_df_filtered)
     merged_df = merge_with_metadata(pav_df_filtered, meta_df)
@@ -167,4 +184,12 @@ def main():
     run_regression_analysis(merged_df)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(
+        description="Presence of GO-annotated non-core genes against distance from the origin island."
+    )
+    parser.add_argument("--sweep", action="store_true",
+                        help="Fit the models for every GO term instead of the GO_TERMS list")
+    parser.add_argument("--min-genes", type=int, default=5,
+                        help="Skip terms backed by fewer PAV genes than this in the sweep (default: 5)")
+    args = parser.parse_args()
+    main(sweep=args.sweep, min_genes=args.min_genes)
@@ -0,0 +1,141 @@
+# GO-term-wide sweep of present-gene counts versus distance from an origin (OLS + Poisson GLM per term).
+from typing import Mapping, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import t as t_dist
+
+from scripts.go_enrichment.batch_enrichment import benjamini_hochberg
+from scripts.go_enrichment.go_index import GoAnnotation, resolve_go_ids, term_names
+from scripts.sgsgeneloss.geo_distance import geodesic_km
+from scripts.sgsgeneloss.parallel import map_in_pool
+
+
+def go_term_presence_counts(pav_df: pd.DataFrame, annotation: GoAnnotation,
+                            term_groups: Optional[Mapping[str, Sequence[str]]] = None,
+                            include_descendants: bool = True) -> Tuple[pd.DataFrame, pd.Series]:
+    """Per-sample present-gene counts for every GO term (or every named group of terms) via one sparse product.
+
+    A gene counts towards a group when it carries any of the group's terms, as filter_dmnd_by_go_terms does.
+    Returns the samples x terms count table and the number of annotated PAV genes behind each column.
+    """
+    genes = pav_df.index.intersection(annotation.gene_ids)
+    rows = annotation.gene_ids.get_indexer(genes)
+    incidence = (annotation.propagated if include_descendants else annotation.direct)[rows].astype(np.float32)
+    presence = sparse.csr_matrix(pav_df.loc[genes].to_numpy(dtype=np.float32))
+
+    if term_groups is None:
+        membership = incidence
+        labels = annotation.term_ids
+    else:
+        # groups x terms indicator, genes hit a group if they hit any of its terms.
+        group_rows, group_cols = [], []
+        for g, go_ids in enumerate(term_groups.values()):
+            cols = resolve_go_ids(annotation, go_ids)
+            group_rows.extend([g] * len(cols))
+            group_cols.extend(cols)
+        groups = sparse.csr_matrix((np.ones(len(group_rows), dtype=np.float32), (group_rows, group_cols)),
+                                   shape=(len(term_groups), incidence.shape[1]))
+        membership = (incidence @ groups.T).astype(bool).astype(np.float32)
+        labels = np.array(list(term_groups.keys()))
+
+    counts = np.asarray((presence.T @ membership).todense())
+    n_genes = np.asarray(membership.sum(axis=0)).ravel().astype(int)
+    counts_df = pd.DataFrame(counts, index=pav_df.columns, columns=labels)
+    return counts_df, pd.Series(n_genes, index=labels, name="n_genes")
+
+
+def vectorized_ols(x: np.ndarray, y: np.ndarray) -> pd.DataFrame:
+    """Closed-form simple linear regression of every column of `y` (samples x responses) on `x`."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    x_c = x - x.mean()
+    y_c = y - y.mean(axis=0)
+    sxx = (x_c ** 2).sum()
+
+    slope = x_c @ y_c / sxx
+    intercept = y.mean(axis=0) - slope * x.mean()
+    rss = ((y_c - np.outer(x_c, slope)) ** 2).sum(axis=0)
+    tss = (y_c ** 2).sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        se = np.sqrt(rss / (n - 2) / sxx)
+        t_stat = slope / se
+        r2 = 1 - rss / tss
+    p = 2 * t_dist.sf(np.abs(t_stat), df=n - 2)
+    constant = tss == 0
+    return pd.DataFrame({
+        "ols_intercept": intercept,
+        "ols_slope": slope,
+        "ols_se": np.where(constant, np.nan, se),
+        "ols_r2": np.where(constant, np.nan, r2),
+        "ols_p": np.where(constant, np.nan, p),
+    })
+
+
+def _fit_poisson_chunk(args: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    """Poisson GLM slope, se and p-value for each column of a response chunk."""
+    import statsmodels.api as sm
+
+    x, y_chunk = args
+    design = sm.add_constant(x)
+    out = np.full((y_chunk.shape[1], 3), np.nan)
+    for i, y in enumerate(y_chunk.T):
+        if np.ptp(y) == 0:
+            continue
+        try:
+            fit = sm.GLM(y, design, family=sm.families.Poisson()).fit()
+            out[i] = fit.params[1], fit.bse[1], fit.pvalues[1]
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+    return out
+
+
+def fit_poisson_glms(x: np.ndarray, y: np.ndarray, n_jobs: Optional[int] = None,
+                     chunk_size: int = 64) -> pd.DataFrame:
+    """Poisson GLM of every column of `y` on `x`, fitted in chunks across a process pool."""
+    chunks = [(x, y[:, i:i + chunk_size]) for i in range(0, y.shape[1], chunk_size)]
+    results = map_in_pool(_fit_poisson_chunk, chunks, n_jobs)
+
+    fits = np.vstack(results) if results else np.empty((0, 3))
+    return pd.DataFrame(fits, columns=["poisson_slope", "poisson_se", "poisson_p"])
+
+
+def run_presence_distance_sweep(pav_df: pd.DataFrame, annotation: GoAnnotation, meta_df: pd.DataFrame,
+                                origin: Tuple[float, float],
+                                term_groups: Optional[Mapping[str, Sequence[str]]] = None,
+                                sample_col: str = "sampleID", min_genes: int = 5, poisson: bool = True,
+                                n_jobs: Optional[int] = None) -> pd.DataFrame:
+    """Regresses present-gene counts on distance from `origin` for every GO term (or term group) at once.
+
+    Terms backed by fewer than `min_genes` PAV genes or constant across samples are skipped. Returns one row per
+    term with OLS and Poisson slopes, p-values and BH FDRs, sorted by OLS FDR.
+    """
+    counts_df, n_genes = go_term_presence_counts(pav_df, annotation, term_groups=term_groups)
+    counts_df.index = counts_df.index.str.replace("_merged_all", "", regex=False)
+
+    # Samples with coordinates, in the same order as the count rows.
+    meta = meta_df.set_index(sample_col) if sample_col in meta_df.columns else meta_df
+    samples = counts_df.index.intersection(meta.dropna(subset=["Latitude", "Longitude"]).index)
+    meta = meta.loc[samples]
+    distance = geodesic_km(meta["Latitude"].to_numpy(), meta["Longitude"].to_numpy(), origin[0], origin[1])
+
+    counts_df = counts_df.loc[samples]
+    keep = (n_genes.to_numpy() >= min_genes) & (np.ptp(counts_df.to_numpy(), axis=0) > 0)
+    counts = counts_df.to_numpy()[:, keep]
+    labels = counts_df.columns[keep]
+
+    sweep_df = vectorized_ols(distance, counts)
+    sweep_df.insert(0, "term", labels)
+    sweep_df.insert(1, "n_genes", n_genes.to_numpy()[keep])
+    if term_groups is None:
+        sweep_df.insert(1, "name", term_names(annotation, labels))
+    sweep_df["ols_fdr_bh"] = benjamini_hochberg(sweep_df["ols_p"].to_numpy())
+
+    if poisson:
+        glm_df = fit_poisson_glms(distance, counts, n_jobs=n_jobs)
+        sweep_df = pd.concat([sweep_df, glm_df], axis=1)
+        sweep_df["poisson_fdr_bh"] = benjamini_hochberg(sweep_df["poisson_p"].to_numpy())
+
+    return sweep_df.sort_values("ols_fdr_bh").reset_index(drop=True)
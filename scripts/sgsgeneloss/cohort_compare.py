@@ -0,0 +1,116 @@
+# Aligns packed PAV matrices of several cohorts (e.g. islands vs mainland) and compares them with bit operations.
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Mapping
+import numpy as np
+import pandas as pd
+
+from scripts.sgsgeneloss.pav_store import POPCOUNT_TABLE, PackedPav, load_pav
+
+
+@dataclass
+class AlignedCohorts:
+    """Packed PAV matrices of several cohorts reindexed onto one shared, integer-coded gene index.
+
+    Per-gene summaries (assayed, core, any absent) are kept as packed gene bitmaps, so set relations between
+    cohorts are single bitwise operations over genes / 8 bytes.
+    """
+    genes: pd.Index
+    cohorts: Dict[str, PackedPav]
+    assayed: Dict[str, np.ndarray]
+
+    def core(self, name: str) -> np.ndarray:
+        """Packed bitmap of genes present in every sample of a cohort (and assayed in it)."""
+        return np.packbits(self.cohorts[name].core_mask()) & self.assayed[name]
+
+    def any_absent(self, name: str) -> np.ndarray:
+        """Packed bitmap of assayed genes absent in at least one sample of a cohort."""
+        return ~self.core(name) & self.assayed[name]
+
+    def count(self, bitmap: np.ndarray) -> int:
+        """Number of genes set in a packed bitmap."""
+        return int(POPCOUNT_TABLE[bitmap].sum())
+
+    def gene_ids(self, bitmap: np.ndarray) -> pd.Index:
+        """Gene IDs set in a packed bitmap."""
+        return self.genes[np.unpackbits(bitmap, count=len(self.genes)).astype(bool)]
+
+    def frequencies(self) -> pd.DataFrame:
+        """Genes x cohorts fraction of samples carrying each gene (NaN where the cohort did not assay it)."""
+        freq = {}
+        for name, packed in self.cohorts.items():
+            values = packed.gene_counts().to_numpy() / max(len(packed.samples), 1)
+            assayed = np.unpackbits(self.assayed[name], count=len(self.genes)).astype(bool)
+            freq[name] = np.where(assayed, values, np.nan)
+        return pd.DataFrame(freq, index=self.genes)
+
+
+def align_cohorts(cohorts: Mapping[str, PackedPav]) -> AlignedCohorts:
+    """Reindexes each cohort's packed rows onto the sorted union of their gene IDs.
+
+    Genes a cohort never assayed get empty rows and are left out of its `assayed` bitmap, so they are not mistaken
+    for losses.
+    """
+    genes = pd.Index(np.unique(np.concatenate([np.asarray(p.genes, dtype=str) for p in cohorts.values()])),
+                     name="ID")
+    aligned, assayed = {}, {}
+    for name, packed in cohorts.items():
+        rows = genes.get_indexer(packed.genes)
+        bits = np.zeros((len(genes), packed.bits.shape[1]), dtype=np.uint8)
+        bits[rows] = packed.bits
+        aligned[name] = PackedPav(bits=bits, genes=genes, samples=packed.samples)
+
+        mask = np.zeros(len(genes), dtype=bool)
+        mask[rows] = True
+        assayed[name] = np.packbits(mask)
+    return AlignedCohorts(genes=genes, cohorts=aligned, assayed=assayed)
+
+
+def set_relations(aligned: AlignedCohorts, reference: str, other: str) -> Dict[str, np.ndarray]:
+    """Packed gene bitmaps of the set relations between two cohorts, restricted to genes both assayed."""
+    both = aligned.assayed[reference] & aligned.assayed[other]
+    ref_core, other_core = aligned.core(reference), aligned.core(other)
+    ref_absent, other_absent = aligned.any_absent(reference), aligned.any_absent(other)
+    return {
+        "core_in_both": ref_core & other_core & both,
+        f"lost_only_in_{reference}": ref_absent & other_core & both,
+        f"lost_only_in_{other}": other_absent & ref_core & both,
+        "absent_in_both": ref_absent & other_absent & both,
+    }
+
+
+def compare_cohorts(aligned: AlignedCohorts, reference: str, other: str) -> pd.DataFrame:
+    """Per-gene comparison of two aligned cohorts: frequencies, their delta and the set relation of each gene.
+
+    Categories are core_in_both, absent_in_both, lost_only_in_<reference> (absent somewhere in the reference but
+    core in the other), lost_only_in_<other>, and not_shared (assayed in only one cohort).
+    """
+    category = np.full(len(aligned.genes), "not_shared", dtype=object)
+    for label, bitmap in set_relations(aligned, reference, other).items():
+        category[np.unpackbits(bitmap, count=len(aligned.genes)).astype(bool)] = label
+
+    freq = aligned.frequencies()[[reference, other]]
+    compare_df = freq.rename(columns={reference: f"freq_{reference}", other: f"freq_{other}"})
+    compare_df["freq_delta"] = freq[other] - freq[reference]
+    compare_df["category"] = category
+    return compare_df
+
+
+def relation_counts(aligned: AlignedCohorts, reference: str, other: str) -> pd.Series:
+    """Gene counts of each set relation between two cohorts, straight from the packed bitmaps."""
+    counts = {"assayed_in_both": aligned.assayed[reference] & aligned.assayed[other],
+              **set_relations(aligned, reference, other)}
+    return pd.Series({label: aligned.count(bitmap) for label, bitmap in counts.items()}, name="n_genes")
+
+
+if __name__ == "__main__":
+    DATA_FOLDER = Path("../../data/sgsgeneloss")
+    run_folder = Path("../../data/sgsgeneloss_/250408_mainland_species/run_2")
+
+    aligned = align_cohorts({
+        "islands": load_pav(DATA_FOLDER / "pav_matrix.csv"),
+        "mainland": load_pav(run_folder / "mainland_pav_matrix.csv"),
+    })
+    print(relation_counts(aligned, "islands", "mainland"))
+    compare_df = compare_cohorts(aligned, "islands", "mainland")
+    compare_df.to_csv(DATA_FOLDER / "islands_v_mainland_pav_comparison.csv")
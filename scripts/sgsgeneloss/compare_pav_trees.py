@@ -1,49 +1,21 @@
-from ete3 import Tree, TreeStyle, faces, AttrFace
 from pathlib import Path
-import matplotlib.pyplot as plt
-from PIL import Image
+import matplotlib
+matplotlib.use("Agg")  # Headless, runs on cluster nodes without a display.
+from tabulate import tabulate
 from scripts.sgsgeneloss.popcolors import pop_colors
+from scripts.sgsgeneloss.tree_builder import read_newick
+from scripts.sgsgeneloss.tree_compare import compare_trees, plot_tanglegram
 
 # Load trees.
 tree_folder = Path("../../data/sgsgeneloss")
-mash_tree = Tree(str(tree_folder / "mashtree_pav.nwk"))
-nj_tree = Tree(str(tree_folder / "nj_pav_tree.nwk"))
+mash_tree = read_newick(tree_folder / "mashtree_pav.nwk")
+nj_tree = read_newick(tree_folder / "nj_pav_tree.nwk")
 
-# Create tanglegram layout.
-def layout(node):
-    # Add node names to leaves for visualisation.
-    if node.is_leaf():
-        name = node.name
-        color = pop_colors.get(name, "black")
-        face = AttrFace("name", fgcolor=color)
-        faces.add_face_to_node(face, node, column=0)
+# Quantitative comparison on the shared samples.
+metrics = compare_trees(mash_tree, nj_tree)
+print(tabulate(metrics.to_frame(), headers="keys"))
+metrics.to_csv(tree_folder / "mash_v_nj_pav_metrics.csv")
 
-# Create treestyle for both trees.
-ts1 = TreeStyle()
-ts1.show_leaf_name = False
-ts1.layout_fn = layout
-ts1.title.add_face(faces.TextFace("Mash Tree", fsize=20), column=0)
-
-ts2 = TreeStyle()
-ts2.show_leaf_name = False
-ts2.layout_fn = layout
-ts2.title.add_face(faces.TextFace("Neighbor Joining Tree", fsize=20), column=0)
-
-# Render both trees side by side as images
-mash_png = "../../data/sgsgeneloss_/mash_tree.png"
-nj_png = "../../data/sgsgeneloss_/nj_tree.png"
-mash_tree.render(mash_png, tree_style=ts1, w=500)
-nj_tree.render(nj_png, tree_style=ts2, w=500)
-
-# Load PNGs
-img1 = Image.open(mash_png)
-img2 = Image.open(nj_png)
-
-# Plot side-by-side with matplotlib
-fig, axs = plt.subplots(1, 2, figsize=(14, 8))
-axs[0].imshow(img1)
-axs[0].axis('off')
-axs[1].imshow(img2)
-axs[1].axis('off')
-plt.tight_layout()
-plt.savefig("../../data/sgsgeneloss_/mash_v_nj_pav.png")
+# Tanglegram with crossing-minimising rotation.
+fig = plot_tanglegram(mash_tree, nj_tree, ("Mash Tree", "Neighbor Joining Tree"), colors=pop_colors)
+fig.savefig(tree_folder / "mash_v_nj_pav.png", dpi=300, bbox_inches="tight")
@@ -0,0 +1,196 @@
+# Chunked float32 (or 16-bit quantised) gene x sample coverage store with per-sample depth normalisation.
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
+import numpy as np
+import pandas as pd
+
+# GLOBALS
+COVERAGE_STORE_VERSION = 1
+COVERAGE_STORE_SUFFIX = ".cov"
+GENES_FILE = "genes.parquet"
+MANIFEST_FILE = "manifest.json"
+CHUNK_DIR = "chunks"
+GENE_CHUNK_SIZE = 4096
+QUANT_MAX = np.iinfo(np.uint16).max
+
+
+def _chunk_file(store_path: Path, chunk: int) -> Path:
+    return store_path / CHUNK_DIR / f"genes-{chunk:05d}.parquet"
+
+
+def write_coverage_store(cov_df: pd.DataFrame, outdir: Union[str, Path], gene_chunk_size: int = GENE_CHUNK_SIZE,
+                         quantise: bool = False) -> Path:
+    """Writes a genes x samples coverage matrix as Parquet files of `gene_chunk_size` genes each.
+
+    Values are stored as float32, or with `quantise` as uint16 with one linear scale per sample (max depth / 65535),
+    two bytes a value at a resolution far below read-depth noise. Columns are samples, so reading a few samples only
+    touches those columns and reading a few genes only touches their chunks.
+    """
+    outdir_path = Path(outdir)
+    (outdir_path / CHUNK_DIR).mkdir(parents=True, exist_ok=True)
+    samples = [str(s) for s in cov_df.columns]
+    values = cov_df.to_numpy(dtype=np.float32)
+
+    scales = None
+    if quantise:
+        scales = np.maximum(np.nanmax(values, axis=0, initial=0), np.finfo(np.float32).tiny) / QUANT_MAX
+        values = np.rint(np.nan_to_num(values) / scales).astype(np.uint16)
+
+    n_chunks = -(-len(cov_df) // gene_chunk_size)
+    for chunk in range(n_chunks):
+        rows = slice(chunk * gene_chunk_size, (chunk + 1) * gene_chunk_size)
+        pd.DataFrame(values[rows], columns=samples).to_parquet(_chunk_file(outdir_path, chunk), index=False)
+
+    pd.DataFrame({"ID": cov_df.index.astype(str)}).to_parquet(outdir_path / GENES_FILE, index=False)
+    manifest = {
+        "format_version": COVERAGE_STORE_VERSION,
+        "n_genes": len(cov_df),
+        "samples": samples,
+        "gene_chunk_size": gene_chunk_size,
+        "n_chunks": n_chunks,
+        "dtype": "uint16" if quantise else "float32",
+        "scales": scales.tolist() if scales is not None else None,
+    }
+    (outdir_path / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+    return outdir_path
+
+
+@dataclass
+class CoverageStore:
+    """Read handle on a coverage store, only the gene IDs and manifest are held in memory."""
+    path: Path
+    genes: pd.Index
+    samples: pd.Index
+    gene_chunk_size: int
+    n_chunks: int
+    scales: Optional[np.ndarray]
+
+    def _decode(self, values: np.ndarray, sample_cols: np.ndarray) -> np.ndarray:
+        if self.scales is None:
+            return values.astype(np.float32, copy=False)
+        return values.astype(np.float32) * self.scales[sample_cols].astype(np.float32)
+
+    def _sample_cols(self, samples: Optional[Sequence[str]]) -> np.ndarray:
+        if samples is None:
+            return np.arange(len(self.samples))
+        cols = self.samples.get_indexer(samples)
+        if (cols < 0).any():
+            raise KeyError(f"{(cols < 0).sum()} samples are not in the coverage store.")
+        return cols
+
+    def iter_chunks(self, samples: Optional[Sequence[str]] = None,
+                    size_factors: Optional[pd.Series] = None) -> Iterator[pd.DataFrame]:
+        """Yields the store one gene chunk at a time (optionally only some samples, divided by size factors)."""
+        cols = self._sample_cols(samples)
+        names = self.samples[cols].tolist()
+        factors = None if size_factors is None else size_factors.reindex(names).to_numpy(dtype=np.float32)
+        for chunk in range(self.n_chunks):
+            values = self._decode(pd.read_parquet(_chunk_file(self.path, chunk), columns=names).to_numpy(), cols)
+            if factors is not None:
+                values = values / factors
+            genes = self.genes[chunk * self.gene_chunk_size:(chunk + 1) * self.gene_chunk_size]
+            yield pd.DataFrame(values, index=genes, columns=names)
+
+    def read(self, genes: Optional[Sequence[str]] = None, samples: Optional[Sequence[str]] = None,
+             size_factors: Optional[pd.Series] = None) -> pd.DataFrame:
+        """float32 genes x samples slice, reading only the chunks holding `genes` and the columns of `samples`."""
+        if genes is None:
+            return pd.concat(list(self.iter_chunks(samples, size_factors)))
+
+        rows = self.genes.get_indexer(genes)
+        if (rows < 0).any():
+            raise KeyError(f"{(rows < 0).sum()} genes are not in the coverage store.")
+        cols = self._sample_cols(samples)
+        names = self.samples[cols].tolist()
+        out = np.empty((len(rows), len(cols)), dtype=np.float32)
+        chunks = rows // self.gene_chunk_size
+        for chunk in np.unique(chunks):
+            hit = np.flatnonzero(chunks == chunk)
+            values = pd.read_parquet(_chunk_file(self.path, chunk), columns=names).to_numpy()
+            out[hit] = self._decode(values[rows[hit] - chunk * self.gene_chunk_size], cols)
+        if size_factors is not None:
+            out /= size_factors.reindex(names).to_numpy(dtype=np.float32)
+        return pd.DataFrame(out, index=self.genes[rows], columns=names)
+
+    def sample_means(self, size_factors: Optional[pd.Series] = None) -> pd.Series:
+        """Mean coverage per sample, accumulated chunk by chunk."""
+        total = np.zeros(len(self.samples))
+        for chunk_df in self.iter_chunks(size_factors=size_factors):
+            total += chunk_df.to_numpy(dtype=np.float64).sum(axis=0)
+        return pd.Series(total / max(len(self.genes), 1), index=self.samples, name="mean_coverage")
+
+
+def open_coverage_store(store_dir: Union[str, Path]) -> CoverageStore:
+    """Opens a coverage store written by write_coverage_store."""
+    store_path = Path(store_dir)
+    manifest = json.loads((store_path / MANIFEST_FILE).read_text())
+    if manifest["format_version"] != COVERAGE_STORE_VERSION:
+        raise ValueError(f"Unsupported coverage store version {manifest['format_version']} in {store_path}")
+    genes = pd.Index(pd.read_parquet(store_path / GENES_FILE)["ID"], name="ID")
+    scales = np.asarray(manifest["scales"], dtype=np.float64) if manifest["scales"] is not None else None
+    return CoverageStore(path=store_path, genes=genes, samples=pd.Index(manifest["samples"]),
+                         gene_chunk_size=manifest["gene_chunk_size"], n_chunks=manifest["n_chunks"], scales=scales)
+
+
+def load_coverage(path: Union[str, Path], quantise: bool = False) -> CoverageStore:
+    """Opens a coverage store, converting a cov_matrix.csv once into cov_matrix.cov/ next to it (like load_pav)."""
+    path = Path(path)
+    if path.is_dir():
+        return open_coverage_store(path)
+
+    store_path = path.with_suffix(COVERAGE_STORE_SUFFIX)
+    manifest = store_path / MANIFEST_FILE
+    if not (manifest.exists() and manifest.stat().st_mtime >= path.stat().st_mtime):
+        write_coverage_store(pd.read_csv(path, index_col=0, engine="pyarrow"), store_path, quantise=quantise)
+    return open_coverage_store(store_path)
+
+
+def reads_mapped_size_factors(bam_stats_df: pd.DataFrame, samples: Sequence[str], sample_col: str = "file",
+                              reads_col: str = "reads_mapped", per: float = 1e6) -> pd.Series:
+    """Per-sample size factors as mapped reads per `per` reads, from the bam stats table.
+
+    Sample IDs are matched after dropping the _merged_all / _sorted suffixes used by the different outputs.
+    """
+    def key(name: str) -> str:
+        return str(name).removesuffix("_merged_all").removesuffix("_merged").removesuffix("_sorted")
+
+    reads = pd.Series(bam_stats_df[reads_col].to_numpy(dtype=float), index=bam_stats_df[sample_col].map(key))
+    factors = reads.reindex([key(s) for s in samples]).to_numpy() / per
+    return pd.Series(factors, index=list(samples), name="size_factor")
+
+
+def median_ratio_size_factors(store: CoverageStore, sample_batch: int = 64) -> pd.Series:
+    """DESeq-style median-of-ratios size factors, in two chunked passes so the matrix is never fully loaded.
+
+    The first pass builds per-gene log geometric means over genes covered in every sample, the second takes the
+    samples' median log ratios to them `sample_batch` columns at a time.
+    """
+    log_geo = np.full(len(store.genes), np.nan)
+    for chunk, chunk_df in enumerate(store.iter_chunks()):
+        values = chunk_df.to_numpy(dtype=np.float64)
+        with np.errstate(divide="ignore"):
+            logs = np.log(values)
+        covered = (values > 0).all(axis=1)
+        start = chunk * store.gene_chunk_size
+        log_geo[start:start + len(values)] = np.where(covered, logs.mean(axis=1), np.nan)
+
+    usable = ~np.isnan(log_geo)
+    if not usable.any():
+        raise ValueError("No gene is covered in every sample, median-ratio size factors are undefined.")
+
+    factors = []
+    for start in range(0, len(store.samples), sample_batch):
+        batch = store.samples[start:start + sample_batch].tolist()
+        columns = np.vstack([c.to_numpy(dtype=np.float64) for c in store.iter_chunks(samples=batch)])
+        factors.append(np.exp(np.median(np.log(columns[usable]) - log_geo[usable, None], axis=0)))
+    return pd.Series(np.concatenate(factors), index=store.samples, name="size_factor")
+
+
+if __name__ == "__main__":
+    DATA_FOLDER = Path("../../data/sgsgeneloss")
+    store = load_coverage(DATA_FOLDER / "cov_matrix.csv")
+    size_factors = median_ratio_size_factors(store)
+    print(pd.DataFrame({"raw_mean": store.sample_means(), "normalised_mean": store.sample_means(size_factors),
+                        "size_factor": size_factors}))
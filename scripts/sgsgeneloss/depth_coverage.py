@@ -0,0 +1,280 @@
+# Gene-level coverage (excov-compatible) from per-base or interval depth files plus the gene-model GFF.
+import gzip
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from scripts.sgsgeneloss.excov_dataset import (CALL_COL, CHROM_COL, COVERED_LENGTH_COL, DEFAULT_MIN_FRACTION,
+                                               DEPTH_COL, END_COL, EXON_LENGTH_COL, ID_COL, START_COL)
+
+# GLOBALS
+GFF_COLS = ["seqid", "source", "type", "start", "end", "score", "strand", "phase", "attributes"]
+# Columns of the written excovs, all read back by excov_dataset and pav_recall.
+EXCOV_COLS = [ID_COL, CHROM_COL, START_COL, END_COL, EXON_LENGTH_COL, COVERED_LENGTH_COL, DEPTH_COL, CALL_COL]
+# Bytes of raw depth rows parsed per batch, the most of a depth file held in memory at once.
+DEPTH_BLOCK_SIZE = 64 << 20
+
+
+def load_gene_models(gff_file: Union[str, Path], gene_type: str = "gene",
+                     transcript_type: str = "mRNA") -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Gene spans and their merged exon intervals from a GFF3, both as 0-based half-open coordinates.
+
+    Exons are linked to genes through their transcript's Parent, and overlapping exons of alternative transcripts
+    are merged so every exonic base of a gene is counted once.
+    """
+    gff_df = pd.read_csv(gff_file, sep="\t", comment="#", header=None, names=GFF_COLS)
+    gff_df["feature_id"] = gff_df["attributes"].str.extract(r"(?:^|;)ID=([^;]+)")[0]
+    gff_df["parent"] = gff_df["attributes"].str.extract(r"(?:^|;)Parent=([^;,]+)")[0]
+
+    genes = gff_df[gff_df["type"] == gene_type]
+    genes_df = pd.DataFrame({
+        ID_COL: genes["feature_id"].to_numpy(),
+        CHROM_COL: genes["seqid"].to_numpy(),
+        "start": genes["start"].to_numpy(dtype=np.int64) - 1,
+        "end": genes["end"].to_numpy(dtype=np.int64),
+    })
+
+    transcript_gene = gff_df.loc[gff_df["type"] == transcript_type].set_index("feature_id")["parent"]
+    exons = gff_df[gff_df["type"] == "exon"]
+    exons_df = pd.DataFrame({
+        ID_COL: exons["parent"].map(transcript_gene).to_numpy(),
+        CHROM_COL: exons["seqid"].to_numpy(),
+        "start": exons["start"].to_numpy(dtype=np.int64) - 1,
+        "end": exons["end"].to_numpy(dtype=np.int64),
+    }).dropna(subset=[ID_COL])
+    return genes_df, merge_intervals(exons_df)
+
+
+def merge_intervals(intervals_df: pd.DataFrame) -> pd.DataFrame:
+    """Merges overlapping [start, end) intervals within each gene, vectorised over the sorted table."""
+    df = intervals_df.sort_values([ID_COL, "start"]).reset_index(drop=True)
+    if df.empty:
+        return df
+    ids = df[ID_COL].to_numpy()
+    starts, ends = df["start"].to_numpy(), df["end"].to_numpy()
+
+    # Running max end within a gene, a new block starts where an interval begins past it.
+    new_gene = np.r_[True, ids[1:] != ids[:-1]]
+    gene_block = np.cumsum(new_gene)
+    running_end = pd.Series(ends).groupby(gene_block).cummax().to_numpy()
+    new_block = new_gene | np.r_[True, starts[1:] > running_end[:-1]]
+    block = np.cumsum(new_block) - 1
+
+    merged = df.groupby(block).agg({ID_COL: "first", CHROM_COL: "first", "start": "min", "end": "max"})
+    return merged.reset_index(drop=True)
+
+
+def _join_runs(chrom: np.ndarray, start: np.ndarray, end: np.ndarray, depth: np.ndarray) -> pd.DataFrame:
+    """Joins adjacent positions of equal depth so per-base rows shrink to runs."""
+    new_run = np.r_[True, (chrom[1:] != chrom[:-1]) | (start[1:] != end[:-1]) | (depth[1:] != depth[:-1])]
+    first = np.flatnonzero(new_run)
+    run_ends = np.r_[first[1:], len(new_run)] - 1
+    return pd.DataFrame({"chrom": chrom[first], "start": start[first], "end": end[run_ends], "depth": depth[first]})
+
+
+def iter_depth_segments(depth_file: Union[str, Path], block_size: int = DEPTH_BLOCK_SIZE) -> Iterator[pd.DataFrame]:
+    """Streams a depth file as run-length encoded [start, end) segments of constant depth, one batch at a time.
+
+    Three columns are read as `samtools depth` (chrom, 1-based pos, depth, extra sample columns are summed), four as
+    a bedGraph or mosdepth per-base/regions bed (chrom, start, end, depth), decided on the first batch. Only one
+    `block_size` batch of raw rows is held at a time, runs split at a batch boundary stay two segments. Missing
+    positions have zero depth.
+    """
+    # `samtools depth -H` writes a single "#CHROM" header line.
+    opener = gzip.open if str(depth_file).endswith(".gz") else open
+    with opener(depth_file, "rt") as f:
+        first_line = f.readline()
+        has_header = first_line.startswith("#")
+        n_cols = len((f.readline() if has_header else first_line).rstrip("\n").split("\t"))
+    names = [f"c{i}" for i in range(n_cols)]
+    types = {"c0": pa.string(), "c1": pa.int64(), **{name: pa.float64() for name in names[2:]}}
+    reader = pa_csv.open_csv(
+        pa.input_stream(str(depth_file), compression="detect"),
+        read_options=pa_csv.ReadOptions(column_names=names, skip_rows=int(has_header), block_size=block_size),
+        parse_options=pa_csv.ParseOptions(delimiter="\t"),
+        convert_options=pa_csv.ConvertOptions(column_types=types))
+
+    intervals = None
+    for batch in reader:
+        if not batch.num_rows:
+            continue
+        df = batch.to_pandas()
+        if intervals is None:
+            intervals = n_cols == 4 and (df["c2"] % 1 == 0).all() and (df["c2"] > df["c1"]).all()
+        chrom, first = df["c0"].to_numpy(), df["c1"].to_numpy(np.int64)
+        if intervals:
+            start, end, depth = first, df["c2"].to_numpy(np.int64), df["c3"].to_numpy(dtype=float)
+        else:
+            start, end = first - 1, first
+            depth = df[names[2:]].sum(axis=1).to_numpy(dtype=float)
+        yield _join_runs(chrom, start, end, depth)
+
+
+def read_depth_segments(depth_file: Union[str, Path], block_size: int = DEPTH_BLOCK_SIZE) -> pd.DataFrame:
+    """All run-length encoded segments of a depth file in one table, see iter_depth_segments."""
+    batches = list(iter_depth_segments(depth_file, block_size))
+    if not batches:
+        return pd.DataFrame({"chrom": [], "start": [], "end": [], "depth": []})
+    segments = pd.concat(batches, ignore_index=True)
+    return _join_runs(segments["chrom"].to_numpy(), segments["start"].to_numpy(), segments["end"].to_numpy(),
+                      segments["depth"].to_numpy())
+
+
+def iter_chromosome_segments(depth_file: Union[str, Path], block_size: int = DEPTH_BLOCK_SIZE
+                             ) -> Iterator[Tuple[str, np.ndarray, np.ndarray, np.ndarray]]:
+    """Yields (chrom, segment starts, ends, depths) for each chromosome as soon as the stream moves past it.
+
+    Depth files are written grouped by chromosome (samtools depth, mosdepth), so at most one chromosome's runs plus
+    one batch are in memory. A chromosome that comes back after another one raises a ValueError.
+    """
+    done, current, parts = set(), None, []
+
+    def flush():
+        segments = pd.concat(parts, ignore_index=True)
+        return (current, segments["start"].to_numpy(), segments["end"].to_numpy(), segments["depth"].to_numpy())
+
+    for segments in iter_depth_segments(depth_file, block_size):
+        for chrom, chrom_segments in segments.groupby("chrom", sort=False):
+            if chrom == current:
+                parts.append(chrom_segments)
+                continue
+            if chrom in done:
+                raise ValueError(f"{depth_file} is not grouped by chromosome, {chrom} appears twice.")
+            if current is not None:
+                yield flush()
+                done.add(current)
+            current, parts = chrom, [chrom_segments]
+    if current is not None:
+        yield flush()
+
+
+def _interval_sums(seg_start: np.ndarray, seg_end: np.ndarray, seg_value: np.ndarray, starts: np.ndarray,
+                   ends: np.ndarray) -> np.ndarray:
+    """Integral of a piecewise-constant track over each [start, end), from a cumulative sum at segment starts."""
+    if not len(seg_start):
+        return np.zeros(len(starts))
+    lengths = seg_end - seg_start
+    cum = np.r_[0.0, np.cumsum(seg_value * lengths)]
+
+    def area(x: np.ndarray) -> np.ndarray:
+        k = np.searchsorted(seg_start, x, side="right") - 1
+        k_safe = np.maximum(k, 0)
+        within = np.clip(x - seg_start[k_safe], 0, lengths[k_safe])
+        return np.where(k < 0, 0.0, cum[k_safe] + seg_value[k_safe] * within)
+
+    return area(ends) - area(starts)
+
+
+def _chromosome_coverage(args: Tuple[np.ndarray, np.ndarray, np.ndarray, pd.DataFrame, pd.DataFrame, float]
+                         ) -> pd.DataFrame:
+    """Per-gene exon and gene-span coverage metrics for one chromosome (runs in pool workers)."""
+    seg_start, seg_end, depth, genes_df, exons_df, min_depth = args
+    covered = (depth >= min_depth).astype(float)
+
+    exon_len = (exons_df["end"] - exons_df["start"]).to_numpy()
+    exon_covered = _interval_sums(seg_start, seg_end, covered, exons_df["start"].to_numpy(),
+                                  exons_df["end"].to_numpy())
+    per_gene = pd.DataFrame({ID_COL: exons_df[ID_COL].to_numpy(), EXON_LENGTH_COL: exon_len,
+                             COVERED_LENGTH_COL: exon_covered}).groupby(ID_COL).sum()
+
+    gene_depth = _interval_sums(seg_start, seg_end, depth, genes_df["start"].to_numpy(), genes_df["end"].to_numpy())
+    out = genes_df.assign(gene_depth_sum=gene_depth).set_index(ID_COL).join(per_gene)
+    return out
+
+
+def compute_gene_coverage(depth_file: Union[str, Path], genes_df: pd.DataFrame, exons_df: pd.DataFrame,
+                          min_depth: float = 1, min_fraction: float = DEFAULT_MIN_FRACTION,
+                          n_jobs: Optional[int] = None, block_size: int = DEPTH_BLOCK_SIZE) -> pd.DataFrame:
+    """Excov per-gene table (exonic and covered exonic bases, mean gene depth, is_lost) for one sample.
+
+    A base counts as covered at depth >= `min_depth`, and a gene is LOST when under `min_fraction` of its exonic
+    bases are covered. The depth file is streamed in `block_size` batches and each chromosome is handed to a
+    process pool as soon as it has been read. Genes without exons (or on chromosomes with no reads) get zero
+    coverage.
+    """
+    chrom_genes = dict(tuple(genes_df.groupby(CHROM_COL, sort=False)))
+    chrom_exons = dict(tuple(exons_df.groupby(CHROM_COL, sort=False)))
+    empty_exons = exons_df.iloc[:0]
+
+    def job(chrom, seg_start, seg_end, depth):
+        return (seg_start, seg_end, depth, chrom_genes.pop(chrom), chrom_exons.get(chrom, empty_exons), min_depth)
+
+    def jobs():
+        # Chromosomes go to the workers as the depth file is streamed, those without reads come last.
+        for chrom, seg_start, seg_end, depth in iter_chromosome_segments(depth_file, block_size):
+            if chrom in chrom_genes:
+                yield job(chrom, seg_start, seg_end, depth)
+        empty = np.empty(0, dtype=np.int64)
+        for chrom in list(chrom_genes):
+            yield job(chrom, empty, empty, np.empty(0))
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs == 1 or len(chrom_genes) <= 1:
+        parts = [_chromosome_coverage(args) for args in jobs()]
+    else:
+        n_workers = min(n_jobs, len(chrom_genes))
+        futures, parts = [], []
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for args in jobs():
+                futures.append(pool.submit(_chromosome_coverage, args))
+                # At most two chromosomes per worker wait in the queue, so reading never runs far ahead.
+                if len(futures) - len(parts) > 2 * n_workers:
+                    parts.append(futures[len(parts)].result())
+            parts += [future.result() for future in futures[len(parts):]]
+
+    cov_df = pd.concat(parts).fillna({EXON_LENGTH_COL: 0, COVERED_LENGTH_COL: 0})
+    exon_length = cov_df[EXON_LENGTH_COL].to_numpy(dtype=np.int64)
+    covered_length = np.rint(cov_df[COVERED_LENGTH_COL].to_numpy()).astype(np.int64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(exon_length > 0, covered_length / exon_length, 0.0)
+    excov_df = pd.DataFrame({
+        ID_COL: cov_df.index,
+        CHROM_COL: cov_df[CHROM_COL].to_numpy(),
+        # Excov positions are 1-based inclusive like the GFF.
+        START_COL: cov_df["start"].to_numpy() + 1,
+        END_COL: cov_df["end"].to_numpy(),
+        EXON_LENGTH_COL: exon_length,
+        COVERED_LENGTH_COL: covered_length,
+        DEPTH_COL: cov_df["gene_depth_sum"].to_numpy() / (cov_df["end"] - cov_df["start"]).to_numpy(),
+        CALL_COL: np.where(fraction >= min_fraction, "PRESENT", "LOST"),
+    })
+    return excov_df[EXCOV_COLS]
+
+
+def write_sample_excovs(excov_df: pd.DataFrame, sample_dir: Union[str, Path]) -> List[Path]:
+    """Writes one .excov per chromosome into a sample folder, the layout merge_excovs and ingest_sample_folders
+    expect from SGSGeneLoss."""
+    sample_path = Path(sample_dir)
+    sample_path.mkdir(parents=True, exist_ok=True)
+    out_files = []
+    for chrom, chrom_df in excov_df.groupby(CHROM_COL, sort=False):
+        out_file = sample_path / f"{chrom}.excov"
+        chrom_df.to_csv(out_file, index=False)
+        out_files.append(out_file)
+    return out_files
+
+
+def depth_files_to_excovs(depth_files: Dict[str, Path], gff_file: Union[str, Path], outdir: Union[str, Path],
+                          min_depth: float = 1, min_fraction: float = DEFAULT_MIN_FRACTION,
+                          n_jobs: Optional[int] = None) -> None:
+    """Runs compute_gene_coverage for every sample -> depth file, parsing the GFF only once."""
+    genes_df, exons_df = load_gene_models(gff_file)
+    for sample, depth_file in depth_files.items():
+        excov_df = compute_gene_coverage(depth_file, genes_df, exons_df, min_depth=min_depth,
+                                         min_fraction=min_fraction, n_jobs=n_jobs)
+        write_sample_excovs(excov_df, Path(outdir) / sample)
+        print(f"{sample}: {(excov_df[CALL_COL] == 'LOST').sum()} of {len(excov_df)} genes lost.")
+
+
+if __name__ == "__main__":
+    DATA_FOLDER = Path("../../data/sgsgeneloss")
+    depth_folder = DATA_FOLDER / "depth"
+    depth_files = {p.name.split(".")[0]: p for p in sorted(depth_folder.glob("*.per-base.bed.gz"))}
+
+    # Same output layout as SGSGeneLoss, so the folder can go straight into ingest_sample_folders.
+    depth_files_to_excovs(depth_files, DATA_FOLDER / "reference.gff3", DATA_FOLDER / "depth_excovs", min_depth=2)
@@ -0,0 +1,375 @@
+# Single-pass ingestion of merged SGSGeneLoss .excov files into PAV, coverage and gene position tables.
+import hashlib
+import json
+from datetime import datetime
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+
+from scripts.sgsgeneloss.pav_store import append_samples, open_packed_pav, write_packed_pav
+from scripts.sgsgeneloss.parallel import map_in_pool
+
+# Excov column names as written by SGSGeneLoss (the "end_postion" typo is theirs).
+ID_COL = "ID"
+CHROM_COL = "chromosome"
+START_COL = "start_position"
+END_COL = "end_postion"
+CALL_COL = "is_lost"
+DEPTH_COL = "ave_cove_depth_gene"
+# Exonic bases per gene and how many of them are covered, the covered fraction is their ratio.
+EXON_LENGTH_COL = "exon_length"
+COVERED_LENGTH_COL = "covered_exon_length"
+# Covered exon fraction for a gene to be called present by depth_coverage and summarised by pav_recall. Not a
+# recorded SGSGeneLoss setting: docs.md shows minCov being changed to 0.8 and then 0.5 for the mainland reruns.
+DEFAULT_MIN_FRACTION = 0.05
+POSITION_COLS = [CHROM_COL, START_COL, END_COL]
+INGEST_COLS = [ID_COL, *POSITION_COLS, CALL_COL, DEPTH_COL]
+CALL_MAP = {"PRESENT": 1, "LOST": 0}
+DATASET_VERSION = 3
+# Merged excovs may be written compressed (see merge_excovs), longest suffix first.
+EXCOV_SUFFIXES = (".excov.zst", ".excov.gz", ".excov")
+COVERAGE_DIR = "coverage"
+
+
+@dataclass
+class ExcovDataset:
+    """Gene x sample PAV (int8) and coverage (float) matrices plus per-gene positions, all on the same gene index.
+
+    `provenance` maps each sample to its source file, the file's sha1 and the SGSGeneLoss parameters used.
+    """
+    pav: pd.DataFrame
+    coverage: pd.DataFrame
+    positions: pd.DataFrame
+    provenance: Dict[str, Dict] = field(default_factory=dict)
+
+    @property
+    def samples(self) -> List[str]:
+        return self.pav.columns.tolist()
+
+
+def _glob_excovs(folder: Path) -> List[Path]:
+    """Sorted .excov files (plain, gzip or zstd) directly inside a folder."""
+    return sorted(f for suffix in EXCOV_SUFFIXES for f in folder.glob(f"*{suffix}"))
+
+
+def find_excov_files(infolder: Union[str, Path]) -> List[Path]:
+    """Sorted merged .excov files in a folder, raising if there are none."""
+    infolder_path = Path(infolder)
+    if not infolder_path.is_dir():
+        raise FileNotFoundError(f"Input folder does not exist: {infolder}")
+
+    excov_files = _glob_excovs(infolder_path)
+    if not excov_files:
+        raise FileNotFoundError(f"No .excov files found in {infolder}")
+    return excov_files
+
+
+def find_sample_folders(master_folder: Union[str, Path]) -> List[Path]:
+    """Sorted per-sample folders of per-chromosome SGSGeneLoss .excov files, raising if there are none."""
+    master_path = Path(master_folder)
+    if not master_path.is_dir():
+        raise FileNotFoundError(f"Input folder does not exist: {master_folder}")
+
+    sample_folders = sorted(p for p in master_path.iterdir() if p.is_dir() and _glob_excovs(p))
+    if not sample_folders:
+        raise FileNotFoundError(f"No sample folders with .excov files found in {master_folder}")
+    return sample_folders
+
+
+def excov_sample_name(source: Path) -> str:
+    """Sample name of a merged excov file, or of a per-sample folder named as its merged *_all.excov would be."""
+    if source.is_dir():
+        return f"{source.name}_all"
+    for suffix in EXCOV_SUFFIXES:
+        if source.name.endswith(suffix):
+            return source.name[:-len(suffix)]
+    return source.stem
+
+
+def _read_excov_columns(source: Path, columns: Sequence[str]) -> pd.DataFrame:
+    """Selected columns of a merged .excov file, or of every per-chromosome file of a sample folder stacked in
+    memory, so no merged intermediate has to be written."""
+    if source.is_dir():
+        return pd.concat([pd.read_csv(f, engine="pyarrow", usecols=columns) for f in _glob_excovs(source)],
+                         ignore_index=True)
+    return pd.read_csv(source, engine="pyarrow", usecols=columns)
+
+
+def read_excov(source: Path) -> pd.DataFrame:
+    """Reads only the columns needed for PAV, coverage and positions from one .excov file or sample folder."""
+    df = _read_excov_columns(source, INGEST_COLS)
+    return df.drop_duplicates(subset=ID_COL).set_index(ID_COL)
+
+
+def build_positions(df: pd.DataFrame) -> pd.DataFrame:
+    """Gene position table (chromosome, start, end, length) from excov rows indexed by gene ID."""
+    positions = df[POSITION_COLS].copy()
+    positions["length"] = positions[END_COL] - positions[START_COL]
+    return positions
+
+
+def gene_layout_key(gene_ids: np.ndarray) -> str:
+    """sha1 of a sample's ordered gene IDs, samples run against the same GFF share one key."""
+    return hashlib.sha1(np.ascontiguousarray(gene_ids).tobytes()).hexdigest()
+
+
+def file_sha1(source: Path, chunk_size: int = 1 << 20) -> str:
+    """sha1 of a file's contents read in chunks, or of a sample folder's .excov files in sorted order."""
+    digest = hashlib.sha1()
+    for file_path in (_glob_excovs(source) if source.is_dir() else [source]):
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parse_excov_file(file_path: Path) -> Tuple[np.ndarray, str, np.ndarray, np.ndarray, pd.DataFrame, str]:
+    """Gene IDs, their layout key, 0/1 calls, depths, positions and file sha1 of one .excov file (runs in pool
+    workers)."""
+    df = read_excov(file_path)
+    ids = df.index.to_numpy(dtype=str)
+    calls = df[CALL_COL].map(CALL_MAP).fillna(0).to_numpy(dtype=np.int8)
+    return (ids, gene_layout_key(ids), calls, df[DEPTH_COL].to_numpy(dtype=float), build_positions(df),
+            file_sha1(file_path))
+
+
+def _parse_excov_columns(args: Tuple[Path, Sequence[str]]) -> Tuple[np.ndarray, str, pd.DataFrame]:
+    """Gene IDs, their layout key and the selected value columns of an .excov file (runs in pool workers)."""
+    file_path, value_cols = args
+    df = _read_excov_columns(file_path, [ID_COL, *value_cols]).drop_duplicates(subset=ID_COL)
+    ids = df[ID_COL].to_numpy(dtype=str)
+    return ids, gene_layout_key(ids), df[list(value_cols)]
+
+
+def _distinct_layouts(gene_id_arrays: Sequence[np.ndarray], keys: Optional[Sequence[str]]) -> Dict[str, np.ndarray]:
+    """Layout key -> gene IDs for each distinct gene ordering."""
+    keys = keys if keys is not None else [gene_layout_key(ids) for ids in gene_id_arrays]
+    layouts = {}
+    for key, ids in zip(keys, gene_id_arrays):
+        layouts.setdefault(key, ids)
+    return layouts
+
+
+def union_gene_index(gene_id_arrays: Sequence[np.ndarray], keys: Optional[Sequence[str]] = None) -> pd.Index:
+    """Sorted union of the gene IDs seen across samples, built once from the distinct gene layouts."""
+    layouts = _distinct_layouts(gene_id_arrays, keys)
+    return pd.Index(np.unique(np.concatenate(list(layouts.values()))), name=ID_COL)
+
+
+def assemble_matrix(gene_index: pd.Index, gene_id_arrays: Sequence[np.ndarray], value_arrays: Sequence[np.ndarray],
+                    dtype, fill_value=0, keys: Optional[Sequence[str]] = None) -> np.ndarray:
+    """Scatters each sample's values into a preallocated genes x samples matrix via the shared gene index.
+
+    Row positions are looked up once per distinct gene layout (see gene_layout_key) and reused across samples.
+    """
+    keys = keys if keys is not None else [gene_layout_key(ids) for ids in gene_id_arrays]
+    rows = {key: gene_index.get_indexer(ids) for key, ids in _distinct_layouts(gene_id_arrays, keys).items()}
+
+    matrix = np.full((len(gene_index), len(value_arrays)), fill_value, dtype=dtype)
+    for j, (key, values) in enumerate(zip(keys, value_arrays)):
+        matrix[rows[key], j] = values
+    return matrix
+
+
+def assemble_sample_matrices(excov_files: Sequence[Path], value_cols: Sequence[str],
+                             value_maps: Optional[Dict[str, Dict]] = None, dtype=float,
+                             n_jobs: Optional[int] = None) -> Dict[str, pd.DataFrame]:
+    """Genes x samples matrices of several excov columns from a single read of each file, parsed in a process pool
+    and assembled on one shared gene index.
+
+    Genes missing from a sample are filled with 0.
+    """
+    value_maps = value_maps or {}
+    parsed = map_in_pool(_parse_excov_columns, [(f, tuple(value_cols)) for f in excov_files], n_jobs)
+    ids, keys = [p[0] for p in parsed], [p[1] for p in parsed]
+    gene_index = union_gene_index(ids, keys)
+    samples = [excov_sample_name(f) for f in excov_files]
+
+    matrices = {}
+    for col in value_cols:
+        values = [(p[2][col].map(value_maps[col]) if col in value_maps else p[2][col]).fillna(0).to_numpy(dtype=dtype)
+                  for p in parsed]
+        matrix = assemble_matrix(gene_index, ids, values, dtype=dtype, keys=keys)
+        matrices[col] = pd.DataFrame(matrix, index=gene_index, columns=samples)
+    return matrices
+
+
+def assemble_sample_matrix(excov_files: Sequence[Path], value_col: str, value_map: Optional[Dict] = None,
+                           dtype=float, n_jobs: Optional[int] = None) -> pd.DataFrame:
+    """Genes x samples matrix of one excov column, parsed in a process pool and assembled in one allocation.
+
+    Genes missing from a sample are filled with 0.
+    """
+    value_maps = {value_col: value_map} if value_map else None
+    return assemble_sample_matrices(excov_files, [value_col], value_maps=value_maps, dtype=dtype,
+                                    n_jobs=n_jobs)[value_col]
+
+
+def _first_positions(gene_index: pd.Index, position_frames: Sequence[pd.DataFrame]) -> pd.DataFrame:
+    """Position table on `gene_index`, each gene taken from the first frame that has it."""
+    positions_df = position_frames[0].reindex(gene_index)
+    for positions in position_frames[1:]:
+        missing = positions_df[START_COL].isna().to_numpy()
+        if not missing.any():
+            break
+        positions_df.loc[missing] = positions.reindex(gene_index[missing]).to_numpy()
+    return positions_df.astype({START_COL: "Int64", END_COL: "Int64", "length": "Int64"})
+
+
+def _provenance(excov_files: Sequence[Path], hashes: Sequence[str], params: Optional[Dict]) -> Dict[str, Dict]:
+    """Per-sample provenance records for freshly ingested excov files."""
+    added = datetime.now().isoformat(timespec="seconds")
+    return {excov_sample_name(f): {"source": str(f), "sha1": h, "params": params or {}, "added": added}
+            for f, h in zip(excov_files, hashes)}
+
+
+def _ingest_files(excov_files: Sequence[Path], params: Optional[Dict], n_jobs: Optional[int]) -> ExcovDataset:
+    """Parses merged excov files (or sample folders) in a process pool and assembles them onto their union gene
+    index."""
+    parsed = map_in_pool(_parse_excov_file, excov_files, n_jobs)
+    ids, keys = [p[0] for p in parsed], [p[1] for p in parsed]
+    gene_index = union_gene_index(ids, keys)
+
+    pav = assemble_matrix(gene_index, ids, [p[2] for p in parsed], dtype=np.int8, keys=keys)
+    coverage = assemble_matrix(gene_index, ids, [p[3] for p in parsed], dtype=float, keys=keys)
+
+    samples = [excov_sample_name(f) for f in excov_files]
+    return ExcovDataset(
+        pav=pd.DataFrame(pav, index=gene_index, columns=samples),
+        coverage=pd.DataFrame(coverage, index=gene_index, columns=samples),
+        positions=_first_positions(gene_index, [p[4] for p in parsed]),
+        provenance=_provenance(excov_files, [p[5] for p in parsed], params),
+    )
+
+
+def ingest_excovs(infolder: Union[str, Path], params: Optional[Dict] = None,
+                  n_jobs: Optional[int] = None) -> ExcovDataset:
+    """Reads every merged .excov file in `infolder` once and fills the PAV, coverage and position tables together.
+
+    Files are parsed in a process pool, then every sample is scattered into preallocated matrices on the union
+    gene index. Genes missing from a sample are treated as lost with zero coverage, as create_pav_matrix does.
+    `params` (the SGSGeneLoss settings of the run) is recorded with each sample's provenance.
+    """
+    return _ingest_files(find_excov_files(infolder), params, n_jobs)
+
+
+def ingest_sample_folders(master_folder: Union[str, Path], params: Optional[Dict] = None,
+                          n_jobs: Optional[int] = None) -> ExcovDataset:
+    """Like ingest_excovs, but streams each sample folder's per-chromosome .excov files straight into the matrices
+    instead of reading merged *_all.excov intermediates. Sample names match the merged-file route."""
+    return _ingest_files(find_sample_folders(master_folder), params, n_jobs)
+
+
+def _write_manifest(dataset_path: Path, n_genes: int, samples: List[str], provenance: Dict[str, Dict],
+                    n_coverage_parts: int) -> None:
+    manifest = {
+        "format_version": DATASET_VERSION,
+        "n_genes": n_genes,
+        "samples": samples,
+        "coverage_parts": n_coverage_parts,
+        "provenance": provenance,
+    }
+    (dataset_path / "manifest.json").write_text(json.dumps(manifest, indent=2))
+
+
+def _coverage_part(dataset_path: Path, part: int) -> Path:
+    return dataset_path / COVERAGE_DIR / f"part-{part:05d}.parquet"
+
+
+def write_excov_dataset(dataset: ExcovDataset, outdir: Union[str, Path], sample_capacity: Optional[int] = None) -> Path:
+    """Writes positions as Parquet, PAV as a packed store (see pav_store) and coverage as the first of a set of
+    Parquet parts, plus a manifest with per-sample provenance.
+
+    `sample_capacity` reserves room in the PAV store for samples added later with append_excovs.
+    """
+    outdir_path = Path(outdir)
+    outdir_path.mkdir(parents=True, exist_ok=True)
+    (outdir_path / COVERAGE_DIR).mkdir(exist_ok=True)
+
+    dataset.positions.to_parquet(outdir_path / "genes.parquet")
+    write_packed_pav(dataset.pav, outdir_path / "pav", sample_capacity=sample_capacity)
+    dataset.coverage.to_parquet(_coverage_part(outdir_path, 0))
+
+    _write_manifest(outdir_path, len(dataset.pav), dataset.samples, dataset.provenance, 1)
+    print(f"Wrote excov dataset ({len(dataset.pav)} genes x {len(dataset.samples)} samples) to {outdir_path}")
+    return outdir_path
+
+
+def append_excovs(dataset_dir: Union[str, Path], infolder: Union[str, Path], params: Optional[Dict] = None,
+                  sample_folders: bool = False, n_jobs: Optional[int] = None) -> List[str]:
+    """Adds the .excov files in `infolder` whose samples are not yet in the dataset, without touching existing ones.
+    With `sample_folders`, `infolder` holds per-sample folders of per-chromosome excovs (see ingest_sample_folders).
+
+    New samples go into the spare capacity of the packed PAV store and into a new coverage part, genes first seen
+    in them are appended to the position table, and each gets a provenance record. Returns the added samples.
+    """
+    dataset_path = Path(dataset_dir)
+    manifest = json.loads((dataset_path / "manifest.json").read_text())
+    if manifest["format_version"] != DATASET_VERSION:
+        raise ValueError(f"Excov dataset {dataset_path} has format version {manifest['format_version']}, "
+                         f"expected {DATASET_VERSION}. Re-run ingest_excovs.")
+
+    known = set(manifest["samples"])
+    sources = find_sample_folders(infolder) if sample_folders else find_excov_files(infolder)
+    new_files = [f for f in sources if excov_sample_name(f) not in known]
+    if not new_files:
+        print(f"No new samples to add to {dataset_path}")
+        return []
+
+    new = _ingest_files(new_files, params, n_jobs)
+    pav_store = append_samples(dataset_path / "pav", new.pav)
+
+    # Genes first seen in the new samples are appended in the same order as the PAV store rows.
+    positions = pd.read_parquet(dataset_path / "genes.parquet")
+    new_genes = pav_store.genes[len(positions):]
+    if len(new_genes):
+        positions = pd.concat([positions, new.positions.loc[new_genes]])
+        positions.to_parquet(dataset_path / "genes.parquet")
+
+    part = manifest.get("coverage_parts", 1)
+    new.coverage.to_parquet(_coverage_part(dataset_path, part))
+
+    _write_manifest(dataset_path, len(pav_store), pav_store.samples.tolist(),
+                    {**manifest["provenance"], **new.provenance}, part + 1)
+    print(f"Added {len(new_files)} samples and {len(new_genes)} new genes to {dataset_path}")
+    return new.samples
+
+
+def load_gene_positions(dataset_dir: Union[str, Path], fallback_excov: Optional[Path] = None) -> pd.DataFrame:
+    """Gene position table of a dataset without touching the PAV or coverage files.
+
+    If the dataset has not been written yet the table is built from `fallback_excov` (a merged .excov file or
+    sample folder) instead.
+    """
+    genes_file = Path(dataset_dir) / "genes.parquet"
+    if genes_file.exists():
+        return pd.read_parquet(genes_file)
+    if fallback_excov is None or not Path(fallback_excov).exists():
+        raise FileNotFoundError(f"No excov dataset at {dataset_dir} and no fallback excov at {fallback_excov}.")
+    df = _read_excov_columns(Path(fallback_excov), [ID_COL, *POSITION_COLS])
+    return build_positions(df.drop_duplicates(ID_COL).set_index(ID_COL))
+
+
+def load_excov_dataset(dataset_dir: Union[str, Path]) -> ExcovDataset:
+    """Reads a dataset written by write_excov_dataset, checking the tables still agree with the manifest."""
+    dataset_path = Path(dataset_dir)
+    manifest = json.loads((dataset_path / "manifest.json").read_text())
+    if manifest["format_version"] != DATASET_VERSION:
+        raise ValueError(f"Excov dataset {dataset_path} has format version {manifest['format_version']}, "
+                         f"expected {DATASET_VERSION}. Re-run ingest_excovs.")
+
+    positions = pd.read_parquet(dataset_path / "genes.parquet")
+    pav = open_packed_pav(dataset_path / "pav").to_frame()
+
+    # Each coverage part only holds the genes known when it was written, later genes count as zero coverage.
+    parts = [pd.read_parquet(_coverage_part(dataset_path, i)) for i in range(manifest["coverage_parts"])]
+    coverage = pd.concat([p.reindex(pav.index, fill_value=0.0) for p in parts], axis=1)
+
+    if pav.columns.tolist() != manifest["samples"] or len(pav) != manifest["n_genes"]:
+        raise ValueError(f"PAV table in {dataset_path} does not match its manifest.")
+    if coverage.columns.tolist() != manifest["samples"] or not pav.index.equals(positions.index):
+        raise ValueError(f"Coverage or gene positions in {dataset_path} do not match the PAV table.")
+
+    return ExcovDataset(pav=pav, coverage=coverage, positions=positions, provenance=manifest["provenance"])
@@ -0,0 +1,105 @@
+# Vectorised ellipsoidal (WGS84) distances between sample locations, with a disk cached sample x sample matrix.
+import hashlib
+import warnings
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+# GLOBALS
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+DISTANCE_CACHE_DIR = Path("../../data/geo_distance_cache")
+
+
+def geodesic_km(lat1, lon1, lat2, lon2, max_iter: int = 200, tol: float = 1e-12) -> np.ndarray:
+    """Vincenty inverse distance on the WGS84 ellipsoid in km, broadcasting over NumPy arrays.
+
+    Agrees with geopy's geodesic to well under a metre for anything but near-antipodal points, where the
+    iteration may not converge (a warning is raised and the last estimate is returned).
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.radians(np.asarray(v, dtype=float))
+                                                  for v in (lat1, lon1, lat2, lon2)))
+    f = WGS84_F
+    u1 = np.arctan((1 - f) * np.tan(lat1))
+    u2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1, sin_u2, cos_u2 = np.sin(u1), np.cos(u1), np.sin(u2), np.cos(u2)
+    big_l = lon2 - lon1
+
+    lam = big_l.copy()
+    active = np.ones(lam.shape, dtype=bool)
+    for _ in range(max_iter):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            cos_2sm = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+        c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        lam_new = big_l + (1 - c) * f * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sm + c * cos_sigma * (-1 + 2 * cos_2sm ** 2)))
+
+        # Only keep iterating the pairs that have not converged.
+        active = np.abs(lam_new - lam) > tol
+        lam = np.where(active, lam_new, lam)
+        if not active.any():
+            break
+    else:
+        warnings.warn(f"Vincenty distance did not converge for {active.sum()} point pairs.")
+
+    u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (cos_2sm + big_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sm ** 2) - big_b / 6 * cos_2sm * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sm ** 2)))
+
+    return WGS84_B * big_a * (sigma - delta_sigma) / 1000
+
+
+def origin_distance_table(meta_df: pd.DataFrame, origins: Mapping[str, Tuple[float, float]],
+                          lat_col: str = "Latitude", lon_col: str = "Longitude") -> pd.DataFrame:
+    """Samples x origins table of distances (km) from each sample to every (lat, lon) origin."""
+    origin_lat, origin_lon = np.array(list(origins.values()), dtype=float).reshape(-1, 2).T
+    dist = geodesic_km(meta_df[lat_col].to_numpy()[:, None], meta_df[lon_col].to_numpy()[:, None],
+                       origin_lat[None, :], origin_lon[None, :])
+    return pd.DataFrame(dist, index=meta_df.index, columns=list(origins.keys()))
+
+
+def island_centroids(meta_df: pd.DataFrame, group_col: str = "Island", lat_col: str = "Latitude",
+                     lon_col: str = "Longitude") -> Dict[str, Tuple[float, float]]:
+    """Mean sample location of each island, usable as candidate founder points in origin_distance_table."""
+    centroids = meta_df.groupby(group_col)[[lat_col, lon_col]].mean()
+    return {name: (row[lat_col], row[lon_col]) for name, row in centroids.iterrows()}
+
+
+def _metadata_hash(meta_df: pd.DataFrame, lat_col: str, lon_col: str) -> str:
+    """sha1 of the sample IDs and their coordinates."""
+    digest = hashlib.sha1()
+    digest.update("\n".join(map(str, meta_df.index)).encode())
+    digest.update(np.ascontiguousarray(meta_df[[lat_col, lon_col]].to_numpy(dtype=float)).tobytes())
+    return digest.hexdigest()
+
+
+def sample_distance_matrix(meta_df: pd.DataFrame, lat_col: str = "Latitude", lon_col: str = "Longitude",
+                           cache_dir: Optional[Path] = DISTANCE_CACHE_DIR) -> pd.DataFrame:
+    """Symmetric sample x sample geographic distance matrix (km), cached on disk keyed by the metadata hash."""
+    meta_df = meta_df.dropna(subset=[lat_col, lon_col])
+    cache_file = Path(cache_dir) / f"{_metadata_hash(meta_df, lat_col, lon_col)}.npy" if cache_dir else None
+
+    if cache_file is not None and cache_file.exists():
+        dist = np.load(cache_file)
+    else:
+        lat = meta_df[lat_col].to_numpy()
+        lon = meta_df[lon_col].to_numpy()
+        i, j = np.triu_indices(len(meta_df), k=1)
+        dist = np.zeros((len(meta_df), len(meta_df)))
+        dist[i, j] = geodesic_km(lat[i], lon[i], lat[j], lon[j])
+        dist[j, i] = dist[i, j]
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            np.save(cache_file, dist)
+
+    return pd.DataFrame(dist, index=meta_df.index, columns=meta_df.index)
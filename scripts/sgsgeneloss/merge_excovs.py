@@ -1,103 +1,131 @@
-from typing import List
+import gzip
+import shutil
+from functools import partial
+from typing import IO, Dict, List, Optional
 from pathlib import Path
 import pandas as pd
-from functools import reduce
 from tabulate import tabulate
+from scripts.sgsgeneloss.excov_dataset import assemble_sample_matrix, find_excov_files
+from scripts.sgsgeneloss.parallel import map_in_pool
+
+# Output suffix for each supported compression of merged excovs.
+COMPRESSION_SUFFIXES = {None: ".excov", "gzip": ".excov.gz", "zstd": ".excov.zst"}
+# SGSGeneLoss arguments that only locate files and are left out of the recorded run settings.
+SGSGL_PATH_ARGS = ("bamPath", "bamFileList", "gffFile", "outDirPath")
 
 def parse_folder_for_samples(folder_path: Path) -> List[Path]:
     """Parses a parent folder and returns a list of Path objects for each child folder found within it."""
     return [p for p in folder_path.iterdir() if p.is_dir()]
 
-def merge_excovs_in_folder(sample_folder_path: Path, outdir_path: Path) -> None:
+def open_excov_output(out_file: Path, compression: Optional[str] = None) -> IO[bytes]:
+    """Opens a merged excov for binary writing, gzip or zstd compressed if asked (zstd needs `zstandard`)."""
+    if compression is None:
+        return out_file.open("wb")
+    if compression == "gzip":
+        return gzip.open(out_file, "wb", compresslevel=6)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.open(out_file, "wb", cctx=zstandard.ZstdCompressor(level=3))
+    raise ValueError(f"Unknown compression '{compression}', use one of {list(COMPRESSION_SUFFIXES)}")
+
+def merge_excovs_in_folder(sample_folder_path: Path, outdir_path: Path, compression: Optional[str] = None) -> Path:
     """Parses the folder path supplied as the argument for .excov files and merges them into a single output file."""
     sample_name = sample_folder_path.name
-    out_file = outdir_path / f"{sample_name}_all.excov"
+    out_file = outdir_path / f"{sample_name}_all{COMPRESSION_SUFFIXES[compression]}"
 
     header_written = False
-    with out_file.open('w') as out:
+    with open_excov_output(out_file, compression) as out:
         for excov_file in sorted(sample_folder_path.glob("*.excov")):
-            with excov_file.open() as f:
-                for i, line in enumerate(f):
-                    if i == 0 and header_written:
-                        continue  # skip header if already written
-                    out.write(line)
-            header_written = True
+            with excov_file.open("rb") as f:
+                header = f.readline()
+                if not header_written:
+                    out.write(header)
+                    header_written = True
+                # Body is copied in blocks rather than line by line.
+                shutil.copyfileobj(f, out, length=1 << 20)
 
     print(f"Merged: {sample_name} -> {out_file}")
+    return out_file
 
-def merge_excovs_for_sample_set(master_folder: str, outdir_folder: str) -> None:
-    """Will create a merged .excov file for all samples found within the highest level folder."""
+def merge_excovs_for_sample_set(master_folder: str, outdir_folder: str, compression: Optional[str] = None,
+                                n_jobs: Optional[int] = None) -> List[Path]:
+    """Will create a merged .excov file for all samples found within the highest level folder, one sample folder
+    per worker process."""
 
     # Turn strings into paths.
     master_folder_path = Path(master_folder)
     outdir_folder_path = Path(outdir_folder)
     outdir_folder_path.mkdir(parents=True, exist_ok=True)
 
-
     # .excov files for each sample and merge, send results to outdir.
     sample_file_paths = parse_folder_for_samples(master_folder_path)
-    for sample in sample_file_paths:
-        merge_excovs_in_folder(sample, outdir_folder_path)
+    merge = partial(merge_excovs_in_folder, outdir_path=outdir_folder_path, compression=compression)
+    out_files = map_in_pool(merge, sample_file_paths, n_jobs)
 
     print(f"Created merged .excov file for {len(sample_file_paths)} samples within {master_folder_path.name}.")
+    return out_files
 
-def create_pav_matrix(infolder:str) -> pd.DataFrame:
-    """Build a PAV matrix from sample_merged.excov files"""
+def sgsgeneloss_params(command: str) -> Dict[str, str]:
+    """The key=value arguments of an SGSGeneLoss command line (minCov, chromosomeList, ...), without the input and
+    output paths, for the provenance of the samples it produced."""
+    args = dict(token.split("=", 1) for token in command.split() if "=" in token)
+    return {key: value for key, value in args.items() if key not in SGSGL_PATH_ARGS}
 
-    # Make str into Path objects.
-    infolder_path = Path(infolder)
+def create_pav_matrix(infolder:str, n_jobs: Optional[int] = None) -> pd.DataFrame:
+    """Build a PAV matrix from sample_merged.excov files"""
 
     # Get file list to include in matrix.
-    if not infolder_path:
-        raise FileNotFoundError(f"Input folder does not exist: {infolder}")
-
-    excov_files = sorted(infolder_path.glob("*.excov"))
-    if not excov_files:
-        raise FileNotFoundError(f"No .excov files found in {infolder}")
-
-    # Only interested in geneID and is_lost columns.
-    pav_dfs = []
-    for file_path in excov_files:
-        sample_name = file_path.stem
-        df = pd.read_csv(file_path, engine="pyarrow")
+    excov_files = find_excov_files(infolder)
 
-        df = df[["ID", "is_lost"]].copy()
-        df["is_lost"] = df["is_lost"].map({"PRESENT": 1, "LOST": 0})
-        df = df.rename(columns={"is_lost": sample_name})
-        pav_dfs.append(df)
-
-    # Merge on 'ID' (gene IDs)
-    pav_matrix = reduce(lambda left, right: pd.merge(left, right, on="ID", how="outer"), pav_dfs)
-    pav_matrix = pav_matrix.fillna(0).set_index("ID").astype(int)
+    # Only interested in geneID and is_lost columns, missing genes count as lost.
+    pav_matrix = assemble_sample_matrix(excov_files, "is_lost", value_map={"PRESENT": 1, "LOST": 0}, dtype=int,
+                                        n_jobs=n_jobs)
 
     return pav_matrix
 
-def create_coverage_matrix(infolder:str) -> pd.DataFrame:
+def create_coverage_matrix(infolder:str, n_jobs: Optional[int] = None) -> pd.DataFrame:
     """Builds a coverage matrix for all samples in the input folder."""
-    infolder_path = Path(infolder)
-    excov_files = sorted(infolder_path.glob("*.excov"))
-
-    coverage_dfs = []
-    for file_path in excov_files:
-        sample_name = file_path.stem
-        df = pd.read_csv(file_path, engine="pyarrow")
-
-        # Select geneID and coverage.
-        df = df[["ID", "ave_cove_depth_gene"]].copy()
-        df = df.rename(columns={"ave_cove_depth_gene": sample_name})
-        coverage_dfs.append(df)
+    excov_files = find_excov_files(infolder)
 
-    coverage_matrix = reduce(lambda left, right: pd.merge(left, right, on="ID", how="outer"), coverage_dfs)
-    coverage_matrix = coverage_matrix.fillna(0).set_index("ID").astype(float)
+    # Select geneID and coverage.
+    coverage_matrix = assemble_sample_matrix(excov_files, "ave_cove_depth_gene", dtype=float, n_jobs=n_jobs)
 
     return coverage_matrix
 
 if __name__ == "__main__":
-    merge_excovs_for_sample_set(master_folder=r"../../data/sgsgeneloss_/250408_mainland_species/run_2/mainland_yacon", outdir_folder="../../data/sgsgeneloss_/250408_mainland_species/run_2/mainland_yacon_merged")
-    pav_df = create_pav_matrix(infolder="../../data/sgsgeneloss_/250408_mainland_species/run_2/mainland_yacon_merged")
-    pav_df.to_csv("../../data/sgsgeneloss_/250408_mainland_species/run_2/mainland_pav_matrix.csv", index=True)
-    # Create coverage matrix.
-    cov_df = create_coverage_matrix(infolder="../../data/sgsgeneloss_/250408_mainland_species/run_2/mainland_yacon_merged")
-    cov_df.to_csv("../../data/sgsgeneloss_/250408_mainland_species/run_2/mainland_cov_matrix.csv", index=True)
-
-
+    import argparse
+    from scripts.sgsgeneloss.excov_dataset import (append_excovs, ingest_excovs, ingest_sample_folders,
+                                                     load_excov_dataset, write_excov_dataset)
+    from scripts.sgsgeneloss.coverage_store import write_coverage_store
+
+    # e.g. the island cohort behind pav_matrix.csv, whose gene positions plot_stats.py and nc_position_analysis.py
+    # read: python merge_excovs.py ../../data/sgsgeneloss/SGSGL_results ../../data/sgsgeneloss/excov_dataset
+    #       --params chromosomeList=all minCov=<value used>
+    parser = argparse.ArgumentParser(description="Ingest SGSGeneLoss excovs into an excov dataset.")
+    parser.add_argument("excov_folder", type=Path,
+                        help="Folder of merged *_all.excov files, or of per-sample folders with --sample-folders.")
+    parser.add_argument("dataset_dir", type=Path, help="Dataset to create, or to append new samples to.")
+    parser.add_argument("--params", nargs="+", required=True,
+                        help="SGSGeneLoss settings of the run as key=value (or its whole command line), stored "
+                             "with every sample's provenance.")
+    parser.add_argument("--sample-folders", action="store_true",
+                        help="Stream per-chromosome excovs straight into the dataset, no merged copies are written.")
+    parser.add_argument("--pav-out", type=Path, help="Also write the PAV matrix to this CSV.")
+    parser.add_argument("--cov-out", type=Path, help="Also write the coverage matrix to this coverage store.")
+    args = parser.parse_args()
+
+    sgsgl_params = sgsgeneloss_params(" ".join(args.params))
+    if not sgsgl_params:
+        parser.error("--params needs at least one key=value setting.")
+    # Only new samples are read once the dataset exists.
+    if (args.dataset_dir / "manifest.json").exists():
+        append_excovs(args.dataset_dir, args.excov_folder, params=sgsgl_params, sample_folders=args.sample_folders)
+    else:
+        ingest = ingest_sample_folders if args.sample_folders else ingest_excovs
+        write_excov_dataset(ingest(args.excov_folder, params=sgsgl_params), args.dataset_dir, sample_capacity=256)
+    if args.pav_out or args.cov_out:
+        dataset = load_excov_dataset(args.dataset_dir)
+        if args.pav_out:
+            dataset.pav.to_csv(args.pav_out, index=True)
+        if args.cov_out:
+            write_coverage_store(dataset.coverage, args.cov_out)
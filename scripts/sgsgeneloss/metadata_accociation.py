@@ -1,15 +1,16 @@
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 from typing import Optional, Dict
 from pathlib import Path
 from scipy.stats import ttest_ind, mannwhitneyu
 from scripts.sgsgeneloss.popcolors import island_colors # (change this to load the python dict of colors - or with __init__
 from tabulate import tabulate
-from umap import UMAP
+from scripts.sgsgeneloss.pav_store import load_pav_df
+from scripts.sgsgeneloss.umap_embedding import UmapParams, embed
+from scripts.sgsgeneloss.pav_heatmap import plt_pav_heatmap
 
 # Load data/metadata.
-pav_df = pd.read_csv("../../data/sgsgeneloss/pav_matrix.csv", index_col=0, header=0)
+pav_df = load_pav_df("../../data/sgsgeneloss/pav_matrix.csv")
 meta_df = pd.read_excel("../../metadata/raw_sample_metadata.xlsx", index_col=0, header=0, sheet_name="S1 Sample Overview")
 
 # Do some formatting.
@@ -20,12 +21,8 @@ meta_df = meta_df.loc[meta_df.index.intersection(pav_df_t.index)]
 
 # Some plots to show association of samples between islands:
 def plt_island_umap(pav_df_t: pd.DataFrame, meta_df: pd.DataFrame, outfile: Optional[str] = None):
-    # Fit UMAP on binary PAV data using Jaccard distance
-    umap_model = UMAP(n_components=15, random_state=42, metric="hamming")
-    umap_coords = umap_model.fit_transform(pav_df_t)
-
-    # Create UMAP dataframe for plotting
-    umap_df = pd.DataFrame(umap_coords, columns=["UMAP1", "UMAP2"], index=meta_df.index)
+    # UMAP of the cached Hamming distances of the binary PAV data, fitted once and read back from the cache
+    umap_df = embed(pav_df_t.T, UmapParams(n_neighbors=15, n_components=2)).loc[meta_df.index, ["UMAP1", "UMAP2"]]
     umap_df["species"] = meta_df["species"]
 
     # Assign consistent colors to islands
@@ -63,12 +60,8 @@ def plt_island_umap(pav_df_t: pd.DataFrame, meta_df: pd.DataFrame, outfile: Opti
     return plt
 
 def plt_island_umap_3_dims(pav_df_t: pd.DataFrame, pop_colors: Dict[str, str],outfile: Optional[str] = None):
-    # Compute UMAP
-    umap_model = UMAP(n_components=3, random_state=42, metric="hamming", n_neighbors=7)
-    umap_coords = umap_model.fit_transform(pav_df_t)
-
-    # Create DataFrame with UMAP coordinates
-    umap_df = pd.DataFrame(umap_coords, columns=["UMAP1", "UMAP2", "UMAP3"], index=pav_df_t.index)
+    # Read (or compute once) the UMAP coordinates
+    umap_df = embed(pav_df_t.T, UmapParams(n_neighbors=7, n_components=3))
 
     # Set up 3D figure
     fig = plt.figure(figsize=(10, 8))
@@ -178,33 +171,13 @@ def filter_pavs_by_prevalance(pav_df: pd.DataFrame, min: float, max: float):
     return subset
 
 def plt_non_core_heatmap(pav_df: pd.DataFrame, meta_df: pd.DataFrame, outfile: Optional[str] = None) -> None:
-    df = pav_df.copy()
-    mdf = meta_df.copy()
-    nc_gene_mask = df.columns[(pav_df != 1).any(axis=0)]
-    subset = df[nc_gene_mask]
-
-    # Sort Columns.
-    sorted_samples = mdf.sort_values("Island").index.tolist()
-    subset = subset[sorted_samples]
-
-    # Build Columns colors
-    islands = mdf["Island"].unique()
-    colors = plt.cm.tab10.colors
-    color_map = {island: colors[i % len(colors)] for i, island in enumerate(islands)}
-    col_colors = mdf["Island"].map(color_map)
-
-    sns.clustermap(subset,
-                col_cluster=False,
-                row_cluster=False,
-                cmap="Greys",
-                figsize=(20, 20),
-                cbar_kws={"label": "Presence (1) / Absence (0)"},
-                col_colors=col_colors,
-                )
-    plt.title("PAV Heatmap of Non-Core genes.")
-    plt.xlabel("Features")
-    plt.ylabel("Samples")
-    plt.show()
+    # Samples grouped by island and clustered within, non-core genes seriated, drawn as one raster image.
+    fig, _ = plt_pav_heatmap(pav_df, sample_groups=meta_df["Island"], group_colors=island_colors,
+                             gene_filter="non_core", figsize=(20, 20))
+    if outfile:
+        fig.savefig(outfile)
+    else:
+        plt.show()
 
 def plt_umap_with_color(pav_df_t: pd.DataFrame, pop_colors: Dict[str, str], outfile: Optional[str] = None):
     """
@@ -222,12 +195,8 @@ def plt_umap_with_color(pav_df_t: pd.DataFrame, pop_colors: Dict[str, str], outf
         If provided, saves the plot to this path.
     """
 
-    # Fit UMAP on binary PAV data using Hamming distance
-    umap_model = UMAP(n_components=2, random_state=42, metric="hamming", n_neighbors=7)
-    umap_coords = umap_model.fit_transform(pav_df_t)
-
-    # Create UMAP dataframe for plotting
-    umap_df = pd.DataFrame(umap_coords, columns=["UMAP1", "UMAP2"], index=pav_df_t.index)
+    # UMAP of the cached Hamming distances of the binary PAV data, fitted once and read back from the cache
+    umap_df = embed(pav_df_t.T, UmapParams(n_neighbors=7, n_components=2))
 
     # Set up figure
     fig, ax = plt.subplots(figsize=(8, 6))
@@ -2,6 +2,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 from pathlib import Path
+from scripts.sgsgeneloss.excov_dataset import load_gene_positions
+from scripts.sgsgeneloss.pav_store import load_pav
 
 # Function to extract chromosome and co-ordinates of each gene.
 def build_position_table(excov_file:Path) -> pd.DataFrame:
@@ -123,8 +125,8 @@ def plot_combined_percentage_histogram(filtered, chrs_df, bin_size=5):
 
 # Get PAV matrix and make core/non-core summary.
 DATA_FOLDER = Path("../../data/sgsgeneloss/")
-pav_df = pd.read_csv(DATA_FOLDER/ "pav_matrix.csv", index_col=0, header=0)
-classification = pav_df.all(axis=1).map({True: "core", False: "non-core"})
+pav = load_pav(DATA_FOLDER / "pav_matrix.csv")
+classification = pd.Series(pav.core_mask(), index=pav.genes).map({True: "core", False: "non-core"})
 
 # Build summary dataframe
 summary_df = pd.DataFrame({
@@ -132,7 +134,8 @@ summary_df = pd.DataFrame({
 })
 
 # Get contig (chromosome), start position and end position and relative chromosome end in one dataframe..
-position_df = build_position_table( DATA_FOLDER/ "SGSGL_results/AHA6_30_merged_all.excov")
+position_df = load_gene_positions(DATA_FOLDER / "excov_dataset",
+                                  fallback_excov=DATA_FOLDER / "SGSGL_results/AHA6_30_merged_all.excov")
 chrs_df = pd.read_csv(DATA_FOLDER/"SGSGL_results/chrs.csv", header=0)
 chrs_df = chrs_df.rename(columns={"chr": "chromosome"})
 chrs_df = chrs_df[chrs_df['chromosome'].str.startswith("chr")]
@@ -1,26 +1,34 @@
-import pandas as pd
-from scipy.spatial.distance import pdist, squareform
-from skbio import DistanceMatrix
-from skbio.tree import nj
 from pathlib import Path
 from tabulate import tabulate
+from scripts.sgsgeneloss.pav_store import PackedPav, load_pav_df
+from scripts.sgsgeneloss.pav_distance_cache import condensed_distances
+from scripts.sgsgeneloss.pav_bootstrap import annotate_support, bootstrap_splits
+from scripts.sgsgeneloss.tree_builder import neighbor_joining, upgma
+
+# GLOBALS
+# Gene-resampling replicates for clade support, 0 writes the tree without support values.
+N_BOOTSTRAP = 1000
 
 # Read data.
 pav_file = Path("../../data/sgsgeneloss/pav_matrix.csv")
-pav_df = pd.read_csv(pav_file, header=0, index_col=0)
+pav_df = load_pav_df(pav_file)
 pav_df.columns = pav_df.columns.str.replace('_merged_all', '', regex=False)
-pav_df_T = pav_df.T
-
-# Compute hamming distance.
-dist_array = pdist(pav_df_T, 'hamming')
-dist_matrix = squareform(dist_array)
 
-# Build distance matrix with sample names.
-sample_names = pav_df_T.index.tolist()
-dm = DistanceMatrix(dist_matrix, sample_names)
+# Hamming distance, computed once per PAV version by the distance cache.
+pav = PackedPav.from_frame(pav_df)
+condensed = condensed_distances(pav, "hamming")
+sample_names = pav_df.columns.tolist()
 
 # Build NJ-tree.
-tree = nj(dm)
+tree = neighbor_joining(condensed, sample_names)
 tree = tree.root_at_midpoint()
+
+# Annotate bootstrap support on the internal nodes.
+if N_BOOTSTRAP:
+    tree = annotate_support(tree, bootstrap_splits(pav, N_BOOTSTRAP))
+
 tree.write("../../data/phylo_pav_tree.nwk")
-print(tabulate(pav_df.head(), headers="keys"))
\ No newline at end of file
+
+# UPGMA tree from the same distances for comparison.
+upgma(condensed, sample_names).write("../../data/phylo_pav_tree_upgma.nwk")
+print(tabulate(pav_df.head(), headers="keys"))
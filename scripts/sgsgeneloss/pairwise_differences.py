@@ -1,33 +1,19 @@
 from pathlib import Path
-from sklearn.metrics import pairwise_distances
 from popcolors import order, pop_colors
-import pandas as pd
-import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
-
-# Helper funcs.
-def match_similarity(u, v):
-    return np.sum(u == v) / len(u)
+from scripts.sgsgeneloss.pav_store import load_pav
+from scripts.sgsgeneloss.pav_similarity import nearest_partners
+from scripts.sgsgeneloss.pav_distance_cache import distance_frame
 
 # Load PAV.
 DATA_FOLDER = Path("../../data/")
 PAV_MATRIX = DATA_FOLDER / "sgsgeneloss_/pav_matrix.csv"
 
-# To pandas + filter + transpose
-pav_df = pd.read_csv(PAV_MATRIX, header=0, index_col=0)
-nc_pav_df = pav_df[~(pav_df == 1).all(axis=1)]
-nc_pav_t = nc_pav_df.T
-
-# Compute similarity matrix
-similarity_matrix = pd.DataFrame(
-    pairwise_distances(nc_pav_t, metric=lambda u, v: 1 - match_similarity(u, v)),
-    index=nc_pav_t.index,
-    columns=nc_pav_t.index
-)
-
-similarity_matrix = 1 - similarity_matrix
+# Matching similarity over the non-core genes, i.e. 1 - their cached Hamming distance.
+pav = load_pav(PAV_MATRIX)
+similarity_matrix = 1 - distance_frame(pav, "hamming", gene_filter="non_core")
 similarity_matrix = similarity_matrix.loc[order, order]
 
 
@@ -45,11 +31,7 @@ for tick_label in ax.get_yticklabels():
     tick_label.set_color(pop_colors[sample])
 
 # Overlay sample of max similarity:
-for i, sample in enumerate(similarity_matrix.index):
-    row = similarity_matrix.loc[sample].drop(sample)   # exclude self
-    partner = row.idxmax()
-    j = similarity_matrix.columns.get_loc(partner)
-
+for i, j in enumerate(nearest_partners(similarity_matrix)):
     rect = Rectangle((j, i), 1, 1, fill=False, edgecolor='red', linewidth=2)
     ax.add_patch(rect)
 
@@ -0,0 +1,21 @@
+# Process-pool map with a serial fallback, shared by the excov, stats, bootstrap and GO sweep scripts.
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Sequence
+
+
+def resolve_n_jobs(n_jobs: Optional[int] = None) -> int:
+    """Number of worker processes, every CPU when `n_jobs` is None or 0."""
+    return n_jobs or os.cpu_count() or 1
+
+
+def map_in_pool(func: Callable, items: Sequence, n_jobs: Optional[int] = None, chunksize: int = 1) -> List:
+    """Maps `func` over `items` in a process pool (serially for one job or one item), keeping input order.
+
+    The pool never has more workers than items; `chunksize` batches many small items per task.
+    """
+    n_jobs = resolve_n_jobs(n_jobs)
+    if n_jobs == 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(items))) as pool:
+        return list(pool.map(func, items, chunksize=chunksize))
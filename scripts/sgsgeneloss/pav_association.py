@@ -0,0 +1,183 @@
+# Per-gene association of PAV with sample metadata: every gene tested at once per metadata column, with BH FDR.
+from pathlib import Path
+from typing import Iterator, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2, hypergeom
+
+from scripts.go_enrichment.batch_enrichment import benjamini_hochberg
+from scripts.sgsgeneloss.pav_store import PackedPav, load_pav
+from scripts.sgsgeneloss.pav_similarity import GENE_BLOCK_SIZE
+from scripts.sgsgeneloss.pav_distance_cache import GeneFilter, select_genes
+
+# GLOBALS
+METADATA_COLUMNS = ("Island", "Climate", "species")
+# Newton steps of the per-gene logistic fits, linear predictors are clipped to keep separated genes finite.
+LOGIT_MAX_ITER = 25
+LOGIT_TOL = 1e-8
+LOGIT_MAX_ETA = 30.0
+
+
+def _blocks(pav: PackedPav, rows: np.ndarray, cols: np.ndarray, block_size: int) -> Iterator[Tuple[slice, np.ndarray]]:
+    """Yields (position in `rows`, float64 genes x selected samples 0/1 block)."""
+    for start in range(0, len(rows), block_size):
+        span = slice(start, start + block_size)
+        block = np.unpackbits(pav.bits[rows[span]], axis=1, count=len(pav.samples))[:, cols]
+        yield span, block.astype(np.float64)
+
+
+def contingency_counts(pav: PackedPav, groups: pd.Series, rows: np.ndarray,
+                       block_size: int = GENE_BLOCK_SIZE) -> Tuple[np.ndarray, pd.Series]:
+    """Genes x levels number of samples with the gene present, and the number of samples per level.
+
+    One product of each gene block with the samples x levels indicator matrix; samples without a level are left
+    out of both.
+    """
+    groups = groups.reindex(pav.samples)
+    cols = np.flatnonzero(groups.notna().to_numpy())
+    levels = pd.Categorical(groups.iloc[cols])
+    onehot = np.zeros((len(cols), len(levels.categories)))
+    onehot[np.arange(len(cols)), levels.codes] = 1
+    present = np.empty((len(rows), len(levels.categories)))
+    for span, block in _blocks(pav, rows, cols, block_size):
+        present[span] = block @ onehot
+    return present, pd.Series(onehot.sum(axis=0), index=levels.categories, name="n_samples")
+
+
+def fisher_exact_2xk(present: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """Two-sided Fisher exact p-values of genes x 2 presence counts, all genes in one array operation.
+
+    Given a gene's total presence the count in the first level is hypergeometric; the p-value sums the
+    probabilities of all tables no more likely than the observed one, with scipy's relative tolerance.
+    """
+    n_total, n_first = int(sizes.sum()), int(sizes[0])
+    k = present.sum(axis=1)
+    x = np.arange(n_first + 1)
+    pmf = hypergeom.pmf(x[None, :], n_total, k[:, None], n_first)
+    observed = hypergeom.pmf(present[:, 0], n_total, k, n_first)
+    return np.clip((pmf * (pmf <= observed[:, None] * (1 + 1e-7))).sum(axis=1), 0, 1)
+
+
+def chi2_independence(present: np.ndarray, sizes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Pearson chi-squared statistic and p-value of genes x levels presence counts against their level sizes."""
+    n_total = sizes.sum()
+    k = present.sum(axis=1, keepdims=True)
+    expected_present = k * sizes[None, :] / n_total
+    expected_absent = (n_total - k) * sizes[None, :] / n_total
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stat = ((present - expected_present) ** 2 / expected_present
+                + (sizes[None, :] - present - expected_absent) ** 2 / expected_absent).sum(axis=1)
+    return stat, chi2.sf(stat, len(sizes) - 1)
+
+
+def categorical_tests(pav: PackedPav, groups: pd.Series, rows: np.ndarray,
+                      block_size: int = GENE_BLOCK_SIZE) -> pd.DataFrame:
+    """Fisher exact (two levels) or chi-squared (more levels) test of every gene against a categorical column.
+
+    Also reports the levels with the highest and lowest presence rate. Genes present in all or none of the
+    annotated samples get NaN p-values.
+    """
+    present, sizes = contingency_counts(pav, groups, rows, block_size)
+    keep = sizes.to_numpy() > 0
+    present, sizes = present[:, keep], sizes[keep]
+    if len(sizes) < 2:
+        raise ValueError(f"Column {groups.name!r} has fewer than two levels among the PAV samples.")
+    rates = present / sizes.to_numpy()[None, :]
+    k = present.sum(axis=1)
+    if len(sizes) == 2:
+        test, stat, pvals = "fisher", np.full(len(rows), np.nan), fisher_exact_2xk(present, sizes.to_numpy())
+    else:
+        test = "chi2"
+        stat, pvals = chi2_independence(present, sizes.to_numpy())
+    variable = (k > 0) & (k < sizes.sum())
+    return pd.DataFrame({
+        "test": test,
+        "statistic": np.where(variable, stat, np.nan),
+        "p_value": np.where(variable, pvals, np.nan),
+        "n_present": k.astype(int),
+        "n_samples": int(sizes.sum()),
+        "most_present_in": sizes.index[rates.argmax(axis=1)],
+        "least_present_in": sizes.index[rates.argmin(axis=1)],
+        "rate_range": rates.max(axis=1) - rates.min(axis=1),
+    }, index=pav.genes[rows])
+
+
+def _log_likelihood(y: np.ndarray, eta: np.ndarray) -> np.ndarray:
+    return (y * eta - np.logaddexp(0, eta)).sum(axis=1)
+
+
+def logistic_tests(pav: PackedPav, covariate: pd.Series, rows: np.ndarray,
+                   block_size: int = GENE_BLOCK_SIZE) -> pd.DataFrame:
+    """Likelihood-ratio test of presence ~ covariate for every gene, fitted by batched Newton-Raphson.
+
+    The covariate is standardised, so `coef` is the change in log-odds of presence per standard deviation. All
+    genes of a block share one design and are updated together through a batch of 2 x 2 solves.
+    """
+    covariate = covariate.reindex(pav.samples).astype(float)
+    cols = np.flatnonzero(covariate.notna().to_numpy())
+    z = covariate.iloc[cols].to_numpy()
+    z = (z - z.mean()) / (z.std() or 1.0)
+    coef, stat = np.full(len(rows), np.nan), np.full(len(rows), np.nan)
+    k = np.zeros(len(rows))
+    for span, y in _blocks(pav, rows, cols, block_size):
+        k[span] = y.sum(axis=1)
+        rate = np.clip(k[span] / len(cols), 1e-12, 1 - 1e-12)
+        beta = np.column_stack([np.log(rate / (1 - rate)), np.zeros(len(y))])
+        for _ in range(LOGIT_MAX_ITER):
+            eta = np.clip(beta[:, :1] + beta[:, 1:] * z[None, :], -LOGIT_MAX_ETA, LOGIT_MAX_ETA)
+            mu = 1 / (1 + np.exp(-eta))
+            w = mu * (1 - mu) + 1e-12
+            gradient = np.stack([(y - mu).sum(axis=1), ((y - mu) * z).sum(axis=1)], axis=1)
+            hessian = np.stack([np.stack([w.sum(axis=1), (w * z).sum(axis=1)], axis=1),
+                                np.stack([(w * z).sum(axis=1), (w * z ** 2).sum(axis=1)], axis=1)], axis=1)
+            step = np.linalg.solve(hessian, gradient[:, :, None])[:, :, 0]
+            beta += step
+            if np.abs(step).max() < LOGIT_TOL:
+                break
+        eta = np.clip(beta[:, :1] + beta[:, 1:] * z[None, :], -LOGIT_MAX_ETA, LOGIT_MAX_ETA)
+        null = np.log(rate / (1 - rate))[:, None] * np.ones_like(y)
+        coef[span] = beta[:, 1]
+        stat[span] = np.clip(2 * (_log_likelihood(y, eta) - _log_likelihood(y, null)), 0, None)
+    variable = (k > 0) & (k < len(cols))
+    return pd.DataFrame({
+        "test": "logistic_lrt",
+        "statistic": np.where(variable, stat, np.nan),
+        "p_value": np.where(variable, chi2.sf(stat, 1), np.nan),
+        "n_present": k.astype(int),
+        "n_samples": len(cols),
+        "coef": np.where(variable, coef, np.nan),
+    }, index=pav.genes[rows])
+
+
+def associate(pav: Union[pd.DataFrame, PackedPav], meta_df: pd.DataFrame,
+              columns: Sequence[str] = METADATA_COLUMNS, gene_filter: GeneFilter = "non_core",
+              block_size: int = GENE_BLOCK_SIZE) -> pd.DataFrame:
+    """Tests every selected gene against each metadata column and returns one table ranked by p-value.
+
+    Numeric columns are tested with a logistic model, all others as categories. `meta_df` is indexed by the
+    PAV sample names. q-values are Benjamini-Hochberg adjusted within each column over the testable genes.
+    """
+    packed = pav if isinstance(pav, PackedPav) else PackedPav.from_frame(pav)
+    rows = packed.gene_rows(select_genes(packed, gene_filter))
+    tables = []
+    for column in columns:
+        values = meta_df[column]
+        if pd.api.types.is_numeric_dtype(values):
+            table = logistic_tests(packed, values, rows, block_size)
+        else:
+            table = categorical_tests(packed, values, rows, block_size)
+        table.insert(0, "variable", column)
+        table.insert(table.columns.get_loc("p_value") + 1, "q_value", benjamini_hochberg(table["p_value"].to_numpy()))
+        tables.append(table.rename_axis("gene").reset_index())
+    return pd.concat(tables, ignore_index=True).sort_values(["p_value", "statistic"], ascending=[True, False],
+                                                            ignore_index=True, na_position="last")
+
+
+if __name__ == "__main__":
+    pav = load_pav(Path("../../data/sgsgeneloss/pav_matrix.csv"))
+    meta_df = pd.read_excel("../../metadata/raw_sample_metadata.xlsx", index_col=0, sheet_name="S1 Sample Overview")
+    meta_df = meta_df.rename(index=lambda s: f"{s}_merged_all")
+    results = associate(pav, meta_df)
+    results.to_csv("../../data/sgsgeneloss/pav_metadata_association.csv", index=False)
+    print(results.head(20).to_string())
+    print(results.groupby("variable")["q_value"].apply(lambda q: (q < 0.05).sum()).rename("q < 0.05"))
@@ -0,0 +1,90 @@
+# Gene-resampling bootstrap support for neighbour-joining trees built from PAV Hamming distances.
+from collections import Counter
+from dataclasses import replace
+from pathlib import Path
+from typing import List, Optional, Sequence, Set, Tuple
+import numpy as np
+import pandas as pd
+
+from scripts.sgsgeneloss.pav_store import PackedPav, load_pav
+from scripts.sgsgeneloss.pav_distance_cache import condensed_distances
+from scripts.sgsgeneloss.tree_builder import DistanceTree, neighbor_joining
+from scripts.sgsgeneloss.parallel import map_in_pool, resolve_n_jobs
+
+# GLOBALS
+N_BOOTSTRAP = 1000
+
+
+def gene_patterns(pav: PackedPav) -> Tuple[np.ndarray, np.ndarray]:
+    """Distinct variable gene rows (uint8 0/1 patterns x samples) and each gene's pattern index.
+
+    Genes present or absent in every sample never separate two samples, so they all map to the extra index
+    len(patterns) and only count towards the number of genes.
+    """
+    width = -(-len(pav.samples) // 8)
+    rows, inverse = np.unique(np.ascontiguousarray(pav.bits[:, :width]), axis=0, return_inverse=True)
+    patterns = np.unpackbits(rows, axis=1, count=len(pav.samples))
+    constant = patterns.all(axis=1) | ~patterns.any(axis=1)
+    remap = np.where(constant, (~constant).sum(), np.cumsum(~constant) - 1)
+    return patterns[~constant], remap[inverse.ravel()]
+
+
+def weighted_hamming(patterns: np.ndarray, weights: np.ndarray, n_genes: int) -> np.ndarray:
+    """Square Hamming distance matrix of a gene sample in which pattern k was drawn weights[k] times."""
+    values = patterns.astype(np.float64)
+    present = weights @ values
+    both = (values * weights[:, None]).T @ values
+    return (present[:, None] + present[None, :] - 2 * both) / n_genes
+
+
+def _bootstrap_chunk(args) -> List[Set[int]]:
+    """NJ trees of one chunk of replicates, returned as their split sets."""
+    patterns, gene_pattern, taxa, seeds = args
+    n_genes = len(gene_pattern)
+    replicate_splits = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        weights = np.bincount(gene_pattern[rng.integers(0, n_genes, n_genes)], minlength=len(patterns) + 1)
+        dist = weighted_hamming(patterns, weights[:-1].astype(np.float64), n_genes)
+        replicate_splits.append(neighbor_joining(dist, taxa).splits())
+    return replicate_splits
+
+
+def bootstrap_splits(pav: PackedPav, n_replicates: int = N_BOOTSTRAP, seed: int = 0,
+                     n_jobs: Optional[int] = None) -> List[Set[int]]:
+    """Splits of `n_replicates` NJ trees on genes resampled with replacement, built in a process pool.
+
+    Each replicate is the pattern count vector of its gene sample, so its distance matrix is one weighted
+    product over distinct patterns. Every replicate has its own seed, so results do not depend on `n_jobs`.
+    """
+    patterns, gene_pattern = gene_patterns(pav)
+    taxa = [str(s) for s in pav.samples]
+    seeds = np.random.SeedSequence(seed).spawn(n_replicates)
+    n_jobs = resolve_n_jobs(n_jobs)
+    chunks = [(patterns, gene_pattern, taxa, list(c)) for c in np.array_split(seeds, min(4 * n_jobs, n_replicates))
+              if len(c)]
+    results = map_in_pool(_bootstrap_chunk, chunks, n_jobs)
+    return [splits for chunk in results for splits in chunk]
+
+
+def annotate_support(tree: DistanceTree, replicate_splits: Sequence[Set[int]]) -> DistanceTree:
+    """Copy of `tree` with each internal node labelled by the percentage of replicates containing its split."""
+    counts = Counter(split for splits in replicate_splits for split in splits)
+    labels = {node: str(round(100 * counts[split] / max(len(replicate_splits), 1)))
+              for node, split in tree.node_splits().items()}
+    return replace(tree, labels=labels)
+
+
+def bootstrap_nj_tree(pav: PackedPav, n_replicates: int = N_BOOTSTRAP, seed: int = 0,
+                      n_jobs: Optional[int] = None) -> DistanceTree:
+    """Midpoint-rooted NJ tree of the Hamming distances with bootstrap support as internal node labels."""
+    taxa = [str(s) for s in pav.samples]
+    tree = neighbor_joining(condensed_distances(pav, "hamming"), taxa).root_at_midpoint()
+    return annotate_support(tree, bootstrap_splits(pav, n_replicates, seed, n_jobs))
+
+
+if __name__ == "__main__":
+    pav = load_pav(Path("../../data/sgsgeneloss/pav_matrix.csv"))
+    tree = bootstrap_nj_tree(pav)
+    tree.write("../../data/phylo_pav_tree_bootstrap.nwk")
+    print(pd.Series(list(tree.labels.values()), name="support").astype(int).describe())
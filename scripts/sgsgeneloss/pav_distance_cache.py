@@ -0,0 +1,100 @@
+# Content-addressed disk cache of condensed sample distance matrices, shared by the tree, heatmap and ordination code.
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Union
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import squareform
+
+from scripts.sgsgeneloss.pav_store import PackedPav, load_pav
+from scripts.sgsgeneloss.pav_similarity import DISTANCE_METRICS, pairwise_distance
+
+# GLOBALS
+PAV_DISTANCE_CACHE_DIR = Path("../../data/pav_distance_cache")
+# Named gene filters, anything else is passed as an explicit list of gene IDs.
+GENE_FILTERS = ("all", "non_core")
+# Suffix the merged excov file names add to sample IDs, some scripts strip it before packing.
+SAMPLE_SUFFIX = "_merged_all"
+# Matrices already read in this process, keyed like the files on disk.
+_LOADED: Dict[str, np.ndarray] = {}
+
+GeneFilter = Union[str, Sequence[str]]
+
+
+def select_genes(pav: PackedPav, gene_filter: GeneFilter = "all") -> Optional[pd.Index]:
+    """Gene IDs a filter keeps, None meaning every gene."""
+    if isinstance(gene_filter, str):
+        if gene_filter == "all":
+            return None
+        if gene_filter == "non_core":
+            return pav.genes[~pav.core_mask()]
+        raise ValueError(f"Unknown gene filter {gene_filter!r}, expected one of {GENE_FILTERS} or a list of genes.")
+    return pd.Index(gene_filter)
+
+
+def canonical_samples(samples: Sequence[str]) -> List[str]:
+    """Sample IDs without the merged excov suffix, so relabelled copies of a matrix share cache entries."""
+    return [str(sample).removesuffix(SAMPLE_SUFFIX) for sample in samples]
+
+
+def distance_key(pav: PackedPav, metric: str, gene_filter: GeneFilter = "all") -> str:
+    """sha1 of (PAV content hash over canonical sample IDs, gene filter, metric).
+
+    Named filters are hashed by name since they are a function of the matrix, explicit gene lists by their IDs.
+    """
+    digest = hashlib.sha1()
+    digest.update(pav.content_hash(canonical_samples(pav.samples)).encode())
+    digest.update(b"\0")
+    if isinstance(gene_filter, str):
+        digest.update(gene_filter.encode())
+    else:
+        digest.update("\n".join(map(str, gene_filter)).encode())
+    digest.update(b"\0")
+    digest.update(metric.encode())
+    return digest.hexdigest()
+
+
+def condensed_distances(pav: Union[pd.DataFrame, PackedPav], metric: str = "hamming", gene_filter: GeneFilter = "all",
+                        cache_dir: Optional[Path] = PAV_DISTANCE_CACHE_DIR) -> np.ndarray:
+    """Condensed (scipy pdist layout) sample distances of a genes x samples PAV matrix, computed once per key.
+
+    Results are kept as <key>.npy in `cache_dir` and in memory for the rest of the process; pass cache_dir=None
+    to skip the disk cache.
+    """
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(f"Unknown distance metric {metric!r}, expected one of {DISTANCE_METRICS}.")
+    packed = pav if isinstance(pav, PackedPav) else PackedPav.from_frame(pav)
+    key = distance_key(packed, metric, gene_filter)
+    if key in _LOADED:
+        return _LOADED[key]
+
+    cache_file = Path(cache_dir) / f"{key}.npy" if cache_dir else None
+    if cache_file is not None and cache_file.exists():
+        condensed = np.load(cache_file)
+    else:
+        dist = pairwise_distance(packed, metric, genes=select_genes(packed, gene_filter))
+        condensed = squareform(dist.to_numpy(), checks=False)
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # Written under a temporary name first so a concurrent reader never sees a partial file.
+            tmp_file = cache_file.with_suffix(".tmp.npy")
+            np.save(tmp_file, condensed)
+            tmp_file.replace(cache_file)
+    _LOADED[key] = condensed
+    return condensed
+
+
+def distance_frame(pav: Union[pd.DataFrame, PackedPav], metric: str = "hamming", gene_filter: GeneFilter = "all",
+                   cache_dir: Optional[Path] = PAV_DISTANCE_CACHE_DIR) -> pd.DataFrame:
+    """Square samples x samples distance DataFrame served from the cache."""
+    samples = pav.samples if isinstance(pav, PackedPav) else pav.columns
+    dist = squareform(condensed_distances(pav, metric, gene_filter, cache_dir))
+    return pd.DataFrame(dist, index=samples, columns=samples)
+
+
+if __name__ == "__main__":
+    # Warm the cache with the matrices the plotting scripts ask for.
+    pav = load_pav(Path("../../data/sgsgeneloss/pav_matrix.csv"))
+    for metric in DISTANCE_METRICS:
+        for gene_filter in GENE_FILTERS:
+            condensed_distances(pav, metric, gene_filter)
@@ -3,6 +3,7 @@ from scripts.go_enrichment.non_core_presence_v_distance import filter_pav_by_dmn
 from tabulate import tabulate
 from great_tables import GT, style, loc
 from popcolors import pop_colors
+from scripts.sgsgeneloss.pav_store import load_pav
 
 # GO Terms to filter by:
 GO_TERMS = [
@@ -19,9 +20,10 @@ GO_TERMS = [
 ]
 
 # Read and transpose.
-pav_df = pd.read_csv("../../data/sgsgeneloss/pav_matrix.csv", header=0, index_col=0)
+pav = load_pav("../../data/sgsgeneloss/pav_matrix.csv")
+pav_df = pav.to_frame()
 dmnd_df = pd.read_csv("../../data/functional_annotation/noncore_go_merged_diamond_results_uniprot.csv", index_col=0)
-nc_pav_df = pav_df[(pav_df == 0).any(axis=1)]
+nc_pav_df = pav_df[~pav.core_mask()]
 nc_pav_df_t = nc_pav_df.T
 
 # Build summary table.
@@ -0,0 +1,175 @@
+# PAV heatmaps drawn as a single raster image, with genes and samples seriated straight from the packed bits.
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Mapping, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+from matplotlib.patches import Patch
+from scipy.cluster.hierarchy import leaves_list, linkage
+from scipy.spatial.distance import squareform
+
+from scripts.sgsgeneloss.pav_store import PackedPav, load_pav
+from scripts.sgsgeneloss.pav_similarity import GENE_BLOCK_SIZE
+from scripts.sgsgeneloss.pav_distance_cache import GeneFilter, condensed_distances, select_genes
+
+# GLOBALS
+HEATMAP_DPI = 200
+# Up to this many distinct gene patterns are clustered, larger sets are seriated lexicographically.
+GENE_CLUSTER_LIMIT = 4000
+# Optimal leaf ordering of the sample dendrogram is skipped for larger cohorts.
+OPTIMAL_ORDER_LIMIT = 1000
+# Axes with more entries than this get no tick labels.
+MAX_TICK_LABELS = 200
+
+
+@dataclass
+class HeatmapAxes:
+    """Axes of a PAV heatmap figure, for styling it after the fact."""
+    heatmap: plt.Axes
+    colorbar: plt.Axes
+    group_bar: Optional[plt.Axes] = None
+
+    @property
+    def title_axes(self) -> plt.Axes:
+        """The axes carrying the title, the group bar when there is one."""
+        return self.group_bar if self.group_bar is not None else self.heatmap
+
+
+def order_samples(pav: PackedPav, gene_filter: GeneFilter = "non_core",
+                  groups: Optional[pd.Series] = None) -> np.ndarray:
+    """Sample positions in average-linkage leaf order of the cached Hamming distances, kept together by group."""
+    condensed = condensed_distances(pav, "hamming", gene_filter)
+    order = leaves_list(linkage(condensed, "average", optimal_ordering=len(pav.samples) <= OPTIMAL_ORDER_LIMIT))
+    if groups is not None:
+        codes = pd.Categorical(groups.reindex(pav.samples)).codes
+        order = order[np.argsort(codes[order], kind="stable")]
+    return order
+
+
+def order_genes(pav: PackedPav, rows: np.ndarray, sample_order: np.ndarray,
+                max_patterns: int = GENE_CLUSTER_LIMIT) -> np.ndarray:
+    """Positions in `rows` that put genes with the same or similar presence pattern next to each other.
+
+    Genes are reduced to their distinct patterns first, so only those are ordered: by average linkage on
+    Hamming distance when there are at most `max_patterns`, otherwise lexicographically in sample order, which
+    nests genes sharing their presence in the leading samples into blocks.
+    """
+    n_samples = len(pav.samples)
+    width = -(-n_samples // 8)
+    patterns, inverse = np.unique(np.ascontiguousarray(pav.bits[rows, :width]), axis=0, return_inverse=True)
+    values = np.unpackbits(patterns, axis=1, count=n_samples)[:, sample_order]
+    rank = np.empty(len(patterns), dtype=np.int64)
+    if 2 < len(patterns) <= max_patterns:
+        x = values.astype(np.float32)
+        present = x.sum(axis=1)
+        dist = np.clip(present[:, None] + present[None, :] - 2 * (x @ x.T), 0, None) / n_samples
+        np.fill_diagonal(dist, 0)
+        rank[leaves_list(linkage(squareform(dist, checks=False), "average"))] = np.arange(len(patterns))
+    else:
+        keys = np.packbits(values, axis=1)
+        rank[np.lexsort(keys.T[::-1])] = np.arange(len(patterns))
+    return np.argsort(rank[inverse.ravel()], kind="stable")
+
+
+def pav_raster(pav: PackedPav, rows: np.ndarray, sample_order: np.ndarray, gene_bin: int = 1,
+               block_size: int = GENE_BLOCK_SIZE) -> np.ndarray:
+    """float32 image of the given gene rows x ordered samples, each image row the mean of `gene_bin` genes."""
+    step = max(block_size // gene_bin, 1) * gene_bin
+    image = []
+    for start in range(0, len(rows), step):
+        block = np.unpackbits(pav.bits[rows[start:start + step]], axis=1, count=len(pav.samples))[:, sample_order]
+        if gene_bin > 1:
+            starts = np.arange(0, len(block), gene_bin)
+            sizes = np.diff(np.append(starts, len(block)))
+            block = np.add.reduceat(block, starts, axis=0, dtype=np.float32) / sizes[:, None]
+        image.append(block.astype(np.float32))
+    return np.vstack(image) if image else np.zeros((0, len(sample_order)), dtype=np.float32)
+
+
+def plt_pav_heatmap(pav: Union[pd.DataFrame, PackedPav], sample_groups: Optional[pd.Series] = None,
+                    group_colors: Optional[Mapping[str, str]] = None,
+                    sample_colors: Optional[Mapping[str, str]] = None, gene_filter: GeneFilter = "non_core",
+                    cluster_genes: bool = True, cluster_samples: bool = True, max_gene_rows: Optional[int] = None,
+                    figsize: Tuple[float, float] = (12, 8), dpi: int = HEATMAP_DPI,
+                    cmap: Union[str, mcolors.Colormap] = "Greys",
+                    title: str = "PAV Heatmap of Non-Core genes.") -> Tuple[plt.Figure, HeatmapAxes]:
+    """Genes x samples PAV heatmap rendered as one image, with a colour bar of sample groups on top.
+
+    Samples are clustered on the cached distances (kept together by `sample_groups` if given) and genes are
+    seriated on their packed patterns; either can be switched off to keep the input order. When there are more
+    genes than `max_gene_rows` (by default the pixel height of the figure) consecutive genes are averaged into
+    one row, shown as the fraction present.
+    """
+    packed = pav if isinstance(pav, PackedPav) else PackedPav.from_frame(pav)
+    genes = select_genes(packed, gene_filter)
+    rows = packed.gene_rows(genes)
+    groups = None if sample_groups is None else sample_groups.reindex(packed.samples)
+
+    if cluster_samples:
+        sample_order = order_samples(packed, gene_filter, groups)
+    elif groups is not None:
+        sample_order = np.argsort(pd.Categorical(groups).codes, kind="stable")
+    else:
+        sample_order = np.arange(len(packed.samples))
+    if cluster_genes and len(rows):
+        rows = rows[order_genes(packed, rows, sample_order)]
+    max_gene_rows = max_gene_rows or int(figsize[1] * dpi)
+    gene_bin = max(-(-len(rows) // max_gene_rows), 1)
+    image = pav_raster(packed, rows, sample_order, gene_bin)
+
+    samples = packed.samples[sample_order]
+    if sample_colors is None and groups is not None:
+        palette = group_colors or {g: plt.cm.tab10.colors[i % 10] for i, g in enumerate(pd.unique(groups.dropna()))}
+        sample_colors = {s: palette.get(g, "white") for s, g in groups.items()}
+
+    fig = plt.figure(figsize=figsize, dpi=dpi)
+    grid = fig.add_gridspec(2, 2, height_ratios=[1, 30], width_ratios=[40, 1], hspace=0.02, wspace=0.02)
+    ax = fig.add_subplot(grid[1, 0])
+    im = ax.imshow(image, aspect="auto", interpolation="nearest", cmap=cmap, vmin=0, vmax=1)
+    axes = HeatmapAxes(heatmap=ax, colorbar=fig.add_subplot(grid[1, 1]))
+    cbar = fig.colorbar(im, cax=axes.colorbar)
+    if gene_bin == 1:
+        cbar.set_ticks([0.25, 0.75], labels=["Absent", "Present"])
+        cbar.set_label("Presence / Absence")
+    else:
+        cbar.set_label("Fraction present")
+
+    if sample_colors is not None:
+        bar = axes.group_bar = fig.add_subplot(grid[0, 0], sharex=ax)
+        bar.imshow([[mcolors.to_rgb(sample_colors.get(s, "white")) for s in samples]], aspect="auto",
+                   interpolation="nearest")
+        bar.axis("off")
+        bar.set_title(title)
+    else:
+        ax.set_title(title)
+    if groups is not None and group_colors is not None:
+        handles = [Patch(color=color, label=group) for group, color in group_colors.items() if group in set(groups)]
+        fig.legend(handles=handles, loc="lower center", ncol=min(len(handles), 6), frameon=False)
+
+    if len(samples) <= MAX_TICK_LABELS:
+        ax.set_xticks(np.arange(len(samples)), labels=samples, rotation=90, fontsize=6)
+        for label in ax.get_xticklabels():
+            label.set_color((sample_colors or {}).get(label.get_text(), "black"))
+    else:
+        ax.set_xticks([])
+    if gene_bin == 1 and len(rows) <= MAX_TICK_LABELS:
+        ax.set_yticks(np.arange(len(rows)), labels=packed.genes[rows], fontsize=6)
+        ax.set_ylabel("Genes")
+    else:
+        ax.set_yticks([])
+        ax.set_ylabel(f"{len(rows)} genes" + (f" ({gene_bin} per row)" if gene_bin > 1 else ""))
+    ax.set_xlabel("Samples")
+    return fig, axes
+
+
+if __name__ == "__main__":
+    from scripts.sgsgeneloss.popcolors import island_colors
+    pav = load_pav(Path("../../data/sgsgeneloss/pav_matrix.csv"))
+    meta_df = pd.read_excel("../../metadata/raw_sample_metadata.xlsx", index_col=0, sheet_name="S1 Sample Overview")
+    islands = meta_df["Island"].rename(index=lambda s: f"{s}_merged_all")
+    fig, _ = plt_pav_heatmap(pav, islands, island_colors)
+    fig.savefig("../../data/sgsgeneloss/non_core_heatmap.png")
+    fig, _ = plt_pav_heatmap(pav, islands, island_colors, gene_filter="all", title="PAV Heatmap of all genes.")
+    fig.savefig("../../data/sgsgeneloss/pangenome_heatmap.png")
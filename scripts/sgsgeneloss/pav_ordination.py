@@ -0,0 +1,141 @@
+# Sample ordinations of PAV matrices: randomized PCA streamed from the packed bits and PCoA of the cached distances.
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+from scipy.sparse.linalg import eigsh
+
+from scripts.sgsgeneloss.pav_store import PackedPav, load_pav
+from scripts.sgsgeneloss.pav_similarity import GENE_BLOCK_SIZE
+from scripts.sgsgeneloss.pav_distance_cache import PAV_DISTANCE_CACHE_DIR, GeneFilter, distance_frame
+
+# GLOBALS
+# Extra random directions and power iterations of the randomized SVD (Halko et al. 2011 defaults).
+N_OVERSAMPLES = 10
+N_POWER_ITER = 4
+# Above this many samples PCoA only extracts the leading eigenpairs instead of the full eigendecomposition.
+PCOA_DENSE_LIMIT = 2000
+
+
+@dataclass
+class Ordination:
+    """Sample coordinates, the fraction of total variance per axis and, for PCA, the gene loadings per axis."""
+    coordinates: pd.DataFrame
+    explained: pd.Series
+    loadings: Optional[pd.DataFrame] = None
+
+    def axis_labels(self) -> Dict[str, str]:
+        """Axis name -> "PC1 (12.34%)" style label for plots."""
+        return {axis: f"{axis} ({100 * ratio:.2f}%)" for axis, ratio in self.explained.items()}
+
+    def top_loadings(self, axis: str, n: int = 20) -> pd.Series:
+        """The `n` genes with the largest absolute loading on one axis, signed."""
+        if self.loadings is None:
+            raise ValueError("This ordination has no gene loadings.")
+        column = self.loadings[axis]
+        return column.loc[column.abs().nlargest(n).index]
+
+
+def variable_rows(pav: PackedPav) -> np.ndarray:
+    """Row numbers of genes present in some but not all samples, the only genes with any variance."""
+    counts = pav.gene_counts().to_numpy()
+    return np.flatnonzero((counts > 0) & (counts < len(pav.samples)))
+
+
+def _centred_blocks(pav: PackedPav, rows: np.ndarray, means: np.ndarray,
+                    block_size: int) -> Iterator[Tuple[slice, np.ndarray]]:
+    """Yields (position in `rows`, float64 genes x samples block minus each gene's mean)."""
+    for start in range(0, len(rows), block_size):
+        span = slice(start, start + block_size)
+        block = np.unpackbits(pav.bits[rows[span]], axis=1, count=len(pav.samples)).astype(np.float64)
+        yield span, block - means[span, None]
+
+
+def _sign_flip(u: np.ndarray, vt: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Makes the largest absolute entry of each sample vector positive, as sklearn does, for stable axes."""
+    signs = np.sign(u[np.abs(u).argmax(axis=0), np.arange(u.shape[1])])
+    signs[signs == 0] = 1
+    return u * signs, vt * signs[:, None]
+
+
+def randomized_pca(pav: Union[pd.DataFrame, PackedPav], n_components: int = 2, n_oversamples: int = N_OVERSAMPLES,
+                   n_iter: int = N_POWER_ITER, seed: int = 0, block_size: int = GENE_BLOCK_SIZE) -> Ordination:
+    """PCA of samples over variable genes by randomized SVD, streaming gene blocks from the packed matrix.
+
+    The samples x genes matrix is never formed: each pass unpacks `block_size` variable genes at a time and
+    accumulates the products with the current basis, so memory is the basis (samples and variable genes x
+    n_components + n_oversamples) plus one block. Explained variance ratios are relative to the exact total
+    variance, which follows from the gene counts alone.
+    """
+    packed = pav if isinstance(pav, PackedPav) else PackedPav.from_frame(pav)
+    n_samples = len(packed.samples)
+    rows = variable_rows(packed)
+    counts = packed.gene_counts().to_numpy()[rows].astype(np.float64)
+    means = counts / n_samples
+    total_variance = (counts * (n_samples - counts) / n_samples).sum() / (n_samples - 1)
+    rank = min(n_components + n_oversamples, n_samples, len(rows))
+
+    def times(basis: np.ndarray) -> np.ndarray:
+        """Centred samples x genes matrix times a genes x rank basis."""
+        out = np.zeros((n_samples, basis.shape[1]))
+        for span, block in _centred_blocks(packed, rows, means, block_size):
+            out += block.T @ basis[span]
+        return out
+
+    def transpose_times(basis: np.ndarray) -> np.ndarray:
+        """Transposed centred matrix times a samples x rank basis."""
+        out = np.empty((len(rows), basis.shape[1]))
+        for span, block in _centred_blocks(packed, rows, means, block_size):
+            out[span] = block @ basis
+        return out
+
+    rng = np.random.default_rng(seed)
+    q, _ = np.linalg.qr(times(rng.standard_normal((len(rows), rank))))
+    for _ in range(n_iter):
+        z, _ = np.linalg.qr(transpose_times(q))
+        q, _ = np.linalg.qr(times(z))
+    u_small, s, vt = np.linalg.svd(transpose_times(q).T, full_matrices=False)
+    u, vt = _sign_flip(q @ u_small[:, :n_components], vt[:n_components])
+
+    axes = [f"PC{i + 1}" for i in range(u.shape[1])]
+    return Ordination(
+        coordinates=pd.DataFrame(u * s[:n_components], index=packed.samples, columns=axes),
+        explained=pd.Series(s[:n_components] ** 2 / (n_samples - 1) / total_variance, index=axes, name="explained"),
+        loadings=pd.DataFrame(vt.T, index=packed.genes[rows], columns=axes),
+    )
+
+
+def pcoa(pav: Union[pd.DataFrame, PackedPav], metric: str = "hamming", gene_filter: GeneFilter = "all",
+         n_components: int = 2, cache_dir: Optional[Path] = PAV_DISTANCE_CACHE_DIR) -> Ordination:
+    """Classical (Gower) PCoA of the cached sample distances.
+
+    Explained fractions are relative to the trace of the centred matrix, i.e. the sum of all eigenvalues,
+    negative ones included for non-Euclidean distances.
+    """
+    dist = distance_frame(pav, metric, gene_filter, cache_dir)
+    centred = -0.5 * dist.to_numpy() ** 2
+    centred -= centred.mean(axis=0, keepdims=True)
+    centred -= centred.mean(axis=1, keepdims=True)
+    if len(centred) > PCOA_DENSE_LIMIT:
+        eigvals, eigvecs = eigsh(centred, k=n_components, which="LA")
+    else:
+        eigvals, eigvecs = np.linalg.eigh(centred)
+    order = np.argsort(eigvals)[::-1][:n_components]
+    eigvals, eigvecs = np.clip(eigvals[order], 0, None), eigvecs[:, order]
+    eigvecs, _ = _sign_flip(eigvecs, np.zeros((n_components, 0)))
+
+    axes = [f"PCo{i + 1}" for i in range(n_components)]
+    return Ordination(
+        coordinates=pd.DataFrame(eigvecs * np.sqrt(eigvals), index=dist.index, columns=axes),
+        explained=pd.Series(eigvals / max(np.trace(centred), np.finfo(float).tiny), index=axes, name="explained"),
+    )
+
+
+if __name__ == "__main__":
+    pav = load_pav(Path("../../data/sgsgeneloss/pav_matrix.csv"))
+    pca = randomized_pca(pav)
+    print(pca.explained)
+    print(pca.top_loadings("PC1"))
+    for metric in ("hamming", "jaccard"):
+        print(pcoa(pav, metric, gene_filter="non_core").explained)
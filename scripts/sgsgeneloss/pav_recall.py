@@ -0,0 +1,159 @@
+# Re-calls presence/absence from excov coverage metrics over a grid of (min covered fraction, min depth) thresholds.
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+
+from scripts.sgsgeneloss.excov_dataset import (COVERED_LENGTH_COL, DEFAULT_MIN_FRACTION, DEPTH_COL, EXON_LENGTH_COL,
+                                               assemble_sample_matrices, find_excov_files)
+
+# GLOBALS
+# Optional per-gene covered exon fraction column, derived from the exon lengths when an excov does not carry it.
+FRACTION_COL = "exon_cov_fraction"
+
+
+@dataclass
+class PavThresholdGrid:
+    """PAV calls for every (min fraction, min depth) pair, stored as the number of threshold levels each gene x
+    sample passes on both axes.
+
+    A gene is present at grid cell (i, j) when its covered fraction reaches fraction_levels[i] and its mean depth
+    reaches depth_levels[j], i.e. when fraction_passed > i and depth_passed > j. Every PAV matrix of the grid can be
+    read off these two uint8 arrays without touching the coverage again.
+    """
+    fraction_levels: np.ndarray
+    depth_levels: np.ndarray
+    fraction_passed: np.ndarray
+    depth_passed: np.ndarray
+    genes: pd.Index
+    samples: pd.Index
+
+    def _cell(self, min_fraction: float, min_depth: float) -> Tuple[int, int]:
+        i = np.flatnonzero(np.isclose(self.fraction_levels, min_fraction))
+        j = np.flatnonzero(np.isclose(self.depth_levels, min_depth))
+        if not len(i) or not len(j):
+            raise KeyError(f"({min_fraction}, {min_depth}) is not on the threshold grid.")
+        return int(i[0]), int(j[0])
+
+    def pav(self, min_fraction: float, min_depth: float) -> pd.DataFrame:
+        """int8 genes x samples PAV matrix at one grid point."""
+        i, j = self._cell(min_fraction, min_depth)
+        present = (self.fraction_passed > i) & (self.depth_passed > j)
+        return pd.DataFrame(present.view(np.int8), index=self.genes, columns=self.samples)
+
+    def sample_present_counts(self) -> np.ndarray:
+        """(fraction levels x depth levels x samples) number of present genes, from one 2D histogram per sample."""
+        n_f, n_d = len(self.fraction_levels) + 1, len(self.depth_levels) + 1
+        codes = self.fraction_passed.astype(np.int64) * n_d + self.depth_passed
+        counts = np.empty((n_f, n_d, len(self.samples)), dtype=np.int64)
+        for s in range(len(self.samples)):
+            counts[:, :, s] = np.bincount(codes[:, s], minlength=n_f * n_d).reshape(n_f, n_d)
+        # Present at (i, j) means passed > i and > j, a suffix sum over both axes.
+        counts = counts[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+        return counts[1:, 1:]
+
+    def core_counts(self) -> np.ndarray:
+        """(fraction levels x depth levels) number of genes present in every sample.
+
+        A gene is present everywhere at (i, j) exactly when its smallest fraction level and smallest depth level
+        across samples both pass, so one histogram of the per-gene minima covers the whole grid.
+        """
+        n_f, n_d = len(self.fraction_levels) + 1, len(self.depth_levels) + 1
+        codes = self.fraction_passed.min(axis=1).astype(np.int64) * n_d + self.depth_passed.min(axis=1)
+        counts = np.bincount(codes, minlength=n_f * n_d).reshape(n_f, n_d)
+        counts = counts[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+        return counts[1:, 1:]
+
+    def summary(self) -> pd.DataFrame:
+        """One row per grid point with core and non-core gene counts and the spread of per-sample losses."""
+        core = self.core_counts()
+        losses = len(self.genes) - self.sample_present_counts()
+        fi, dj = np.meshgrid(np.arange(len(self.fraction_levels)), np.arange(len(self.depth_levels)), indexing="ij")
+        return pd.DataFrame({
+            "min_fraction": self.fraction_levels[fi.ravel()],
+            "min_depth": self.depth_levels[dj.ravel()],
+            "n_core": core.ravel(),
+            "n_non_core": (len(self.genes) - core).ravel(),
+            "mean_sample_losses": losses.mean(axis=2).ravel(),
+            "min_sample_losses": losses.min(axis=2).ravel(),
+            "max_sample_losses": losses.max(axis=2).ravel(),
+        })
+
+    def sample_losses(self) -> pd.DataFrame:
+        """Long table of lost-gene counts per sample at every grid point."""
+        losses = len(self.genes) - self.sample_present_counts()
+        fi, dj, s = np.meshgrid(np.arange(len(self.fraction_levels)), np.arange(len(self.depth_levels)),
+                                np.arange(len(self.samples)), indexing="ij")
+        return pd.DataFrame({
+            "min_fraction": self.fraction_levels[fi.ravel()],
+            "min_depth": self.depth_levels[dj.ravel()],
+            "sample": self.samples[s.ravel()],
+            "n_lost": losses.ravel(),
+        })
+
+
+def recall_threshold_grid(fraction_df: pd.DataFrame, depth_df: pd.DataFrame, min_fractions: Sequence[float],
+                          min_depths: Sequence[float]) -> PavThresholdGrid:
+    """Calls presence for every (min fraction, min depth) pair in one pass with two searchsorted calls.
+
+    `fraction_df` and `depth_df` are genes x samples tables of covered exon fraction and mean depth on the same
+    index, e.g. from load_coverage_metrics.
+    """
+    if not (fraction_df.index.equals(depth_df.index) and fraction_df.columns.equals(depth_df.columns)):
+        raise ValueError("Fraction and depth tables must share genes and samples.")
+    fraction_levels = np.unique(np.asarray(min_fractions, dtype=float))
+    depth_levels = np.unique(np.asarray(min_depths, dtype=float))
+    if max(len(fraction_levels), len(depth_levels)) > 254:
+        raise ValueError("At most 254 levels per threshold axis are supported.")
+
+    # Number of levels each value reaches (level <= value), so presence at level i is passed > i.
+    fraction_passed = np.searchsorted(fraction_levels, fraction_df.to_numpy(dtype=float), side="right")
+    depth_passed = np.searchsorted(depth_levels, depth_df.to_numpy(dtype=float), side="right")
+    return PavThresholdGrid(
+        fraction_levels=fraction_levels,
+        depth_levels=depth_levels,
+        fraction_passed=fraction_passed.astype(np.uint8),
+        depth_passed=depth_passed.astype(np.uint8),
+        genes=fraction_df.index,
+        samples=fraction_df.columns,
+    )
+
+
+def load_coverage_metrics(infolder: Union[str, Path], fraction_col: str = FRACTION_COL, depth_col: str = DEPTH_COL,
+                          n_jobs: Optional[int] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Genes x samples covered fraction and mean depth tables from one read of each merged .excov file.
+
+    Excovs without `fraction_col` get the fraction as covered_exon_length / exon_length (0 for genes without
+    exons). The first file's header decides which columns are read; a ValueError lists its columns when neither
+    form of the fraction (or the depth column) is there.
+    """
+    excov_files = find_excov_files(infolder)
+    header = pd.read_csv(excov_files[0], nrows=0).columns
+    if fraction_col in header:
+        value_cols = [fraction_col, depth_col]
+    else:
+        value_cols = [EXON_LENGTH_COL, COVERED_LENGTH_COL, depth_col]
+    missing = [col for col in value_cols if col not in header]
+    if missing:
+        raise ValueError(f"{excov_files[0].name} has no column(s) {missing}, available columns: {list(header)}")
+
+    matrices = assemble_sample_matrices(excov_files, value_cols, n_jobs=n_jobs)
+    if fraction_col in matrices:
+        return matrices[fraction_col], matrices[depth_col]
+    exon_length = matrices[EXON_LENGTH_COL]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(exon_length > 0, matrices[COVERED_LENGTH_COL] / exon_length, 0.0)
+    return pd.DataFrame(fraction, index=exon_length.index, columns=exon_length.columns), matrices[depth_col]
+
+
+if __name__ == "__main__":
+    DATA_FOLDER = Path("../../data/sgsgeneloss")
+    fraction_df, depth_df = load_coverage_metrics(DATA_FOLDER / "SGSGL_results")
+
+    grid = recall_threshold_grid(fraction_df, depth_df, min_fractions=np.round(np.arange(0.05, 1.0, 0.05), 2),
+                                 min_depths=[0, 1, 2, 3, 5, 10])
+    grid.summary().to_csv(DATA_FOLDER / "pav_threshold_grid_summary.csv", index=False)
+    grid.sample_losses().to_csv(DATA_FOLDER / "pav_threshold_grid_sample_losses.csv", index=False)
+    summary_df = grid.summary()
+    print(summary_df[np.isclose(summary_df["min_fraction"], DEFAULT_MIN_FRACTION)])
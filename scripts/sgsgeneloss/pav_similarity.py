@@ -0,0 +1,99 @@
+# All-pairs sample similarity / distance on PAV matrices from blocked matrix products on 0/1 arrays.
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+
+from scripts.sgsgeneloss.pav_store import PackedPav, load_pav
+
+# GLOBALS
+SIMILARITY_METRICS = ("matching", "jaccard")
+DISTANCE_METRICS = ("hamming", "jaccard")
+# Genes unpacked per block, float32 products stay exact far beyond this (up to 2**24 genes).
+GENE_BLOCK_SIZE = 8192
+
+
+def _gene_blocks(pav: Union[pd.DataFrame, PackedPav], genes: Optional[Sequence[str]], block_size: int):
+    """Yields float32 (genes x samples) 0/1 blocks of the selected genes."""
+    if isinstance(pav, PackedPav):
+        rows = pav.gene_rows(genes)
+        for start in range(0, len(rows), block_size):
+            block = np.unpackbits(pav.bits[rows[start:start + block_size]], axis=1, count=len(pav.samples))
+            yield block.astype(np.float32)
+    else:
+        values = pav.to_numpy() if genes is None else pav.loc[genes].to_numpy()
+        for start in range(0, len(values), block_size):
+            yield (values[start:start + block_size] != 0).astype(np.float32)
+
+
+def pair_counts(pav: Union[pd.DataFrame, PackedPav], genes: Optional[Sequence[str]] = None,
+                block_size: int = GENE_BLOCK_SIZE) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Per sample pair number of genes present in both and of genes present in only one, plus the gene count.
+
+    Accumulates X.T @ X over blocks of `block_size` genes, so only one block is ever unpacked. The mismatch
+    count follows from the per-sample totals: n_i + n_j - 2 * both.
+    """
+    n_samples = pav.shape[1]
+    both = np.zeros((n_samples, n_samples), dtype=np.float64)
+    present = np.zeros(n_samples, dtype=np.float64)
+    n_genes = 0
+    for block in _gene_blocks(pav, genes, block_size):
+        both += block.T @ block
+        present += block.sum(axis=0, dtype=np.float64)
+        n_genes += len(block)
+    mismatch = present[:, None] + present[None, :] - 2 * both
+    return both.astype(np.int64), mismatch.astype(np.int64), n_genes
+
+
+def _samples(pav: Union[pd.DataFrame, PackedPav]) -> pd.Index:
+    return pav.samples if isinstance(pav, PackedPav) else pav.columns
+
+
+def pairwise_similarity(pav: Union[pd.DataFrame, PackedPav], metric: str = "matching",
+                        genes: Optional[Sequence[str]] = None, block_size: int = GENE_BLOCK_SIZE) -> pd.DataFrame:
+    """Samples x samples similarity of a genes x samples PAV matrix (DataFrame or packed), optionally on a gene subset.
+
+    matching: fraction of genes with the same call (1 - Hamming distance).
+    jaccard: genes present in both / genes present in either (1 for two empty samples).
+    """
+    if metric not in SIMILARITY_METRICS:
+        raise ValueError(f"Unknown similarity metric {metric!r}, expected one of {SIMILARITY_METRICS}.")
+    both, mismatch, n_genes = pair_counts(pav, genes, block_size)
+    if metric == "matching":
+        values = 1 - mismatch / max(n_genes, 1)
+    else:
+        union = both + mismatch
+        values = np.divide(both, union, out=np.ones(both.shape), where=union > 0)
+    samples = _samples(pav)
+    return pd.DataFrame(values, index=samples, columns=samples)
+
+
+def pairwise_distance(pav: Union[pd.DataFrame, PackedPav], metric: str = "hamming",
+                      genes: Optional[Sequence[str]] = None, block_size: int = GENE_BLOCK_SIZE) -> pd.DataFrame:
+    """Samples x samples distance matching scipy's pdist 'hamming' (fraction of differing genes) and 'jaccard'."""
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(f"Unknown distance metric {metric!r}, expected one of {DISTANCE_METRICS}.")
+    both, mismatch, n_genes = pair_counts(pav, genes, block_size)
+    if metric == "hamming":
+        values = mismatch / max(n_genes, 1)
+    else:
+        union = both + mismatch
+        values = np.divide(mismatch, union, out=np.zeros(both.shape), where=union > 0)
+    samples = _samples(pav)
+    return pd.DataFrame(values, index=samples, columns=samples)
+
+
+def nearest_partners(similarity: pd.DataFrame) -> np.ndarray:
+    """Column position of each row's most similar other sample (first one on ties, like idxmax)."""
+    values = similarity.to_numpy(dtype=float, copy=True)
+    rows = np.arange(len(values))
+    values[rows, similarity.columns.get_indexer(similarity.index)] = -np.inf
+    return values.argmax(axis=1)
+
+
+if __name__ == "__main__":
+    DATA_FOLDER = Path("../../data/sgsgeneloss")
+    pav = load_pav(DATA_FOLDER / "pav_matrix.csv")
+    similarity = pairwise_similarity(pav, "matching", genes=pav.genes[~pav.core_mask()])
+    partners = nearest_partners(similarity)
+    print(pd.Series(similarity.columns[partners], index=similarity.index, name="nearest_partner"))
@@ -0,0 +1,235 @@
+# Bit-packed, memory-mapped storage for gene x sample presence/absence (PAV) matrices.
+import hashlib
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Sequence, Union
+import numpy as np
+import pandas as pd
+
+# GLOBALS
+PAV_STORE_VERSION = 1
+PAV_STORE_SUFFIX = ".pav"
+BITS_FILE = "pav.bits"
+GENES_FILE = "genes.parquet"
+MANIFEST_FILE = "manifest.json"
+# Set bits per byte value, used for popcounts over packed rows.
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+@dataclass
+class PackedPav:
+    """Gene x sample PAV matrix with each gene's row packed to bits (np.packbits, big-endian within a byte).
+
+    `bits` is a (genes x row_bytes) uint8 array, memory-mapped when opened from disk, and may hold spare bytes for
+    samples appended later. Bits past the last sample are always 0, so byte-wise popcounts can be summed directly.
+    """
+    bits: np.ndarray
+    genes: pd.Index
+    samples: pd.Index
+    path: Optional[Path] = None
+
+    @property
+    def shape(self):
+        return len(self.genes), len(self.samples)
+
+    def __len__(self) -> int:
+        return len(self.genes)
+
+    @classmethod
+    def from_frame(cls, pav_df: pd.DataFrame) -> "PackedPav":
+        """Packs a 0/1 genes x samples DataFrame."""
+        bits = np.packbits(pav_df.to_numpy() != 0, axis=1)
+        return cls(bits=bits, genes=pd.Index(pav_df.index, name=pav_df.index.name or "ID"),
+                   samples=pd.Index(pav_df.columns))
+
+    def gene_rows(self, genes: Optional[Sequence[str]]) -> np.ndarray:
+        """Row positions of `genes` in the packed bits (every row for None), raising a KeyError for unknown IDs."""
+        if genes is None:
+            return np.arange(len(self.genes))
+        rows = self.genes.get_indexer(genes)
+        if (rows < 0).any():
+            raise KeyError(f"{(rows < 0).sum()} genes are not in the PAV matrix.")
+        return rows
+
+    def _sample_cols(self, samples: Optional[Sequence[str]]) -> np.ndarray:
+        if samples is None:
+            return np.arange(len(self.samples))
+        cols = self.samples.get_indexer(samples)
+        if (cols < 0).any():
+            raise KeyError(f"{(cols < 0).sum()} samples are not in the PAV matrix.")
+        return cols
+
+    def to_numpy(self, genes: Optional[Sequence[str]] = None, samples: Optional[Sequence[str]] = None) -> np.ndarray:
+        """Unpacks the selected genes and samples (all by default) into an int8 0/1 array."""
+        rows = self.gene_rows(genes)
+        cols = self._sample_cols(samples)
+        unpacked = np.unpackbits(self.bits[rows], axis=1, count=len(self.samples)).view(np.int8)
+        return unpacked if samples is None else unpacked[:, cols]
+
+    def to_frame(self, genes: Optional[Sequence[str]] = None, samples: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Unpacks the selected genes and samples (all by default) into an int8 genes x samples DataFrame."""
+        rows = self.gene_rows(genes)
+        cols = self._sample_cols(samples)
+        return pd.DataFrame(self.to_numpy(genes, samples), index=self.genes[rows], columns=self.samples[cols])
+
+    def gene_counts(self) -> pd.Series:
+        """Number of samples each gene is present in."""
+        counts = POPCOUNT_TABLE[self.bits].sum(axis=1, dtype=np.int64)
+        return pd.Series(counts, index=self.genes, name="n_present")
+
+    def sample_counts(self, chunk_size: int = 8192) -> pd.Series:
+        """Number of present genes per sample, unpacking a chunk of genes at a time."""
+        counts = np.zeros(len(self.samples), dtype=np.int64)
+        for start in range(0, len(self.genes), chunk_size):
+            chunk = np.unpackbits(self.bits[start:start + chunk_size], axis=1, count=len(self.samples))
+            counts += chunk.sum(axis=0, dtype=np.int64)
+        return pd.Series(counts, index=self.samples, name="n_present")
+
+    def core_mask(self) -> np.ndarray:
+        """Boolean mask of genes present in every sample."""
+        return self.gene_counts().to_numpy() == len(self.samples)
+
+    def content_hash(self, samples: Optional[Sequence[str]] = None) -> str:
+        """sha1 of the packed bits plus gene and sample IDs, used as a cache key by downstream analyses.
+
+        `samples` replaces the stored sample IDs in the hash, e.g. to hash canonical names of relabelled columns.
+        """
+        digest = hashlib.sha1()
+        digest.update("\n".join(map(str, self.genes)).encode())
+        digest.update(b"\0")
+        digest.update("\n".join(map(str, self.samples if samples is None else samples)).encode())
+        # Spare sample capacity is left out so the hash only depends on the matrix.
+        digest.update(np.ascontiguousarray(self.bits[:, :-(-len(self.samples) // 8)]).tobytes())
+        return digest.hexdigest()
+
+
+def _write_manifest(store_path: Path, genes: pd.Index, samples: Sequence[str], row_bytes: int) -> None:
+    """Writes the gene IDs and the manifest of a packed store."""
+    genes.to_frame(index=False, name="ID").to_parquet(store_path / GENES_FILE, index=False)
+    manifest = {
+        "format_version": PAV_STORE_VERSION,
+        "n_genes": len(genes),
+        "n_samples": len(samples),
+        "row_bytes": int(row_bytes),
+        "samples": [str(s) for s in samples],
+    }
+    (store_path / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+
+
+def write_packed_pav(pav: Union[pd.DataFrame, PackedPav], outdir: Union[str, Path],
+                     sample_capacity: Optional[int] = None) -> Path:
+    """Writes a PAV matrix as a packed store: raw bits, gene IDs (Parquet) and a JSON manifest with the samples.
+
+    Rows are padded to hold `sample_capacity` samples so append_samples can add samples without a rewrite.
+    """
+    packed = pav if isinstance(pav, PackedPav) else PackedPav.from_frame(pav)
+    outdir_path = Path(outdir)
+    outdir_path.mkdir(parents=True, exist_ok=True)
+
+    row_bytes = max(packed.bits.shape[1], -(-(sample_capacity or 0) // 8))
+    bits = np.zeros((len(packed.genes), row_bytes), dtype=np.uint8)
+    bits[:, :packed.bits.shape[1]] = packed.bits
+    bits.tofile(outdir_path / BITS_FILE)
+    _write_manifest(outdir_path, packed.genes, packed.samples, row_bytes)
+    return outdir_path
+
+
+def open_packed_pav(store_dir: Union[str, Path], mode: str = "r") -> PackedPav:
+    """Memory-maps a packed PAV store, only the gene IDs and manifest are read up front."""
+    store_path = Path(store_dir)
+    manifest = json.loads((store_path / MANIFEST_FILE).read_text())
+    if manifest["format_version"] != PAV_STORE_VERSION:
+        raise ValueError(f"Unsupported PAV store version {manifest['format_version']} in {store_path}")
+
+    genes = pd.Index(pd.read_parquet(store_path / GENES_FILE)["ID"], name="ID")
+    if len(genes) != manifest["n_genes"]:
+        raise ValueError(f"Gene list in {store_path} does not match its manifest.")
+
+    shape = (manifest["n_genes"], manifest["row_bytes"])
+    if shape[0] == 0:
+        bits = np.zeros(shape, dtype=np.uint8)
+    else:
+        bits = np.memmap(store_path / BITS_FILE, dtype=np.uint8, mode=mode, shape=shape)
+    return PackedPav(bits=bits, genes=genes, samples=pd.Index(manifest["samples"]), path=store_path)
+
+
+def append_samples(store_dir: Union[str, Path], new_pav_df: pd.DataFrame) -> PackedPav:
+    """Adds sample columns to a packed store in place, in time proportional to the new samples.
+
+    Genes not yet in the store are appended as new rows (absent in every existing sample), and existing genes the
+    new samples lack are recorded as absent. Sample slots come from the spare row capacity; once that runs out the
+    rows are widened to double the capacity, so repeated appends stay cheap on average.
+    """
+    store_path = Path(store_dir)
+    manifest = json.loads((store_path / MANIFEST_FILE).read_text())
+    old_samples = manifest["samples"]
+    duplicated = set(old_samples).intersection(map(str, new_pav_df.columns))
+    if duplicated:
+        raise ValueError(f"Samples already in {store_path}: {sorted(duplicated)}")
+
+    genes = pd.Index(pd.read_parquet(store_path / GENES_FILE)["ID"], name="ID")
+    new_genes = new_pav_df.index.difference(genes)
+    all_genes = genes.append(pd.Index(new_genes, name="ID"))
+    n_old, n_total = len(old_samples), len(old_samples) + new_pav_df.shape[1]
+    row_bytes = manifest["row_bytes"]
+    bits_file = store_path / BITS_FILE
+
+    if -(-n_total // 8) > row_bytes:
+        # Out of spare capacity, rewrite once with twice the row width.
+        old = np.fromfile(bits_file, dtype=np.uint8).reshape(len(genes), row_bytes)
+        row_bytes = max(-(-n_total // 8), 2 * row_bytes)
+        widened = np.zeros((len(all_genes), row_bytes), dtype=np.uint8)
+        widened[:len(genes), :old.shape[1]] = old
+        widened.tofile(bits_file)
+    elif len(new_genes):
+        with bits_file.open("ab") as f:
+            f.write(bytes(len(new_genes) * row_bytes))
+
+    if len(all_genes) and n_total > n_old:
+        # Only the bytes holding the new sample bits are unpacked, edited and repacked.
+        bits = np.memmap(bits_file, dtype=np.uint8, mode="r+", shape=(len(all_genes), row_bytes))
+        first_byte, last_byte = n_old // 8, -(-n_total // 8)
+        block = np.unpackbits(bits[:, first_byte:last_byte], axis=1)
+        offset = n_old - first_byte * 8
+        rows = all_genes.get_indexer(new_pav_df.index)
+        block[:, offset:offset + new_pav_df.shape[1]] = 0
+        block[rows, offset:offset + new_pav_df.shape[1]] = new_pav_df.to_numpy() != 0
+        bits[:, first_byte:last_byte] = np.packbits(block, axis=1)
+        bits.flush()
+        del bits
+
+    _write_manifest(store_path, all_genes, [*old_samples, *map(str, new_pav_df.columns)], row_bytes)
+    return open_packed_pav(store_path)
+
+
+def load_pav(path: Union[str, Path]) -> PackedPav:
+    """Opens a PAV matrix as packed bits from either a packed store or a pav_matrix.csv.
+
+    For a CSV the packed store next to it (pav_matrix.pav/) is used when it is newer than the CSV, otherwise the
+    CSV is parsed once and packed there, so later opens skip the CSV entirely.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return open_packed_pav(path)
+
+    store_path = path.with_suffix(PAV_STORE_SUFFIX)
+    if (store_path / MANIFEST_FILE).exists() and (store_path / MANIFEST_FILE).stat().st_mtime >= path.stat().st_mtime:
+        return open_packed_pav(store_path)
+
+    pav_df = pd.read_csv(path, index_col=0, engine="pyarrow")
+    write_packed_pav(pav_df, store_path)
+    return open_packed_pav(store_path)
+
+
+def load_pav_df(path: Union[str, Path], genes: Optional[Sequence[str]] = None,
+                samples: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """Drop-in for pd.read_csv(pav_matrix.csv, index_col=0), returning int8 genes x samples via load_pav."""
+    return load_pav(path).to_frame(genes=genes, samples=samples)
+
+
+if __name__ == "__main__":
+    # Pack the main PAV matrix once so every analysis script opens it instantly.
+    packed = load_pav(Path("../../data/sgsgeneloss/pav_matrix.csv"))
+    print(f"Packed PAV store {packed.path}: {packed.shape[0]} genes x {packed.shape[1]} samples, "
+          f"{packed.core_mask().sum()} core genes.")
@@ -1,13 +1,24 @@
+import warnings
 from pathlib import Path
 from pickle import FALSE
-from typing import List, Optional
-from sklearn.decomposition import PCA
+from typing import List, Optional, Tuple
 import pandas as pd
 import plotly.io as pio
 import plotly.graph_objs as go
 import plotly.express as px
 import random
 from tabulate import tabulate
+from scripts.sgsgeneloss.excov_dataset import load_gene_positions
+from scripts.sgsgeneloss.coverage_store import CoverageStore, load_coverage, reads_mapped_size_factors
+from scripts.sgsgeneloss.pav_store import load_pav_df
+from scripts.sgsgeneloss.pav_ordination import randomized_pca
+from scripts.sgsgeneloss.parallel import map_in_pool
+
+# GLOBALS
+STATS_FILE_PATTERN = "*stats.txt"
+# Metrics the report plots rely on, a stats file without them is skipped.
+STATS_REQUIRED_KEYS = ["Total_number_of_genes", "Total_number_of_genes_lost"]
+STATS_CACHE_KEYS = ["file", "mtime_ns", "size"]
 
 # Format.
 def find_all_files(folder_path: Path, file_type: str) -> List[Path]:
@@ -18,29 +29,83 @@ def find_all_files(folder_path: Path, file_type: str) -> List[Path]:
     files = list(root.rglob(f"*{file_type}"))
     return files
 
+def find_stats_files(folder_path: Path, pattern: str = STATS_FILE_PATTERN) -> List[Path]:
+    """Sorted SGSGeneLoss <sample>stats.txt files under a results folder (other .txt outputs are skipped)."""
+    return sorted(folder_path.rglob(pattern))
+
 def parse_stat_file(file:Path) -> dict:
-    """Parses the stats.txt output from SGSGeneLoss into a Python dictionary for a single <sample>stats.txt file."""
+    """Parses the stats.txt output from SGSGeneLoss into a Python dictionary for a single <sample>stats.txt file.
+
+    Lines are matched on their "key: value" form rather than their position, so reordered or extra lines are fine.
+    Numeric values are kept (rounded to 3 dp), the BAM line gives the sample_id.
+    """
     result = {}
+    with file.open() as f:
+        for line in f:
+            key, sep, value = line.partition(":")
+            value = value.strip()
+            if not sep or not value:
+                continue
+
+            # Parse bam file name.
+            if "sample_id" not in result and value.endswith(".bam"):
+                result["sample_id"] = value.split("_sorted.bam")[0]
+                continue
+
+            # Parse other metrics.
+            try:
+                result[key.strip().replace(" ", "_")] = round(float(value), 3)
+            except ValueError:
+                continue
+
+    missing = [k for k in ["sample_id", *STATS_REQUIRED_KEYS] if k not in result]
+    if missing:
+        raise ValueError(f"{file} is missing {missing}")
+    return result
 
-    # Parse bam file name.
-    lines = file.read_text().splitlines()
-    bam_name = lines[1].split(":", 1)[1].strip()
-    result["sample_id"] = bam_name.split("_sorted.bam")[0]
+def _parse_stat_file_or_error(file: Path) -> Tuple[Optional[dict], Optional[str]]:
+    """parse_stat_file for pool workers, returning the error message instead of raising."""
+    try:
+        return parse_stat_file(file), None
+    except (OSError, ValueError) as e:
+        return None, str(e)
 
-    # Parse other metrics.
-    for line in lines[8:18]:
-        parts = line.split(": ", 1)
-        key = str(parts[0].strip()).replace(" ", "_")
-        value = parts[1].strip()
-        result[key] = round(float(value), 3)
+def build_stats_df(stat_file_paths: List[Path], cache_file: Optional[Path] = None,
+                   n_jobs: Optional[int] = None) -> pd.DataFrame:
+    """Generates a pandas dataframe containing sample.stats for SGSGeneLoss outputs.
 
-    assert len(result) == 11
-    return result
+    Files are parsed in a process pool. With a `cache_file`, parsed records are kept in Parquet keyed by file path,
+    mtime and size, so only new or changed files are parsed again. Files that cannot be parsed are skipped with a
+    warning.
+    """
+    stat_file_paths = [Path(f) for f in stat_file_paths]
+    keys = pd.DataFrame({
+        "file": [str(f) for f in stat_file_paths],
+        "mtime_ns": [f.stat().st_mtime_ns for f in stat_file_paths],
+        "size": [f.stat().st_size for f in stat_file_paths],
+    })
 
-def build_stats_df(stat_file_paths: List[Path]) -> pd.DataFrame:
-    """Generates a pandas dataframe containing sample.stats for SGSGeneLoss outputs."""
-    records  = [parse_stat_file(f) for f in stat_file_paths]
-    return pd.DataFrame(records)
+    cached = pd.DataFrame(columns=STATS_CACHE_KEYS)
+    if cache_file is not None and Path(cache_file).exists():
+        cached = pd.read_parquet(cache_file).merge(keys, on=STATS_CACHE_KEYS, how="inner")
+    todo = [f for f in stat_file_paths if str(f) not in set(cached["file"])]
+
+    parsed = map_in_pool(_parse_stat_file_or_error, todo, n_jobs, chunksize=16)
+
+    records = []
+    for f, (record, error) in zip(todo, parsed):
+        if record is None:
+            warnings.warn(f"Skipping stats file: {error}")
+            continue
+        records.append({"file": str(f), "mtime_ns": f.stat().st_mtime_ns, "size": f.stat().st_size, **record})
+
+    stats_df = pd.concat([cached, pd.DataFrame(records)], ignore_index=True) if records else cached
+    if cache_file is not None and records:
+        stats_df.to_parquet(cache_file, index=False)
+
+    # Keep the input file order.
+    stats_df = stats_df.set_index("file").reindex([str(f) for f in stat_file_paths]).dropna(how="all")
+    return stats_df.drop(columns=["mtime_ns", "size"]).reset_index(drop=True)
 
 def extract_present_subsample(pav_df: pd.DataFrame, n:int = None) -> List[str]:
     """Identifies a list of "core" genes using the PAV matrix, will randomly subset the data based on user input."""
@@ -190,38 +255,30 @@ def plt_total_read_count_v_number_present_genes(raw_df: pd.DataFrame) -> go.Figu
     return fig
 
 def plt_pav_matrix_pca(pav_df: pd.DataFrame) -> go.Figure:
-    X = pav_df.T
-    X = X.loc[:, (X != X.iloc[0]).any()]
-    pca = PCA(n_components=2)
-    pca_result = pca.fit_transform(X)
-    pca_df = pd.DataFrame({
-        'Sample': X.index,
-        'PC1': pca_result[:, 0],
-        'PC2': pca_result[:, 1]
-    })
+    pca = randomized_pca(pav_df)
+    pca_df = pca.coordinates.rename_axis("Sample").reset_index()
     fig = px.scatter(
         pca_df,
         x='PC1',
         y='PC2',
         title='PCA of PAV Matrix',
         hover_name="Sample",
-        labels={
-            'PC1': f"PC1 ({pca.explained_variance_ratio_[0] * 100:.2f}%)",
-            'PC2': f"PC2 ({pca.explained_variance_ratio_[1] * 100:.2f}%)"
-        }
+        labels=pca.axis_labels()
     )
     fig.update_traces(textposition='top center')
     return fig
 
-def plt_presence_v_coverage(pav_df: pd.DataFrame, cov_df: pd.DataFrame) -> go.Figure:
-    if not (pav_df.index == cov_df.index).all():
+def plt_presence_v_coverage(pav_df: pd.DataFrame, cov_store: CoverageStore,
+                            size_factors: Optional[pd.Series] = None) -> go.Figure:
+    """Present features against mean read depth per sample, depth optionally divided by per-sample size factors."""
+    if not pav_df.index.equals(cov_store.genes):
         raise ValueError("Feature indices of presence-absence and coverage matrices do not match.")
 
         # Summarize per-sample metrics
     summary_df = pd.DataFrame({
         "sample": pav_df.columns,
         "num_present_features": pav_df.sum(),
-        "average_read_depth": cov_df.mean()
+        "average_read_depth": cov_store.sample_means(size_factors).reindex(pav_df.columns)
     })
 
     # Create scatter plot
@@ -233,7 +290,7 @@ def plt_presence_v_coverage(pav_df: pd.DataFrame, cov_df: pd.DataFrame) -> go.Fi
         title="Feature Presence vs. Average Read Depth per Sample",
         labels={
             "num_present_features": "Number of Present Features (mincov = 0.05)",
-            "average_read_depth": "Average Read Depth"
+            "average_read_depth": "Average Read Depth" if size_factors is None else "Average Normalised Read Depth"
         },
         size_max=15  # maximum marker size
     )
@@ -338,22 +395,25 @@ if __name__ == "__main__":
     pio.templates.default = "plotly_white"
 
     # Build .stats dataframe.
-    stats_files =find_all_files(Path("../../data/sgsgeneloss/SGSGL_results/"), file_type=".txt")
-    raw_df = build_stats_df(stats_files)
+    stats_folder = Path("../../data/sgsgeneloss/SGSGL_results/")
+    raw_df = build_stats_df(find_stats_files(stats_folder), cache_file=stats_folder / "stats_cache.parquet")
     raw_df["sample_id"] = raw_df["sample_id"].str.removesuffix("_merged.bam")
 
     # Build pav dataframe and remove outlier samples.
-    pav_df = pd.read_csv("../../data/sgsgeneloss/pav_matrix.csv", index_col=0)
+    pav_df = load_pav_df("../../data/sgsgeneloss/pav_matrix.csv")
 
     # Extract core genes list (present in 100% of individuals).
     core_gene_list = extract_present_subsample(pav_df=pav_df)
 
     # Build gene length dataframe.
-    len_df = build_gene_length_table(excov_file=Path("../../data/sgsgeneloss/SGSGL_results/HALM12_19_merged_all.excov"))
+    # Positions were collected while ingesting the excovs, one excov is only read if the dataset is missing.
+    len_df = load_gene_positions(Path("../../data/sgsgeneloss/excov_dataset"),
+                                 fallback_excov=Path("../../data/sgsgeneloss/SGSGL_results/HALM12_19_merged_all.excov"))
     len_df.to_csv("../../data/sgsgeneloss_/gene_length_table.csv")
 
-    # Build coverage dataframe.
-    cov_df = pd.read_csv("../../data/sgsgeneloss/cov_matrix.csv", index_col=0)
+    # Open the chunked coverage store (converted from cov_matrix.csv on first use), normalised by mapped reads.
+    cov_store = load_coverage("../../data/sgsgeneloss/cov_matrix.csv")
+    size_factors = reads_mapped_size_factors(pd.read_csv("../../data/bam_stats/bam_stats_df.csv"), cov_store.samples)
 
     # Call functions and generate report.
     #figs = [plt_total_genes_lost_hist(raw_df),
@@ -363,7 +423,7 @@ if __name__ == "__main__":
     #        plt_lost_vs_present_avg_gene_length_box(raw_df),
     #        plt_lost_gene_sizes_box(raw_df),
     #        plt_pav_matrix_pca(pav_df),
-    #        plt_presence_v_coverage(pav_df, cov_df),
+    #        plt_presence_v_coverage(pav_df, cov_store, size_factors),
     #        plt_core_gene_length_box(len_df, core_gene_list)]
 
     #build_report(figs, "../../reports/sgsgeneloss_report.html")
@@ -8,6 +8,9 @@ import matplotlib.colors as mcolors
 import numpy as np
 from tabulate import tabulate
 from scripts.functional_annotation.combine_figures import grid_cols
+from scripts.go_enrichment.go_index import filter_by_go_terms
+from scripts.sgsgeneloss.pav_store import load_pav_df
+from scripts.sgsgeneloss.pav_heatmap import plt_pav_heatmap
 
 # Imports.
 DATA_FOLDER = Path("../../data/")
@@ -19,7 +22,7 @@ METADATA = Path("../../metadata/raw_sample_metadata.xlsx")
 
 # Pandas-ify - indexes are the same.
 nc_df = pd.read_csv(NC_DATASET, header=0, index_col=0)
-pav_df = pd.read_csv(PAV_MATRIX, header=0, index_col=0)
+pav_df = load_pav_df(PAV_MATRIX)
 loc_df = pd.read_csv(LOC_DATA, header=0, index_col=0)
 meta_df = pd.read_excel(METADATA, header=0, index_col=0)
 
@@ -71,11 +74,10 @@ go_terms_to_include = [
     "GO:0004672",
     "GO:0016709"
 ]
-pattern = "|".join(go_terms_to_include)
 
 
 # Filter.
-filtered_df = nc_df[nc_df["go_terms"].str.contains(pattern, na=False)]
+filtered_df = filter_by_go_terms(nc_df, go_terms_to_include, gene_col=None)
 #filtered_df = nc_df
 i_filtered = filtered_df.index
 filtered_pav = pav_df.loc[i_filtered]
@@ -106,28 +108,14 @@ functional_pav_df.index = functional_pav_df.index.str.split("|", n=2).str[-1]
 sorted_cols = [col for col in ordered_pop_colors.keys() if col in functional_pav_df.columns]
 functional_pav_df = functional_pav_df[sorted_cols]
 
-# Color bars for legend.
-cmap = mcolors.ListedColormap(["white", "darkgreen"])  # absent=white, present=darkgreen
-bounds = [0, 0.5, 1]
-norm = mcolors.BoundaryNorm(bounds, cmap.N)
+# Absent=white, present=darkgreen, drawn as one image so all genes can be included.
+cmap = mcolors.ListedColormap(["white", "darkgreen"])
 
 # --- Figure setup ---
-plt.figure(figsize=(16, 18))
-ax = sns.heatmap(
-    functional_pav_df,
-    cmap=cmap,
-    norm=norm,
-    cbar_kws={
-        "label": "Presence / Absence",
-        "ticks": [0.25, 0.75],
-        "orientation": "vertical",
-        "shrink": 0.7
-    },
-    linewidths=1,
-    linecolor='white',
-    xticklabels=True,
-    yticklabels=True,
-)
+fig, axes = plt_pav_heatmap(functional_pav_df, sample_colors=ordered_pop_colors, gene_filter="all",
+                            cluster_genes=False, cluster_samples=False, figsize=(16, 18), cmap=cmap,
+                            title="PAV Heatmap (Grouped by Population)")
+ax = axes.heatmap
 
 # --- Y-axis ticks (rounded & human-readable) ---
 #num_ticks = 10
@@ -150,27 +138,12 @@ ax = sns.heatmap(
 #ax.set_yticklabels(tick_labels, fontsize=20)
 #ax.set_ylabel("Position in Genome", fontsize=20)
 
-# --- X-axis customization: color labels by population ---
-for tick_label in ax.get_xticklabels():
-    sample = tick_label.get_text()
-    if sample in ordered_pop_colors:
-        tick_label.set_color(ordered_pop_colors[sample])
-    tick_label.set_rotation(90)
-    tick_label.set_fontsize(18)
-
-#ax.set_xlabel("Sample (grouped by island)", fontsize=20)
-plt.title("PAV Heatmap (Grouped by Population)", fontsize=24, pad=20)
-
-
-# --- Colorbar tweaks ---
-cbar = ax.collections[0].colorbar
-cbar.set_ticklabels(["Absent", "Present"])
-cbar.ax.tick_params(labelsize=14)
-cbar.set_label("Presence / Absence", fontsize=20)
-
-# --- Tight layout for publication ---
-ax.set_xticklabels(ax.get_xticklabels(), fontsize=20)
-ax.set_yticklabels(ax.get_yticklabels(), fontsize=20)
+# --- Tick labels for publication ---
+ax.tick_params(axis="x", labelsize=18)
+ax.tick_params(axis="y", labelsize=20)
+axes.colorbar.tick_params(labelsize=14)
+axes.colorbar.set_ylabel("Presence / Absence", fontsize=20)
+axes.title_axes.set_title("PAV Heatmap (Grouped by Population)", fontsize=24, pad=20)
 plt.tight_layout()
 plt.show()
 
@@ -0,0 +1,311 @@
+# Neighbour-joining and UPGMA/WPGMA trees from (condensed) distance matrices, written straight to Newick.
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import squareform
+
+from scripts.sgsgeneloss.pav_store import load_pav
+from scripts.sgsgeneloss.pav_distance_cache import condensed_distances
+
+# GLOBALS
+# Characters that force a Newick label to be quoted.
+NEWICK_SPECIAL = set("()[]':;, \t")
+# Quoted labels, bare labels, [comments] and punctuation of a Newick string.
+NEWICK_TOKEN = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^\s(),:;\[\]']+")
+
+
+@dataclass
+class DistanceTree:
+    """Tree over `taxa` as a parent array: nodes 0..n_taxa-1 are the tips, the root has parent -1.
+
+    `lengths[v]` is the branch length from v to its parent and `labels` optional internal node labels (e.g.
+    bootstrap support) written into the Newick.
+    """
+    parent: np.ndarray
+    lengths: np.ndarray
+    taxa: List[str]
+    labels: Dict[int, str] = field(default_factory=dict)
+
+    @property
+    def root(self) -> int:
+        return int(np.flatnonzero(self.parent < 0)[0])
+
+    def children(self) -> List[List[int]]:
+        kids = [[] for _ in range(len(self.parent))]
+        for node, up in enumerate(self.parent):
+            if up >= 0:
+                kids[up].append(node)
+        return kids
+
+    def postorder(self) -> List[int]:
+        """Nodes with every child before its parent, without recursion so deep trees are fine."""
+        kids = self.children()
+        order, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(kids[node])
+        return order[::-1]
+
+    def node_splits(self, taxa: Optional[Sequence[str]] = None) -> Dict[int, int]:
+        """Non-trivial bipartition of each internal non-root node as a bitset over `taxa` (the tree's own by default).
+
+        Splits are oriented to exclude the first taxon, so a clade gets the same bitset whatever the rooting. Tips
+        not in `taxa` are ignored, which restricts the splits to the tree pruned to those taxa.
+        """
+        taxa = self.taxa if taxa is None else list(taxa)
+        bit = {name: 1 << i for i, name in enumerate(taxa)}
+        full = (1 << len(taxa)) - 1
+        masks = [0] * len(self.parent)
+        splits = {}
+        for node in self.postorder():
+            if node < len(self.taxa):
+                masks[node] |= bit.get(self.taxa[node], 0)
+            elif self.parent[node] >= 0:
+                split = full ^ masks[node] if masks[node] & 1 else masks[node]
+                if 1 < split.bit_count() < len(taxa) - 1:
+                    splits[node] = split
+            if self.parent[node] >= 0:
+                masks[self.parent[node]] |= masks[node]
+        return splits
+
+    def splits(self, taxa: Optional[Sequence[str]] = None) -> Set[int]:
+        """Set of non-trivial bipartitions, for comparing topologies."""
+        return set(self.node_splits(taxa).values())
+
+    def newick(self) -> str:
+        """Newick string with branch lengths and any internal labels."""
+        kids = self.children()
+        text = {}
+        for node in self.postorder():
+            if node < len(self.taxa):
+                label = _newick_label(self.taxa[node])
+            else:
+                label = "(" + ",".join(text.pop(c) for c in kids[node]) + ")" + self.labels.get(node, "")
+            text[node] = label if self.parent[node] < 0 else f"{label}:{self.lengths[node]:.10g}"
+        return text[self.root] + ";"
+
+    def write(self, path) -> None:
+        Path(path).write_text(self.newick() + "\n")
+
+    def root_at_midpoint(self) -> "DistanceTree":
+        """Copy rooted halfway along the longest tip-to-tip path, unary nodes left behind are dissolved."""
+        n_nodes = len(self.parent)
+        adjacency = [[] for _ in range(n_nodes)]
+        for node, up in enumerate(self.parent):
+            if up >= 0:
+                adjacency[node].append((up, self.lengths[node]))
+                adjacency[up].append((node, self.lengths[node]))
+
+        def farthest(start: int):
+            dist = np.full(n_nodes, -1.0)
+            prev = np.full(n_nodes, -1)
+            dist[start], stack = 0.0, [start]
+            while stack:
+                node = stack.pop()
+                for other, length in adjacency[node]:
+                    if dist[other] < 0:
+                        dist[other], prev[other] = dist[node] + length, node
+                        stack.append(other)
+            tips = np.arange(len(self.taxa))
+            return int(tips[np.argmax(dist[tips])]), dist, prev
+
+        a, _, _ = farthest(0)
+        b, dist, prev = farthest(a)
+        half = dist[b] / 2
+        # Walk back from b until the edge (node, prev[node]) spans the midpoint.
+        node = b
+        while dist[prev[node]] > half:
+            node = prev[node]
+        up = prev[node]
+
+        # New root splits that edge, then every edge is reoriented away from it.
+        new_root = n_nodes
+        adjacency.append([(node, dist[node] - half), (up, half - dist[up])])
+        adjacency[node] = [(o, l) for o, l in adjacency[node] if o != up] + [(new_root, dist[node] - half)]
+        adjacency[up] = [(o, l) for o, l in adjacency[up] if o != node] + [(new_root, half - dist[up])]
+        parent = np.full(n_nodes + 1, -1)
+        lengths = np.zeros(n_nodes + 1)
+        stack = [new_root]
+        seen = np.zeros(n_nodes + 1, dtype=bool)
+        seen[new_root] = True
+        while stack:
+            current = stack.pop()
+            for other, length in adjacency[current]:
+                if not seen[other]:
+                    seen[other] = True
+                    parent[other], lengths[other] = current, length
+                    stack.append(other)
+        return _dissolve_unary(parent, lengths, self.taxa, self.labels)
+
+
+def _newick_label(name: str) -> str:
+    if NEWICK_SPECIAL.intersection(name):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+
+def parse_newick(text: str) -> DistanceTree:
+    """Parses one Newick tree, keeping branch lengths and internal labels (e.g. support values).
+
+    [comments] are skipped, missing lengths read as 0 and underscores in bare labels are kept (as ete3 does).
+    """
+    parent, lengths, names, is_tip = [], [], [], []
+    stack, last, after_close, expect_length = [], -1, False, False
+    for token in NEWICK_TOKEN.findall(text):
+        if token.startswith("["):
+            continue
+        if token == "(":
+            parent.append(stack[-1] if stack else -1)
+            lengths.append(0.0)
+            names.append("")
+            is_tip.append(False)
+            stack.append(len(parent) - 1)
+        elif token == ")":
+            last, after_close = stack.pop(), True
+        elif token == ",":
+            after_close = False
+        elif token == ":":
+            expect_length = True
+        elif token == ";":
+            break
+        elif expect_length:
+            lengths[last] = float(token)
+            expect_length = False
+        else:
+            name = token[1:-1].replace("''", "'") if token.startswith("'") else token
+            if after_close:
+                names[last] = name
+            else:
+                parent.append(stack[-1] if stack else -1)
+                lengths.append(0.0)
+                names.append(name)
+                is_tip.append(True)
+                last = len(parent) - 1
+            after_close = False
+
+    # Renumber so tips come first, in reading order.
+    is_tip = np.array(is_tip)
+    order = np.concatenate([np.flatnonzero(is_tip), np.flatnonzero(~is_tip)])
+    renumber = np.empty(len(order), dtype=int)
+    renumber[order] = np.arange(len(order))
+    old_parent = np.array(parent)[order]
+    new_parent = np.where(old_parent >= 0, renumber[np.maximum(old_parent, 0)], -1)
+    labels = {int(renumber[k]): names[k] for k in np.flatnonzero(~is_tip) if names[k]}
+    return DistanceTree(parent=new_parent, lengths=np.array(lengths)[order],
+                        taxa=[names[k] for k in np.flatnonzero(is_tip)], labels=labels)
+
+
+def read_newick(path) -> DistanceTree:
+    """Reads the first tree of a Newick file."""
+    return parse_newick(Path(path).read_text())
+
+
+def _dissolve_unary(parent: np.ndarray, lengths: np.ndarray, taxa: List[str], labels: Dict[int, str]) -> DistanceTree:
+    """Merges non-root nodes with a single child into that child's branch and renumbers the internal nodes."""
+    n_children = np.bincount(parent[parent >= 0], minlength=len(parent))
+    keep = np.ones(len(parent), dtype=bool)
+    for node in np.flatnonzero((n_children == 1) & (parent >= 0)):
+        child = int(np.flatnonzero(parent == node)[0])
+        parent[child] = parent[node]
+        lengths[child] += lengths[node]
+        keep[node] = False
+    renumber = np.cumsum(keep) - 1
+    new_parent = np.where(parent[keep] >= 0, renumber[np.maximum(parent[keep], 0)], -1)
+    new_labels = {int(renumber[n]): label for n, label in labels.items() if keep[n]}
+    return DistanceTree(parent=new_parent, lengths=lengths[keep], taxa=taxa, labels=new_labels)
+
+
+def _square(dist: np.ndarray) -> np.ndarray:
+    dist = np.asarray(dist, dtype=np.float64)
+    return squareform(dist) if dist.ndim == 1 else dist.copy()
+
+
+def neighbor_joining(dist: np.ndarray, taxa: Sequence[str], clip_negative: bool = True) -> DistanceTree:
+    """Unrooted NJ tree (trifurcating root) from a condensed or square distance matrix.
+
+    Every round scores the full Q matrix of the m live nodes, so the search is O(n^3) overall. Live nodes are kept
+    in the leading m x m block of the distance matrix (a joined pair's last slot is filled from the end), so each
+    round works on one contiguous block instead of copying the live rows. Negative branch lengths are set to 0
+    unless `clip_negative` is False.
+    """
+    D = _square(dist)
+    n = len(D)
+    taxa = [str(t) for t in taxa]
+    if n != len(taxa):
+        raise ValueError(f"{len(taxa)} taxa for a {n} x {n} distance matrix.")
+    if n < 3:
+        parent = np.array([n] * n + [-1])
+        lengths = np.append(np.full(n, D[0, -1] / 2 if n == 2 else 0.0), 0.0)
+        return DistanceTree(parent=parent, lengths=lengths, taxa=taxa)
+
+    r = D.sum(axis=1)
+    np.fill_diagonal(D, np.inf)
+    q_buffer = np.empty_like(D)
+    node_of = np.arange(n)
+    parent = np.full(2 * n - 2, -1)
+    lengths = np.zeros(2 * n - 2)
+    next_node = n
+
+    for m in range(n, 3, -1):
+        q = q_buffer[:m, :m]
+        np.multiply(D[:m, :m], m - 2, out=q)
+        q -= r[:m, None]
+        q -= r[None, :m]
+        i, j = sorted(divmod(int(np.argmin(q)), m))
+
+        dij = D[i, j]
+        li = dij / 2 + (r[i] - r[j]) / (2 * (m - 2))
+        lj = dij - li
+        if clip_negative:
+            li, lj = max(li, 0.0), max(lj, 0.0)
+        parent[node_of[i]], lengths[node_of[i]] = next_node, li
+        parent[node_of[j]], lengths[node_of[j]] = next_node, lj
+
+        # The new node takes slot i, the last live slot moves into slot j.
+        new = (D[i, :m] + D[j, :m] - dij) / 2
+        others = np.ones(m, dtype=bool)
+        others[[i, j]] = False
+        r[:m][others] += new[others] - D[i, :m][others] - D[j, :m][others]
+        r[i] = new[others].sum()
+        new[i] = np.inf
+        D[i, :m], D[:m, i] = new, new
+        node_of[i] = next_node
+        next_node += 1
+        last = m - 1
+        if j != last:
+            D[j, :m], D[:m, j] = D[last, :m], D[:m, last]
+            D[j, j] = np.inf
+            r[j], node_of[j] = r[last], node_of[last]
+
+    # Join the last three at the root.
+    for x, y, z in ((0, 1, 2), (1, 0, 2), (2, 0, 1)):
+        length = (D[x, y] + D[x, z] - D[y, z]) / 2
+        parent[node_of[x]], lengths[node_of[x]] = next_node, max(length, 0.0) if clip_negative else length
+    return DistanceTree(parent=parent, lengths=lengths, taxa=taxa)
+
+
+def upgma(dist: np.ndarray, taxa: Sequence[str], weighted: bool = False) -> DistanceTree:
+    """Rooted ultrametric UPGMA (average linkage) tree, or WPGMA (weighted average linkage) with `weighted`."""
+    condensed = squareform(_square(dist), checks=False)
+    n = len(taxa)
+    Z = linkage(condensed, method="weighted" if weighted else "average")
+    parent = np.full(2 * n - 1, -1)
+    heights = np.zeros(2 * n - 1)
+    heights[n:] = Z[:, 2] / 2
+    for k, (x, y) in enumerate(Z[:, :2].astype(int)):
+        parent[x] = parent[y] = n + k
+    lengths = np.where(parent >= 0, heights[parent] - heights, 0.0)
+    return DistanceTree(parent=parent, lengths=lengths, taxa=[str(t) for t in taxa])
+
+
+if __name__ == "__main__":
+    DATA_FOLDER = Path("../../data")
+    pav = load_pav(DATA_FOLDER / "sgsgeneloss/pav_matrix.csv")
+    condensed = condensed_distances(pav, "hamming")
+    taxa = [s.removesuffix("_merged_all") for s in pav.samples]
+    upgma(condensed, taxa).write(DATA_FOLDER / "phylo_pav_tree_upgma.nwk")
+    neighbor_joining(condensed, taxa).root_at_midpoint().write(DATA_FOLDER / "phylo_pav_tree.nwk")
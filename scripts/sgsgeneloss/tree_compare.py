@@ -0,0 +1,222 @@
+# Headless quantitative comparison of two trees (Robinson-Foulds, clade overlap) and a matplotlib tanglegram.
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+from scripts.sgsgeneloss.tree_builder import DistanceTree
+
+# GLOBALS
+# Barycentre passes (right onto left, then left onto right) tried when untangling.
+UNTANGLE_ROUNDS = 10
+
+
+def shared_taxa(tree_a: DistanceTree, tree_b: DistanceTree) -> List[str]:
+    """Sorted tip names present in both trees, the taxa every comparison is restricted to."""
+    return sorted(set(tree_a.taxa) & set(tree_b.taxa))
+
+
+def robinson_foulds(tree_a: DistanceTree, tree_b: DistanceTree, taxa: Optional[Sequence[str]] = None) -> Dict[str, float]:
+    """Unrooted Robinson-Foulds distance on the shared taxa, plus its normalised form RF / (|S_a| + |S_b|).
+
+    For two fully resolved trees the denominator is the usual maximum 2 * (n - 3).
+    """
+    taxa = shared_taxa(tree_a, tree_b) if taxa is None else list(taxa)
+    splits_a, splits_b = tree_a.splits(taxa), tree_b.splits(taxa)
+    rf = len(splits_a ^ splits_b)
+    return {"rf": rf, "max_rf": len(splits_a) + len(splits_b),
+            "normalised_rf": rf / max(len(splits_a) + len(splits_b), 1)}
+
+
+def _best_match_jaccard(splits: Sequence[int], others: Sequence[int]) -> np.ndarray:
+    """For each split, the highest Jaccard index of its clade side with any split of the other tree."""
+    best = np.zeros(len(splits))
+    for k, split in enumerate(splits):
+        for other in others:
+            best[k] = max(best[k], (split & other).bit_count() / (split | other).bit_count())
+    return best
+
+
+def clade_overlap(tree_a: DistanceTree, tree_b: DistanceTree, taxa: Optional[Sequence[str]] = None) -> Dict[str, float]:
+    """Fraction of each tree's clades found exactly in the other, and their mean best-match Jaccard overlap.
+
+    The Jaccard scores credit clades that differ by a few misplaced samples, which RF counts as entirely wrong.
+    """
+    taxa = shared_taxa(tree_a, tree_b) if taxa is None else list(taxa)
+    splits_a, splits_b = sorted(tree_a.splits(taxa)), sorted(tree_b.splits(taxa))
+    shared = len(set(splits_a) & set(splits_b))
+    return {
+        "clades_a": len(splits_a),
+        "clades_b": len(splits_b),
+        "shared_clades": shared,
+        "frac_a_in_b": shared / max(len(splits_a), 1),
+        "frac_b_in_a": shared / max(len(splits_b), 1),
+        "mean_jaccard_a_to_b": float(_best_match_jaccard(splits_a, splits_b).mean()) if splits_a else np.nan,
+        "mean_jaccard_b_to_a": float(_best_match_jaccard(splits_b, splits_a).mean()) if splits_b else np.nan,
+    }
+
+
+def compare_trees(tree_a: DistanceTree, tree_b: DistanceTree) -> pd.Series:
+    """All comparison metrics of two trees on their shared taxa."""
+    taxa = shared_taxa(tree_a, tree_b)
+    return pd.Series({
+        "n_taxa_a": len(tree_a.taxa),
+        "n_taxa_b": len(tree_b.taxa),
+        "n_shared_taxa": len(taxa),
+        **robinson_foulds(tree_a, tree_b, taxa),
+        **clade_overlap(tree_a, tree_b, taxa),
+    }, name="value")
+
+
+def _tip_order(tree: DistanceTree, kids: List[List[int]]) -> List[int]:
+    """Tips in drawing order for the given child order."""
+    order, stack = [], [tree.root]
+    while stack:
+        node = stack.pop()
+        if node < len(tree.taxa):
+            order.append(node)
+        stack.extend(reversed(kids[node]))
+    return order
+
+
+def _reorder(tree: DistanceTree, kids: List[List[int]], target: Mapping[str, float]) -> List[List[int]]:
+    """Rotates every node's children by the mean target position of their tips (barycentre heuristic).
+
+    Subtrees without any tip in `target` keep their current relative position.
+    """
+    current = np.empty(len(tree.taxa))
+    current[_tip_order(tree, kids)] = np.linspace(0, 1, len(tree.taxa))
+    total = np.zeros(len(tree.parent))
+    count = np.zeros(len(tree.parent))
+    fallback = np.zeros(len(tree.parent))
+    n_tips = np.zeros(len(tree.parent))
+    for node in tree.postorder():
+        if node < len(tree.taxa):
+            if tree.taxa[node] in target:
+                total[node], count[node] = target[tree.taxa[node]], 1
+            fallback[node], n_tips[node] = current[node], 1
+        up = tree.parent[node]
+        if up >= 0:
+            total[up] += total[node]
+            count[up] += count[node]
+            fallback[up] += fallback[node]
+            n_tips[up] += n_tips[node]
+    key = np.where(count > 0, total / np.maximum(count, 1), fallback / np.maximum(n_tips, 1))
+    return [sorted(children, key=lambda c: key[c]) for children in kids]
+
+
+def _positions(tree: DistanceTree, kids: List[List[int]], taxa: Sequence[str]) -> np.ndarray:
+    order = {tree.taxa[tip]: k for k, tip in enumerate(_tip_order(tree, kids))}
+    return np.array([order[name] for name in taxa], dtype=float)
+
+
+def count_crossings(positions_a: np.ndarray, positions_b: np.ndarray) -> int:
+    """Number of crossing connector pairs, i.e. inversions between the two leaf orders."""
+    b = positions_b[np.argsort(positions_a)]
+    return int(np.triu(b[:, None] > b[None, :], k=1).sum())
+
+
+def untangle(tree_a: DistanceTree, tree_b: DistanceTree,
+             rounds: int = UNTANGLE_ROUNDS) -> Tuple[List[List[int]], List[List[int]], int]:
+    """Child orders of both trees minimising connector crossings by alternating barycentre rotation.
+
+    Each pass rotates one tree's nodes towards the other's current leaf order and the best layout seen is kept,
+    then single-node flips that still remove crossings are applied greedily.
+    """
+    taxa = shared_taxa(tree_a, tree_b)
+    kids_a, kids_b = tree_a.children(), tree_b.children()
+    best = (kids_a, kids_b, count_crossings(_positions(tree_a, kids_a, taxa), _positions(tree_b, kids_b, taxa)))
+    for _ in range(rounds):
+        kids_b = _reorder(tree_b, kids_b, dict(zip(taxa, _positions(tree_a, kids_a, taxa))))
+        kids_a = _reorder(tree_a, kids_a, dict(zip(taxa, _positions(tree_b, kids_b, taxa))))
+        crossings = count_crossings(_positions(tree_a, kids_a, taxa), _positions(tree_b, kids_b, taxa))
+        if crossings >= best[2]:
+            break
+        best = (kids_a, kids_b, crossings)
+
+    # Greedy refinement: flip any node whose reversed children cross less.
+    kids_a, kids_b, crossings = best
+    for tree, kids, other in ((tree_a, kids_a, (tree_b, kids_b)), (tree_b, kids_b, (tree_a, kids_a))):
+        fixed = _positions(*other, taxa)
+        for node in tree.postorder()[::-1]:
+            if len(kids[node]) < 2:
+                continue
+            kids[node].reverse()
+            flipped = count_crossings(_positions(tree, kids, taxa), fixed)
+            if flipped < crossings:
+                crossings = flipped
+            else:
+                kids[node].reverse()
+    return kids_a, kids_b, crossings
+
+
+def _layout(tree: DistanceTree, kids: List[List[int]], use_lengths: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """Node x (root distance scaled to [0, 1]) and y (tip rank, internal nodes centred on their children)."""
+    x = np.zeros(len(tree.parent))
+    for node in tree.postorder()[::-1]:
+        up = tree.parent[node]
+        if up >= 0:
+            x[node] = x[up] + (tree.lengths[node] if use_lengths else 1.0)
+    x /= max(x.max(), np.finfo(float).tiny)
+    y = np.zeros(len(tree.parent))
+    y[_tip_order(tree, kids)] = np.arange(len(tree.taxa))[::-1]
+    for node in tree.postorder():
+        if node >= len(tree.taxa):
+            y[node] = (y[kids[node]].min() + y[kids[node]].max()) / 2
+    return x, y
+
+
+def _tree_segments(tree: DistanceTree, kids: List[List[int]], x: np.ndarray, y: np.ndarray) -> List:
+    segments = []
+    for node in range(len(tree.parent)):
+        up = tree.parent[node]
+        if up >= 0:
+            segments.append([(x[up], y[node]), (x[node], y[node])])
+        if kids[node]:
+            segments.append([(x[node], y[kids[node]].min()), (x[node], y[kids[node]].max())])
+    return segments
+
+
+def plot_tanglegram(tree_a: DistanceTree, tree_b: DistanceTree, titles: Sequence[str] = ("Tree A", "Tree B"),
+                    colors: Optional[Mapping[str, str]] = None, use_lengths: bool = True,
+                    figsize: Optional[Tuple[float, float]] = None) -> plt.Figure:
+    """Draws two rooted trees facing each other with shared tips joined, after crossing-minimising rotation.
+
+    Uses matplotlib only, so it runs under the Agg backend on nodes without a display.
+    """
+    colors = colors or {}
+    kids_a, kids_b, crossings = untangle(tree_a, tree_b)
+    xa, ya = _layout(tree_a, kids_a, use_lengths)
+    xb, yb = _layout(tree_b, kids_b, use_lengths)
+    # Left tree spans [0, 1], labels and connectors sit in [1, 3], the right tree is mirrored into [3, 4].
+    xb = 4 - xb
+    n_rows = max(len(tree_a.taxa), len(tree_b.taxa))
+    fig, ax = plt.subplots(figsize=figsize or (14, max(6, 0.18 * n_rows)))
+
+    ax.add_collection(LineCollection(_tree_segments(tree_a, kids_a, xa, ya), colors="black", linewidths=0.8))
+    ax.add_collection(LineCollection(_tree_segments(tree_b, kids_b, xb, yb), colors="black", linewidths=0.8))
+    for tip, name in enumerate(tree_a.taxa):
+        ax.plot([xa[tip], 1.02], [ya[tip]] * 2, ls=":", lw=0.5, color="grey")
+        ax.text(1.04, ya[tip], name, va="center", ha="left", fontsize=6, color=colors.get(name, "black"))
+    for tip, name in enumerate(tree_b.taxa):
+        ax.plot([2.98, xb[tip]], [yb[tip]] * 2, ls=":", lw=0.5, color="grey")
+        ax.text(2.96, yb[tip], name, va="center", ha="right", fontsize=6, color=colors.get(name, "black"))
+
+    tip_b = {name: tip for tip, name in enumerate(tree_b.taxa)}
+    connectors, connector_colors = [], []
+    for tip, name in enumerate(tree_a.taxa):
+        if name in tip_b:
+            connectors.append([(1.6, ya[tip]), (2.4, yb[tip_b[name]])])
+            connector_colors.append(colors.get(name, "grey"))
+    ax.add_collection(LineCollection(connectors, colors=connector_colors, linewidths=0.8, alpha=0.8))
+
+    ax.set_xlim(-0.05, 4.05)
+    ax.set_ylim(-1, n_rows)
+    ax.text(0, n_rows - 0.2, titles[0], fontsize=14, va="bottom")
+    ax.text(4, n_rows - 0.2, titles[1], fontsize=14, va="bottom", ha="right")
+    ax.set_title(f"{crossings} connector crossings", fontsize=9)
+    ax.axis("off")
+    fig.tight_layout()
+    return fig
+
@@ -0,0 +1,165 @@
+# Cached UMAP embeddings of PAV samples and a parallel hyperparameter sweep over one precomputed kNN graph.
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+from sklearn.manifold import trustworthiness
+from sklearn.metrics import silhouette_score
+
+from scripts.sgsgeneloss.pav_store import PackedPav, load_pav
+from scripts.sgsgeneloss.pav_distance_cache import GeneFilter, distance_frame, distance_key
+
+# GLOBALS
+UMAP_CACHE_DIR = Path("../../data/umap_cache")
+# Grid around the hand-tuned n_neighbors = 7 from the UMAP optimisation notes.
+DEFAULT_GRID = {"n_neighbors": [5, 7, 10, 15], "min_dist": [0.0, 0.1, 0.25, 0.5], "metric": ["hamming", "jaccard"]}
+# Neighbourhood size used to score how well an embedding preserves the original distances.
+TRUST_NEIGHBORS = 5
+
+
+@dataclass(frozen=True)
+class UmapParams:
+    """UMAP settings of one embedding, `metric` names the cached PAV distance it is fitted on."""
+    n_neighbors: int = 7
+    min_dist: float = 0.1
+    n_components: int = 2
+    metric: str = "hamming"
+    seed: int = 42
+
+
+def knn_graph(dist: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact k nearest neighbours (self first, as UMAP expects) from a square distance matrix."""
+    k = min(k, len(dist))
+    ranked = dist.copy()
+    # Self goes first even when duplicate samples are also at distance 0.
+    np.fill_diagonal(ranked, -1)
+    indices = np.argpartition(ranked, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(ranked, indices, axis=1), axis=1, kind="stable")
+    indices = np.take_along_axis(indices, order, axis=1)
+    return indices, np.take_along_axis(dist, indices, axis=1)
+
+
+def embedding_key(pav: PackedPav, params: UmapParams, gene_filter: GeneFilter = "all") -> str:
+    """sha1 of the distance cache key (PAV content hash, gene filter, metric), the UMAP parameters and version."""
+    from umap import __version__ as umap_version
+    digest = hashlib.sha1()
+    digest.update(distance_key(pav, params.metric, gene_filter).encode())
+    digest.update(json.dumps(asdict(params), sort_keys=True).encode())
+    digest.update(umap_version.encode())
+    return digest.hexdigest()
+
+
+def _fit_umap(args) -> np.ndarray:
+    """Fits one UMAP on a precomputed distance matrix and kNN graph."""
+    from umap import UMAP
+    dist, knn, params = args
+    model = UMAP(n_neighbors=params.n_neighbors, min_dist=params.min_dist, n_components=params.n_components,
+                 metric="precomputed", random_state=params.seed, precomputed_knn=knn)
+    with warnings.catch_warnings():
+        # random_state forces a single thread and precomputed distances rule out transform, both intended here.
+        warnings.simplefilter("ignore", UserWarning)
+        return model.fit_transform(dist)
+
+
+def _coordinates(coords: np.ndarray, samples: pd.Index) -> pd.DataFrame:
+    return pd.DataFrame(coords, index=samples, columns=[f"UMAP{i + 1}" for i in range(coords.shape[1])])
+
+
+def _cache_file(cache_dir: Optional[Path], key: str) -> Optional[Path]:
+    return Path(cache_dir) / f"{key}.parquet" if cache_dir else None
+
+
+def embed(pav: Union[pd.DataFrame, PackedPav], params: UmapParams = UmapParams(), gene_filter: GeneFilter = "all",
+          cache_dir: Optional[Path] = UMAP_CACHE_DIR) -> pd.DataFrame:
+    """Samples x UMAP coordinates, fitted once per (PAV hash, gene filter, parameters, seed) and then read back."""
+    packed = pav if isinstance(pav, PackedPav) else PackedPav.from_frame(pav)
+    cache_file = _cache_file(cache_dir, embedding_key(packed, params, gene_filter))
+    if cache_file is not None and cache_file.exists():
+        return pd.read_parquet(cache_file)
+
+    dist = distance_frame(packed, params.metric, gene_filter).to_numpy()
+    coords = _coordinates(_fit_umap((dist, knn_graph(dist, params.n_neighbors), params)), packed.samples)
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        coords.to_parquet(cache_file)
+    return coords
+
+
+def score_embedding(dist: np.ndarray, coords: np.ndarray, labels: Optional[np.ndarray] = None) -> Dict[str, float]:
+    """Trustworthiness against the original distances, and the silhouette of the group labels in the embedding."""
+    scores = {"trustworthiness": trustworthiness(dist, coords, n_neighbors=min(TRUST_NEIGHBORS, len(dist) // 2 - 1),
+                                                 metric="precomputed")}
+    if labels is not None:
+        known = pd.notna(labels)
+        scores["silhouette"] = (silhouette_score(coords[known], labels[known])
+                                if len(set(labels[known])) > 1 else np.nan)
+    return scores
+
+
+def sweep(pav: Union[pd.DataFrame, PackedPav], grid: Mapping[str, Sequence] = DEFAULT_GRID,
+          labels: Optional[pd.Series] = None, gene_filter: GeneFilter = "all", n_components: int = 2,
+          seed: int = 42, n_jobs: Optional[int] = None, cache_dir: Optional[Path] = UMAP_CACHE_DIR) -> pd.DataFrame:
+    """Fits every n_neighbors x min_dist x metric combination in a process pool and scores each embedding.
+
+    Per metric the distances come from the distance cache and one kNN graph at the largest n_neighbors is shared
+    by all fits. Cached embeddings are only scored, new ones are written to the cache. `labels` (e.g. island per
+    sample) adds a silhouette column. Returns one row per combination, best trustworthiness first.
+    """
+    packed = pav if isinstance(pav, PackedPav) else PackedPav.from_frame(pav)
+    combos = [UmapParams(n_neighbors=k, min_dist=d, n_components=n_components, metric=m, seed=seed)
+              for k, d, m in itertools.product(grid["n_neighbors"], grid["min_dist"], grid["metric"])]
+    dists = {m: distance_frame(packed, m, gene_filter).to_numpy() for m in grid["metric"]}
+    knns = {m: knn_graph(dist, max(grid["n_neighbors"])) for m, dist in dists.items()}
+
+    coords: Dict[UmapParams, np.ndarray] = {}
+    to_fit: List[UmapParams] = []
+    for params in combos:
+        cache_file = _cache_file(cache_dir, embedding_key(packed, params, gene_filter))
+        if cache_file is not None and cache_file.exists():
+            coords[params] = pd.read_parquet(cache_file).to_numpy()
+        else:
+            to_fit.append(params)
+
+    jobs = [(dists[p.metric], knns[p.metric], p) for p in to_fit]
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs == 1 or len(jobs) <= 1:
+        fitted = [_fit_umap(job) for job in jobs]
+    else:
+        # Spawned rather than forked, since a parent that already ran UMAP holds numba worker threads.
+        spawn = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs)), mp_context=spawn) as pool:
+            fitted = list(pool.map(_fit_umap, jobs))
+    for params, fit in zip(to_fit, fitted):
+        coords[params] = fit
+        cache_file = _cache_file(cache_dir, embedding_key(packed, params, gene_filter))
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            _coordinates(fit, packed.samples).to_parquet(cache_file)
+
+    label_values = None if labels is None else labels.reindex(packed.samples).to_numpy()
+    rows = [{**asdict(p), **score_embedding(dists[p.metric], coords[p], label_values)} for p in combos]
+    return pd.DataFrame(rows).sort_values("trustworthiness", ascending=False, ignore_index=True)
+
+
+def best_params(sweep_df: pd.DataFrame, by: str = "trustworthiness") -> UmapParams:
+    """Parameters of the top row of a sweep by one score column."""
+    row = sweep_df.loc[sweep_df[by].idxmax()]
+    return replace(UmapParams(), **{f: type(getattr(UmapParams(), f))(row[f]) for f in asdict(UmapParams())})
+
+
+if __name__ == "__main__":
+    pav = load_pav(Path("../../data/sgsgeneloss/pav_matrix.csv"))
+    meta_df = pd.read_excel("../../metadata/raw_sample_metadata.xlsx", index_col=0, sheet_name="S1 Sample Overview")
+    islands = meta_df["Island"].rename(index=lambda s: f"{s}_merged_all")
+    sweep_df = sweep(pav, labels=islands)
+    sweep_df.to_csv("../../data/sgsgeneloss/umap_sweep.csv", index=False)
+    print(sweep_df.head(10))
+    print(best_params(sweep_df, by="silhouette"))